@@ -0,0 +1,254 @@
+# admission.py
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import Depends, Request
+from fastapi.exceptions import HTTPException
+
+from app.auth import current_user_id
+from app.writer import GROUP_COMMIT_MAX_BATCH, group_writer
+
+# Write routes are rate limited and gated in front of SQLite's single writer
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", default="true").lower() in (
+    "1",
+    "true",
+)
+
+# Sustained writes per second and burst size, per user and for the process
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", default=20))
+ADMISSION_USER_BURST = float(os.getenv("ADMISSION_USER_BURST", default=40))
+ADMISSION_GLOBAL_RATE = float(os.getenv("ADMISSION_GLOBAL_RATE", default=2000))
+ADMISSION_GLOBAL_BURST = float(os.getenv("ADMISSION_GLOBAL_BURST", default=4000))
+
+# Hard cap on tracked users; idle buckets are dropped well before this
+ADMISSION_MAX_USERS = int(os.getenv("ADMISSION_MAX_USERS", default=100000))
+
+# Writes running against the database at once, how many may wait for a slot
+# and for how long before they are turned away
+WRITE_CONCURRENCY = int(os.getenv("WRITE_CONCURRENCY", default=8))
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", default=64))
+WRITE_QUEUE_TIMEOUT = float(os.getenv("WRITE_QUEUE_TIMEOUT", default=2.0))
+
+
+def _too_many(detail: str, retry_after: float):
+    return HTTPException(
+        status_code=429,
+        detail=detail,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+
+    def take(self, rate: float, burst: float, now: float, cost: float = 1):
+        # Returns 0 when cost tokens were taken, else seconds until they are
+        # available
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / rate
+
+
+class RateLimiter:
+    def __init__(self, rate: float, burst: float, max_users: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        # A bucket left alone this long has refilled completely, so dropping
+        # it is indistinguishable from keeping it
+        self.idle_seconds = burst / rate
+        # key -> bucket, least recently used first
+        self._buckets = OrderedDict()
+        self.evictions = 0
+
+    def take(self, key: str, now: float, cost: float = 1):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+        else:
+            self._buckets.move_to_end(key)
+        wait = bucket.take(self.rate, self.burst, now, cost)
+        self._evict(now)
+        return wait
+
+    def _evict(self, now: float):
+        # Amortised O(1): each bucket is popped at most once after its last use
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if (
+                len(self._buckets) <= self.max_users
+                and now - bucket.updated < self.idle_seconds
+            ):
+                break
+            del self._buckets[key]
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class WriteGate:
+    # Bounded concurrency for database writes. Requests beyond the limit wait
+    # in a bounded queue; a full queue or a long wait is answered with 429
+    # instead of piling more work onto the writer
+
+    def __init__(self, limit: int, queue_size: int, timeout: float):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    async def acquire(self):
+        if self._semaphore.locked():
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                raise _too_many("Server is busy, retry shortly", 1)
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise _too_many("Server is busy, retry shortly", 1)
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+
+class AdmissionControl:
+    def __init__(self):
+        self.users = RateLimiter(
+            ADMISSION_USER_RATE, ADMISSION_USER_BURST, ADMISSION_MAX_USERS
+        )
+        now = time.monotonic()
+        self.global_bucket = TokenBucket(ADMISSION_GLOBAL_BURST, now)
+        self.gate = WriteGate(WRITE_CONCURRENCY, WRITE_QUEUE_SIZE, WRITE_QUEUE_TIMEOUT)
+        # Posts handed to the group-commit writer only wait in its queue for
+        # one shared transaction, so a whole batch of them may be in flight
+        # at once; sized any smaller, the gate would cap the batches
+        self.batch_gate = WriteGate(
+            max(WRITE_CONCURRENCY, GROUP_COMMIT_MAX_BATCH),
+            WRITE_QUEUE_SIZE,
+            WRITE_QUEUE_TIMEOUT,
+        )
+        self.admitted = 0
+        self.limited_user = 0
+        self.limited_global = 0
+
+    def check_rate(self, key: str, cost: int = 1):
+        # cost is the number of messages the write carries. More than a full
+        # bucket could never be admitted, so it is refused outright
+        if cost > self.users.burst:
+            raise HTTPException(
+                status_code=413,
+                detail=f"A batch can hold at most {int(self.users.burst)} messages",
+            )
+        now = time.monotonic()
+        # The user's own bucket first, so one client's flood never spends
+        # the tokens everybody else shares
+        wait = self.users.take(key, now, cost)
+        if wait:
+            self.limited_user += 1
+            raise _too_many("Too many writes, slow down", wait)
+        wait = self.global_bucket.take(
+            ADMISSION_GLOBAL_RATE, ADMISSION_GLOBAL_BURST, now, cost
+        )
+        if wait:
+            self.limited_global += 1
+            raise _too_many("Server is busy, retry shortly", wait)
+
+    def stats(self):
+        return {
+            "enabled": ADMISSION_CONTROL,
+            "tracked_users": len(self.users),
+            "user_bucket_evictions": self.users.evictions,
+            "admitted": self.admitted,
+            "limited_user": self.limited_user,
+            "limited_global": self.limited_global,
+            "writes_active": self.gate.active,
+            "writes_waiting": self.gate.waiting,
+            "writes_rejected": self.gate.rejected + self.batch_gate.rejected,
+            "write_concurrency": self.gate.limit,
+            "batched_writes_active": self.batch_gate.active,
+            "batched_writes_waiting": self.batch_gate.waiting,
+            "batched_write_concurrency": self.batch_gate.limit,
+        }
+
+
+admission = AdmissionControl()
+
+
+def _client_key(request: Request, user_id: Optional[str]):
+    # Signed-in user, else the peer address. Nothing from the request body:
+    # a sender_id there is whatever the caller chose to write
+    if user_id is not None:
+        return f"user:{user_id}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+@asynccontextmanager
+async def _admitted(
+    request: Request, user_id: Optional[str], gate: WriteGate, cost: int = 1
+):
+    if not ADMISSION_CONTROL:
+        yield
+        return
+
+    admission.check_rate(_client_key(request, user_id), cost)
+    await gate.acquire()
+    admission.admitted += 1
+    try:
+        yield
+    finally:
+        gate.release()
+
+
+async def admit_write(
+    request: Request, user_id: Optional[str] = Depends(current_user_id)
+):
+    # Dependency for write routes: rate limits, then holds a write slot until
+    # the response has been produced
+    async with _admitted(request, user_id, admission.gate):
+        yield
+
+
+async def admit_message_write(
+    request: Request, user_id: Optional[str] = Depends(current_user_id)
+):
+    # admit_write for POST /messages/{room_id}, which goes through the
+    # group-commit writer while it runs
+    gate = admission.batch_gate if group_writer.running else admission.gate
+    async with _admitted(request, user_id, gate):
+        yield
+
+
+async def admit_batch_write(
+    request: Request, user_id: Optional[str] = Depends(current_user_id)
+):
+    # admit_write for POST /messages/{room_id}/batch, charged one token per
+    # message. FastAPI has already read the body, so this is its cached copy;
+    # one that is not a list fails validation after the dependencies run
+    messages = await request.json()
+    cost = max(1, len(messages)) if isinstance(messages, list) else 1
+    async with _admitted(request, user_id, admission.gate, cost):
+        yield
@@ -0,0 +1,448 @@
+# archive.py
+#
+# Cold tier for old messages. Messages older than ARCHIVE_AFTER_DAYS are
+# moved out of the messages table into per-room, append-only segment files:
+#
+#   <ARCHIVE_DIR>/<ab>/<room key hex>.seg   zlib-compressed JSON blocks
+#   <ARCHIVE_DIR>/<ab>/<room key hex>.idx   one fixed-size record per block
+#
+# A block holds up to ARCHIVE_BLOCK_MESSAGES consecutive messages of a room
+# in history order. Blocks are only ever appended, data before index, so a
+# reader that sees an index record always finds the whole block behind it;
+# a crash in between leaves unreferenced bytes at the end of the segment.
+# Segments are read through mmap and decoded blocks are kept in a small LRU.
+#
+# Everything archived for a room is older than everything still in the
+# table, so the two tiers concatenate in history order. Archived messages
+# are read-only and not searchable; their ids stay behind in the
+# archived_messages table, so they still count towards their sender and
+# changing one is refused rather than answered with "not found".
+#
+# The same run trims change_log, which holds a copy of every message: changes
+# older than CHANGE_LOG_RETENTION_DAYS and changes about archived messages
+# go. Membership changes and each room's newest change stay, as room-list
+# ETags and room versions are read from them. A sync from before what was
+# pruned is told to start over.
+#
+#   python -m app.archive --older-than-days 90
+import argparse
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from sqlalchemy import (
+    and_,
+    delete,
+    distinct,
+    func,
+    insert,
+    or_,
+    select,
+    text,
+    tuple_,
+    update,
+)
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import aliased
+
+from app.cache import LRUCache
+from app.database import DATABASE_URL, init_db, shard_engines
+from app.models.models import (
+    MEMBERSHIP_CHANGES,
+    ArchivedMessage,
+    Change,
+    ChangeLogHorizon,
+    Message,
+    format_time,
+    key_from_bytes,
+    key_to_bytes,
+    message_time,
+)
+
+
+def _default_directory():
+    # Next to the SQLite file it belongs to, so every database has its own
+    database = make_url(DATABASE_URL).database
+    if database and database != ":memory:":
+        return os.path.splitext(database)[0] + "-archive"
+    return "./archive"
+
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR") or _default_directory()
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", default=90))
+ARCHIVE_BLOCK_MESSAGES = int(os.getenv("ARCHIVE_BLOCK_MESSAGES", default=256))
+ARCHIVE_COMPRESSION_LEVEL = int(os.getenv("ARCHIVE_COMPRESSION_LEVEL", default=6))
+# How far back /sync can resume from
+CHANGE_LOG_RETENTION_DAYS = float(
+    os.getenv("CHANGE_LOG_RETENTION_DAYS", default=30)
+)
+
+# Segments kept mapped, and decoded blocks kept in memory
+ARCHIVE_OPEN_SEGMENTS = int(os.getenv("ARCHIVE_OPEN_SEGMENTS", default=64))
+ARCHIVE_BLOCK_CACHE = int(os.getenv("ARCHIVE_BLOCK_CACHE", default=512))
+
+# first time, first id, last time, last id, offset, length, message count
+_RECORD = struct.Struct("<q16sq16sQII")
+
+
+class _Index:
+    __slots__ = (
+        "size", "firsts", "lasts", "offsets", "lengths", "starts", "count"
+    )
+
+    def __init__(self, data: bytes):
+        self.size = len(data)
+        self.firsts, self.lasts = [], []
+        self.offsets, self.lengths = [], []
+        # starts[i] is the number of messages archived before block i
+        self.starts = []
+        self.count = 0
+        # A torn trailing record from an interrupted append is ignored
+        whole = len(data) - len(data) % _RECORD.size
+        for record in _RECORD.iter_unpack(data[:whole]):
+            first_time, first_id, last_time, last_id, offset, length, count = record
+            self.firsts.append((first_time, key_from_bytes(first_id)))
+            self.lasts.append((last_time, key_from_bytes(last_id)))
+            self.offsets.append(offset)
+            self.lengths.append(length)
+            self.starts.append(self.count)
+            self.count += count
+
+
+class MessageArchive:
+    def __init__(self, directory: str, block_cache: int, open_segments: int):
+        self.directory = directory
+        self.open_segments = open_segments
+        self._lock = threading.Lock()
+        self._indexes = {}
+        # room id -> (mmap, mapped length), least recently used first
+        self._segments = OrderedDict()
+        self._blocks = LRUCache(block_cache, ttl=float("inf"))
+        self.blocks_read = 0
+
+    def _path(self, room_id: str, suffix: str):
+        name = key_to_bytes(room_id).hex()
+        return os.path.join(self.directory, name[:2], name + suffix)
+
+    def _index(self, room_id: str):
+        # Re-read only when the index file has grown since it was parsed
+        path = self._path(room_id, ".idx")
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return None
+        index = self._indexes.get(room_id)
+        if index is None or index.size != size:
+            with open(path, "rb") as f:
+                index = _Index(f.read(size))
+            with self._lock:
+                self._indexes[room_id] = index
+        return index if index.count else None
+
+    def count(self, room_id: str):
+        index = self._index(room_id)
+        return index.count if index is not None else 0
+
+    def newest(self, room_id: str):
+        # (time, id) of the newest archived message, or None
+        index = self._index(room_id)
+        return index.lasts[-1] if index is not None else None
+
+    def _segment(self, room_id: str, end: int):
+        with self._lock:
+            entry = self._segments.get(room_id)
+            if entry is not None and entry[1] >= end:
+                self._segments.move_to_end(room_id)
+                return entry[0]
+
+        # Not mapped yet, or mapped before the block was appended
+        with open(self._path(room_id, ".seg"), "rb") as f:
+            segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with self._lock:
+            # Older mappings are left to the garbage collector rather than
+            # closed, in case another thread is still slicing them
+            self._segments[room_id] = (segment, len(segment))
+            self._segments.move_to_end(room_id)
+            while len(self._segments) > self.open_segments:
+                self._segments.popitem(last=False)
+        return segment
+
+    def _block(self, room_id: str, index: _Index, number: int):
+        # (keys, messages) of one block, oldest first
+        offset, length = index.offsets[number], index.lengths[number]
+        cached = self._blocks.get((room_id, offset))
+        if cached is not None:
+            return cached
+
+        segment = self._segment(room_id, offset + length)
+        rows = json.loads(zlib.decompress(segment[offset : offset + length]))
+        keys = [(row[4], row[0]) for row in rows]
+        messages = [
+            {
+                "id": message_id,
+                "sender_id": sender_id,
+                "username": username,
+                "content": content,
+                "time": format_time(micros),
+                "room_id": room_id,
+            }
+            for message_id, sender_id, username, content, micros in rows
+        ]
+        self.blocks_read += 1
+        self._blocks.set((room_id, offset), (keys, messages))
+        return keys, messages
+
+    def read_range(self, room_id: str, skip: int, limit: int):
+        # Oldest first, like offset paging over the table
+        index = self._index(room_id)
+        if index is None or skip >= index.count or limit <= 0:
+            return []
+        number = bisect.bisect_right(index.starts, skip) - 1
+        position = skip - index.starts[number]
+        messages = []
+        while number < len(index.offsets) and len(messages) < limit:
+            _, block = self._block(room_id, index, number)
+            messages.extend(block[position : position + limit - len(messages)])
+            number += 1
+            position = 0
+        return messages
+
+    def read_before(self, room_id: str, position, limit: int):
+        # Newest first, strictly before position (time, id); None starts at
+        # the newest archived message
+        index = self._index(room_id)
+        if index is None or limit <= 0:
+            return []
+        if position is None:
+            number = len(index.firsts) - 1
+        else:
+            number = bisect.bisect_left(index.firsts, position) - 1
+        messages = []
+        while number >= 0 and len(messages) < limit:
+            keys, block = self._block(room_id, index, number)
+            end = len(keys)
+            if position is not None:
+                end = bisect.bisect_left(keys, position)
+            start = max(0, end - (limit - len(messages)))
+            messages.extend(reversed(block[start:end]))
+            number -= 1
+            position = None
+        return messages
+
+    def read_after(self, room_id: str, position, limit: int):
+        # Oldest first, strictly after position (time, id)
+        index = self._index(room_id)
+        if index is None or limit <= 0:
+            return []
+        number = bisect.bisect_right(index.lasts, position)
+        messages = []
+        while number < len(index.offsets) and len(messages) < limit:
+            keys, block = self._block(room_id, index, number)
+            start = bisect.bisect_right(keys, position) if position else 0
+            messages.extend(block[start : start + limit - len(messages)])
+            number += 1
+            position = None
+        return messages
+
+    def append(self, room_id: str, rows):
+        # rows: consecutive messages of one room in history order, newer
+        # than everything archived for it so far, with integer times
+        data = zlib.compress(
+            json.dumps(
+                [
+                    [row["id"], row["sender_id"], row["username"], row["content"]]
+                    + [row["time"]]
+                    for row in rows
+                ],
+                separators=(",", ":"),
+            ).encode(),
+            ARCHIVE_COMPRESSION_LEVEL,
+        )
+        segment_path = self._path(room_id, ".seg")
+        os.makedirs(os.path.dirname(segment_path), exist_ok=True)
+        with open(segment_path, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        first, last = rows[0], rows[-1]
+        record = _RECORD.pack(
+            first["time"],
+            key_to_bytes(first["id"]),
+            last["time"],
+            key_to_bytes(last["id"]),
+            offset,
+            len(data),
+            len(rows),
+        )
+        with open(self._path(room_id, ".idx"), "ab") as f:
+            # Drop a torn record left by an interrupted append, or every
+            # record after it would be misaligned
+            torn = f.tell() % _RECORD.size
+            if torn:
+                f.truncate(f.tell() - torn)
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        return len(data)
+
+    def stats(self):
+        with self._lock:
+            segments = len(self._segments)
+        stats = {"open_segments": segments, "blocks_read": self.blocks_read}
+        for key, value in self._blocks.stats().items():
+            stats[f"block_cache_{key}"] = value
+        return stats
+
+
+message_archive = MessageArchive(
+    ARCHIVE_DIR, ARCHIVE_BLOCK_CACHE, ARCHIVE_OPEN_SEGMENTS
+)
+
+
+def _remove_archived(connection, condition):
+    # Deletes archived rows from the table, leaving their ids behind. OR
+    # IGNORE since a run after a crash may find ids it already recorded
+    ids = select(Message.id, Message.room_id, Message.sender_id).where(condition)
+    connection.execute(
+        insert(ArchivedMessage)
+        .prefix_with("OR IGNORE")
+        .from_select(["id", "room_id", "sender_id"], ids)
+    )
+    connection.execute(delete(Message).where(condition))
+
+
+def _archive_room(engine, room_id: str, cutoff: int, block_messages: int):
+    archived = 0
+    stored_bytes = 0
+    while True:
+        # One block per transaction, so the write lock is only held briefly.
+        # The block is on disk before its rows are deleted: after a crash in
+        # between they are in both tiers, and the next run deletes them here
+        with engine.begin() as connection:
+            newest = message_archive.newest(room_id)
+            if newest is not None:
+                position = tuple_(Message.time, Message.id)
+                bound = tuple_(*newest, types=(Message.time.type, Message.id.type))
+                _remove_archived(
+                    connection, (Message.room_id == room_id) & (position <= bound)
+                )
+
+            query = select(
+                Message.id,
+                Message.sender_id,
+                Message.username,
+                Message.content,
+                Message.time,
+            ).where(Message.room_id == room_id, Message.time < cutoff)
+            rows = [
+                row._asdict()
+                for row in connection.execute(
+                    query.order_by(Message.time, Message.id).limit(block_messages)
+                )
+            ]
+            if not rows:
+                return archived, stored_bytes
+
+            stored_bytes += message_archive.append(room_id, rows)
+            _remove_archived(
+                connection, Message.id.in_([row["id"] for row in rows])
+            )
+        archived += len(rows)
+
+
+def archive_messages(engine, older_than_days: float, block_messages: int):
+    cutoff = message_time() - int(older_than_days * 86400 * 1_000_000)
+    with engine.connect() as connection:
+        # A range over ix_messages_time_id
+        rooms = connection.execute(
+            select(distinct(Message.room_id)).where(Message.time < cutoff)
+        ).scalars().all()
+
+    report = {"rooms": 0, "messages": 0, "compressed_bytes": 0}
+    for room_id in rooms:
+        archived, stored_bytes = _archive_room(
+            engine, room_id, cutoff, block_messages
+        )
+        report["rooms"] += 1
+        report["messages"] += archived
+        report["compressed_bytes"] += stored_bytes
+    return report
+
+
+def prune_change_log(engine, older_than_days: float):
+    cutoff = message_time() - int(older_than_days * 86400 * 1_000_000)
+    later = aliased(Change)
+    with engine.begin() as connection:
+        # Sequence numbers grow with time, so every change before the first
+        # recent one is old
+        boundary = connection.scalar(
+            select(func.min(Change.seq)).where(Change.time >= cutoff)
+        )
+        if boundary is None:
+            boundary = (connection.scalar(select(func.max(Change.seq))) or 0) + 1
+
+        condition = and_(
+            or_(
+                Change.seq < boundary,
+                Change.entity_id.in_(select(ArchivedMessage.id)),
+            ),
+            text(f"NOT ({MEMBERSHIP_CHANGES})"),
+            # A room's newest change is its version, so only changes with a
+            # later one in their room go. A seek on ix_change_log_room_id_seq
+            select(later.seq)
+            .where(later.room_id == Change.room_id, later.seq > Change.seq)
+            .exists(),
+        )
+        pruned_through = connection.scalar(
+            select(func.max(Change.seq)).where(condition)
+        )
+        if pruned_through is None:
+            return 0
+        pruned = connection.execute(delete(Change).where(condition)).rowcount
+
+        horizon = connection.scalar(
+            select(ChangeLogHorizon.pruned_through).where(ChangeLogHorizon.id == 1)
+        )
+        if horizon is None:
+            connection.execute(
+                insert(ChangeLogHorizon).values(id=1, pruned_through=pruned_through)
+            )
+        elif horizon < pruned_through:
+            connection.execute(
+                update(ChangeLogHorizon).values(pruned_through=pruned_through)
+            )
+    return pruned
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--older-than-days", type=float, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--block-messages", type=int, default=ARCHIVE_BLOCK_MESSAGES)
+    parser.add_argument(
+        "--retain-changes-days", type=float, default=CHANGE_LOG_RETENTION_DAYS
+    )
+    args = parser.parse_args()
+
+    init_db()
+    started = time.monotonic()
+    report = {"rooms": 0, "messages": 0, "compressed_bytes": 0, "changes_pruned": 0}
+    for shard_engine in shard_engines:
+        shard_report = archive_messages(
+            shard_engine, args.older_than_days, args.block_messages
+        )
+        for key, value in shard_report.items():
+            report[key] += value
+        report["changes_pruned"] += prune_change_log(
+            shard_engine, args.retain_changes_days
+        )
+    report["seconds"] = round(time.monotonic() - started, 3)
+    report.update(database=DATABASE_URL, archive=ARCHIVE_DIR)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,291 @@
+# auth.py
+import asyncio
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from fastapi import Request
+from fastapi.exceptions import HTTPException
+from sqlalchemy.engine import make_url
+
+from app.cache import LRUCache
+from app.database import DATABASE_URL
+
+# Write routes require a bearer token. REQUIRE_AUTH=false opts into the old
+# anonymous mode, where a request without one may act for anybody
+REQUIRE_AUTH = os.getenv("REQUIRE_AUTH", default="true").lower() in ("1", "true")
+
+
+def _default_secret_file():
+    # Next to the SQLite file, so every worker serving it finds the same one
+    database = make_url(DATABASE_URL).database
+    if database and database != ":memory:":
+        return os.path.splitext(database)[0] + "-auth-secret"
+    return None
+
+
+def _load_secret(path: str):
+    # The first process to get here creates the file; the rest read it. The
+    # secret is written out in full before it is linked into place, so no
+    # process ever reads a partial one
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(descriptor, "wb") as f:
+            f.write(secrets.token_bytes(32))
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(temporary, path)
+        except FileExistsError:
+            pass
+    finally:
+        os.unlink(temporary)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# Tokens are only valid on workers sharing the secret. Without AUTH_SECRET
+# it is kept in AUTH_SECRET_FILE, which also keeps tokens valid across
+# restarts; an in-memory database leaves a per-process secret
+AUTH_SECRET_FILE = os.getenv("AUTH_SECRET_FILE") or _default_secret_file()
+AUTH_SECRET = os.getenv("AUTH_SECRET", default="").encode() or (
+    _load_secret(AUTH_SECRET_FILE) if AUTH_SECRET_FILE else secrets.token_bytes(32)
+)
+AUTH_TOKEN_TTL = int(os.getenv("AUTH_TOKEN_TTL", default=24 * 60 * 60))
+
+# scrypt cost; 2**14 with r=8 takes ~50 ms and 16 MiB per hash
+AUTH_SCRYPT_N = int(os.getenv("AUTH_SCRYPT_N", default=2**14))
+AUTH_SCRYPT_R = int(os.getenv("AUTH_SCRYPT_R", default=8))
+AUTH_SCRYPT_P = int(os.getenv("AUTH_SCRYPT_P", default=1))
+
+# Hashing runs in its own processes so it never holds the GIL the event loop
+# and the threadpool need. Beyond AUTH_HASH_MAX_PENDING queued hashes,
+# sign-ups and sign-ins are turned away instead of queueing without bound
+AUTH_HASH_WORKERS = int(
+    os.getenv("AUTH_HASH_WORKERS", default=min(4, os.cpu_count() or 1))
+)
+AUTH_HASH_MAX_PENDING = int(os.getenv("AUTH_HASH_MAX_PENDING", default=64))
+
+# token -> (user id, expiry) for tokens whose signature was already checked
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", default=10000))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", default=300))
+
+_SCHEME = "scrypt"
+
+
+def _b64encode(data: bytes):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int):
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024**2
+    )
+
+
+def _hash(password: str, n: int, r: int, p: int):
+    # Runs in a pool process
+    salt = secrets.token_bytes(16)
+    digest = _scrypt(password, salt, n, r, p)
+    return f"{_SCHEME}${n}${r}${p}${_b64encode(salt)}${_b64encode(digest)}"
+
+
+def _verify(password: str, stored: str):
+    # Runs in a pool process
+    _, n, r, p, salt, digest = stored.split("$")
+    candidate = _scrypt(password, _b64decode(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(candidate, _b64decode(digest))
+
+
+def is_hashed(stored: str):
+    return stored.startswith(_SCHEME + "$")
+
+
+def needs_rehash(stored: str):
+    # Plaintext from before hashing, or hashed with older cost parameters
+    current = f"{_SCHEME}${AUTH_SCRYPT_N}${AUTH_SCRYPT_R}${AUTH_SCRYPT_P}$"
+    return not stored.startswith(current)
+
+
+class PasswordHasher:
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pool = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.hashes = 0
+        self.verifications = 0
+        self.rejected = 0
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # forkserver children start from a clean interpreter rather
+                # than a copy of this process and its threads and connections
+                methods = multiprocessing.get_all_start_methods()
+                method = "forkserver" if "forkserver" in methods else "spawn"
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(method),
+                )
+            return self._pool
+
+    async def _run(self, fn, *args):
+        if self._pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Too many sign-ins in progress, retry shortly",
+                headers={"Retry-After": "1"},
+            )
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor(), fn, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password: str):
+        self.hashes += 1
+        return await self._run(
+            _hash, password, AUTH_SCRYPT_N, AUTH_SCRYPT_R, AUTH_SCRYPT_P
+        )
+
+    async def verify(self, password: str, stored: str):
+        self.verifications += 1
+        if not is_hashed(stored):
+            # Accounts created before hashing; upgraded on their next sign-in
+            return hmac.compare_digest(password.encode(), stored.encode())
+        return await self._run(_verify, password, stored)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True, cancel_futures=True)
+                self._pool = None
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "pending": self._pending,
+            "max_pending": self.max_pending,
+            "hashes": self.hashes,
+            "verifications": self.verifications,
+            "rejected": self.rejected,
+        }
+
+
+password_hasher = PasswordHasher(AUTH_HASH_WORKERS, AUTH_HASH_MAX_PENDING)
+
+session_cache = LRUCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+
+def _sign(payload: bytes):
+    return hmac.new(AUTH_SECRET, payload, hashlib.sha256).digest()
+
+
+def issue_token(user_id: str):
+    expires = int(time.time()) + AUTH_TOKEN_TTL
+    payload = f"{user_id}.{expires}".encode()
+    token = f"{_b64encode(payload)}.{_b64encode(_sign(payload))}"
+    session_cache.set(token, (user_id, expires))
+    return token, expires
+
+
+def verify_token(token: str) -> Optional[str]:
+    # Returns the user id, or None for a bad or expired token. Known tokens
+    # are answered from the session cache without recomputing the HMAC
+    session = session_cache.get(token)
+    if session is None:
+        try:
+            encoded_payload, encoded_signature = token.split(".")
+            payload = _b64decode(encoded_payload)
+            signature = _b64decode(encoded_signature)
+            user_id, expires = payload.decode().rsplit(".", 1)
+            session = (user_id, int(expires))
+        except ValueError:
+            return None
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        session_cache.set(token, session)
+
+    user_id, expires = session
+    if expires <= time.time():
+        session_cache.invalidate(token)
+        return None
+    return user_id
+
+
+async def current_user_id(request: Request) -> Optional[str]:
+    # Dependency for routes acting on behalf of a user. A missing token is a
+    # 401 unless REQUIRE_AUTH is off, then it yields None; a bad one is
+    # always a 401.
+    # async so FastAPI calls it inline instead of through the threadpool
+    authorization = request.headers.get("authorization")
+    if not authorization:
+        if REQUIRE_AUTH:
+            raise HTTPException(
+                status_code=401,
+                detail="Not authenticated",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        return None
+
+    scheme, _, token = authorization.partition(" ")
+    user_id = verify_token(token.strip()) if scheme.lower() == "bearer" else None
+    if user_id is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid or expired token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return user_id
+
+
+def ensure_sender(user_id: Optional[str], sender_ids):
+    # An authenticated caller may only post as themselves
+    if user_id is not None and any(sender != user_id for sender in sender_ids):
+        raise HTTPException(
+            status_code=403, detail="sender_id does not match the signed-in user"
+        )
+
+
+def ensure_self(user_id: Optional[str], target_user_id: str):
+    # An authenticated caller may only change their own state
+    if user_id is not None and user_id != target_user_id:
+        raise HTTPException(
+            status_code=403, detail="user_id does not match the signed-in user"
+        )
+
+
+async def ensure_user_scope(request: Request, user_id: Optional[str] = None):
+    # Dependency for reads with an optional user_id: narrowing one to a user
+    # takes being signed in as that user, as ensure_self does for writes
+    if user_id is not None:
+        ensure_self(await current_user_id(request), user_id)
+
+
+def auth_stats():
+    stats = password_hasher.stats()
+    for key, value in session_cache.stats().items():
+        stats[f"session_cache_{key}"] = value
+    return stats
@@ -0,0 +1,171 @@
+# broker.py
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import func, select
+
+from app.cache import room_cache
+from app.database import shard_for
+from app.hub import hub
+from app.models.models import Change
+
+# "local" delivers events to websockets on this process only. "sqlite" also
+# tails the change log, so events committed by other workers (gunicorn or
+# uvicorn --workers) reach this worker's subscribers too
+BROKER = os.getenv("BROKER", default="local").lower()
+BROKER_POLL_INTERVAL_MS = float(os.getenv("BROKER_POLL_INTERVAL_MS", default=20))
+BROKER_BATCH_SIZE = int(os.getenv("BROKER_BATCH_SIZE", default=1000))
+
+# Seqs remembered as already delivered here, so an event is never sent twice
+# whether the tail or the committing request reaches it first
+BROKER_DEDUPE_SIZE = int(os.getenv("BROKER_DEDUPE_SIZE", default=10000))
+
+log = logging.getLogger("app.broker")
+
+
+class LocalBroker:
+    def start(self, engines, event_factory):
+        pass
+
+    def stop(self):
+        pass
+
+    def publish(self, events):
+        # Called after the commit; safe from the threadpool
+        for event in events:
+            hub.publish(event["room_id"], event)
+
+    def stats(self):
+        return {"backend": "local"}
+
+
+class SQLiteBroker(LocalBroker):
+    # Every committed change is already in change_log, and seqs commit in
+    # order because writers hold SQLite's write lock, so each worker polls it
+    # past the last seq it has seen. Events this worker committed
+    # itself go out immediately and are skipped by the tail. Under sharding
+    # every shard has a change log of its own, numbered separately
+
+    def __init__(self, poll_interval_ms: float, batch_size: int, dedupe_size: int):
+        self.poll_interval = poll_interval_ms / 1000
+        self.batch_size = batch_size
+        self.dedupe_size = dedupe_size
+        self._delivered = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._engines = []
+        self._event_factory = None
+        # Per shard
+        self.last_seqs = []
+        self.published = 0
+        self.remote = 0
+        self.polls = 0
+        self.errors = 0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, engines, event_factory):
+        if self.running:
+            return
+        self._engines = engines
+        self._event_factory = event_factory
+        self.last_seqs = []
+        for engine in engines:
+            with engine.connect() as connection:
+                # Only changes committed from now on; older ones are served
+                # by /sync
+                self.last_seqs.append(
+                    connection.scalar(select(func.max(Change.seq))) or 0
+                )
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="change-log-broker", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def _claim(self, shard: int, seq: int):
+        # True for whichever of the request and the tail gets here first
+        with self._lock:
+            if (shard, seq) in self._delivered:
+                return False
+            self._delivered[shard, seq] = None
+            while len(self._delivered) > self.dedupe_size:
+                self._delivered.popitem(last=False)
+            return True
+
+    def publish(self, events):
+        for event in events:
+            if self._claim(shard_for(event["room_id"]), event["seq"]):
+                self.published += 1
+                hub.publish(event["room_id"], event)
+
+    def _run(self):
+        while not self._stopping.wait(self.poll_interval):
+            try:
+                for shard in range(len(self._engines)):
+                    while self._poll(shard) == self.batch_size:
+                        pass
+            except Exception:
+                self.errors += 1
+                log.exception("polling the change log failed")
+
+    def _poll(self, shard: int):
+        with self._engines[shard].connect() as connection:
+            rows = connection.execute(
+                select(Change.seq, Change.room_id, Change.kind, Change.payload)
+                .where(Change.seq > self.last_seqs[shard])
+                .order_by(Change.seq)
+                .limit(self.batch_size)
+            ).all()
+        self.polls += 1
+
+        for seq, room_id, kind, payload in rows:
+            self.last_seqs[shard] = seq
+            if not self._claim(shard, seq):
+                continue
+            # Committed by another worker: this worker's cached page of the
+            # room is missing it. The placeholder keeps the seq so a reader
+            # that saw the database before this change cannot refill it
+            room_cache.expire(room_id, seq)
+            self.remote += 1
+            event = self._event_factory(seq, room_id, kind, json.loads(payload))
+            hub.publish(room_id, event)
+        return len(rows)
+
+    def stats(self):
+        return {
+            "backend": "sqlite",
+            "running": self.running,
+            # Summed over shards, so it keeps growing like a single seq
+            "last_seq": sum(self.last_seqs),
+            "published_local": self.published,
+            "delivered_remote": self.remote,
+            "polls": self.polls,
+            "errors": self.errors,
+        }
+
+
+def _create_broker():
+    if BROKER == "local":
+        return LocalBroker()
+    if BROKER == "sqlite":
+        return SQLiteBroker(
+            BROKER_POLL_INTERVAL_MS, BROKER_BATCH_SIZE, BROKER_DEDUPE_SIZE
+        )
+    raise ValueError(f"Unknown BROKER {BROKER!r}, expected 'local' or 'sqlite'")
+
+
+broker = _create_broker()
@@ -0,0 +1,281 @@
+# cache.py
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+from app.models.models import User
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", default=10000))
+# Bounds how long another worker's change to a user can go unnoticed
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", default=300))
+
+_MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# user id -> {"id", "username", "email"} for sender lookups
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_user(mapper, connection, target):
+    user_cache.invalidate(target.id)
+
+
+ROOM_CACHE_MESSAGES = int(os.getenv("ROOM_CACHE_MESSAGES", default=100))
+ROOM_CACHE_MAX_BYTES = int(os.getenv("ROOM_CACHE_MAX_BYTES", default=64 * 1024 * 1024))
+# Bounds how long another worker's writes to a room can go unnoticed
+ROOM_CACHE_TTL = float(os.getenv("ROOM_CACHE_TTL", default=10))
+
+
+def _message_size(message):
+    return sys.getsizeof(message) + sum(
+        sys.getsizeof(value) for value in message.values()
+    )
+
+
+def _newest_first(message):
+    return (message["time"], message["id"])
+
+
+class _RoomPage:
+    __slots__ = ("messages", "seq", "complete", "size", "expires")
+
+    def __init__(self, messages, seq, complete, ttl):
+        # messages is None for a placeholder that only remembers the newest
+        # change seen for a room nobody has read yet
+        self.messages = messages
+        self.seq = seq
+        self.complete = complete
+        self.size = sum(map(_message_size, messages)) if messages else 0
+        self.expires = time.monotonic() + ttl
+
+
+class RoomPageCache:
+    # The newest messages of each room, newest first, with LRU eviction
+    # across rooms once the estimated size passes max_bytes.
+    #
+    # Writers apply their change events before committing, while they hold
+    # SQLite's write lock, so events arrive in sequence order and `seq` is
+    # the room's version as of the last applied change. A fill carries the
+    # version it was read at and is dropped if a newer change has already
+    # been seen, so a page read just before a write is never cached.
+
+    def __init__(self, max_messages: int, max_bytes: int, ttl: float):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._rooms = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._messages = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _fresh(self, room_id):
+        page = self._rooms.get(room_id)
+        if page is None or page.messages is None:
+            return None
+        if page.expires <= time.monotonic():
+            self._remove(room_id)
+            return None
+        return page
+
+    def page(self, room_id, limit: int):
+        # Returns (messages, has_more) for the newest `limit` messages, or
+        # None when the cache cannot answer for this room and limit
+        with self._lock:
+            page = self._fresh(room_id)
+            if page is None or (limit > len(page.messages) and not page.complete):
+                self.misses += 1
+                return None
+            self._rooms.move_to_end(room_id)
+            self.hits += 1
+            has_more = len(page.messages) > limit or not page.complete
+            return page.messages[:limit], has_more
+
+    def whole_room(self, room_id):
+        # Every message of a room small enough to be held entirely
+        with self._lock:
+            page = self._fresh(room_id)
+            if page is None or not page.complete:
+                self.misses += 1
+                return None
+            self._rooms.move_to_end(room_id)
+            self.hits += 1
+            return page.messages
+
+    def version(self, room_id):
+        with self._lock:
+            page = self._fresh(room_id)
+            return page.seq if page is not None else None
+
+    def fill(self, room_id, seq: int, messages, complete: bool):
+        with self._lock:
+            current = self._rooms.get(room_id)
+            if current is not None and current.seq > seq:
+                return
+            self._store(room_id, _RoomPage(messages, seq, complete, self.ttl))
+
+    def apply(self, events):
+        with self._lock:
+            for event in events:
+                if "message" in event:
+                    self._apply(event)
+
+    def _apply(self, event):
+        room_id = event["room_id"]
+        page = self._rooms.get(room_id)
+        if page is None or page.messages is None:
+            self._store(room_id, _RoomPage(None, event["seq"], False, self.ttl))
+            return
+
+        # Pages handed out earlier stay untouched; each change builds a new list
+        messages = list(page.messages)
+        added, removed = [], []
+        message = event["message"]
+        if event["type"] == "message.created":
+            key = _newest_first(message)
+            position = 0
+            while position < len(messages) and _newest_first(messages[position]) > key:
+                position += 1
+            messages.insert(position, message)
+            added.append(message)
+            if len(messages) > self.max_messages:
+                removed.append(messages.pop())
+                page.complete = False
+        else:
+            for position, cached in enumerate(messages):
+                if cached["id"] == message["id"]:
+                    removed.append(cached)
+                    if event["type"] == "message.deleted":
+                        del messages[position]
+                    else:
+                        messages[position] = message
+                        added.append(message)
+                    break
+
+        size = sum(map(_message_size, added)) - sum(map(_message_size, removed))
+        page.messages = messages
+        page.seq = event["seq"]
+        page.size += size
+        self._bytes += size
+        self._messages += len(added) - len(removed)
+        self._rooms.move_to_end(room_id)
+        self._evict()
+
+    def _store(self, room_id, page):
+        self._remove(room_id)
+        self._rooms[room_id] = page
+        self._bytes += page.size
+        self._messages += len(page.messages or ())
+        self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._rooms:
+            self._remove(next(iter(self._rooms)))
+            self.evictions += 1
+
+    def _remove(self, room_id):
+        page = self._rooms.pop(room_id, None)
+        if page is not None:
+            self._bytes -= page.size
+            self._messages -= len(page.messages or ())
+
+    def invalidate(self, room_id):
+        with self._lock:
+            self._remove(room_id)
+
+    def expire(self, room_id, seq: int):
+        # For changes this process did not apply: the room is dropped, but
+        # fills read before seq are still refused
+        with self._lock:
+            current = self._rooms.get(room_id)
+            if current is not None:
+                seq = max(seq, current.seq)
+            self._store(room_id, _RoomPage(None, seq, False, self.ttl))
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._bytes = 0
+            self._messages = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "rooms": len(self._rooms),
+                "messages": self._messages,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "max_messages_per_room": self.max_messages,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# room id -> newest ROOM_CACHE_MESSAGES messages, for the first history page
+room_cache = RoomPageCache(ROOM_CACHE_MESSAGES, ROOM_CACHE_MAX_BYTES, ROOM_CACHE_TTL)
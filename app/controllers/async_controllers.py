@@ -0,0 +1,222 @@
+# async_controllers.py
+import asyncio
+import itertools
+import uuid
+from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi.exceptions import HTTPException
+from app.controllers import controllers
+from app.controllers.controllers import (
+    _check_page,
+    _gather_messages,
+    _membership_version_query,
+    _messages_response,
+    _newest_rooms,
+    _scattered_messages_query,
+    _cached_latest_page,
+    _archived_slice,
+    _cached_room_slice,
+    _fill_latest_page,
+    _fill_room_window,
+    _latest_page_cacheable,
+    _room_cursor_query,
+    _room_cursor_response,
+    _room_page_query,
+    _room_version_query,
+    _rooms_response,
+    _user_rooms_queries,
+    _with_archived,
+    _cached_identities,
+    _inbox_query,
+    _inbox_response,
+    _identities_query,
+    _remember_identities,
+    _message_to_dict,
+)
+from app.cache import ROOM_CACHE_MESSAGES, room_cache
+from app.database import (
+    async_each_shard,
+    async_shard_session,
+    async_users_session,
+    shard_for,
+)
+from app.models.models import User
+from app.writer import group_writer
+from app.schema.schemas import (
+    ChatRoomCreate,
+    MessageCreate,
+    UpdateMessage,
+    UserCreate,
+)
+
+# Reads are native async queries built from the same statements as the sync
+# controllers. Writes run the sync controllers on the async session through
+# run_sync, so their side effects (hub events etc.) stay defined in one place
+# while the I/O still goes through aiosqlite instead of the threadpool.
+
+
+async def create_user(db: AsyncSession, user: UserCreate):
+    return await db.run_sync(controllers.create_user, user)
+
+
+async def read_user(db: AsyncSession, email: str):
+    result = await db.execute(select(User).where(User.email == email))
+    db_user = result.scalars().first()
+    if db_user:
+        return db_user
+    else:
+        raise HTTPException(status_code=404, detail="User not found")
+
+
+async def create_chat_room(db: AsyncSession, room: ChatRoomCreate):
+    users = (await db.execute(_identities_query(room.members))).all()
+    room_id = str(uuid.uuid4())
+    async with async_shard_session(db, shard_for(room_id)) as room_db:
+        return await room_db.run_sync(
+            controllers.insert_chat_room, room_id, room.name, users
+        )
+
+
+async def add_user_to_room(db: AsyncSession, user_id: str, room_id: str):
+    return await db.run_sync(controllers.add_user_to_room, user_id, room_id)
+
+
+async def _scatter(shards, query):
+    # The same query on every shard at once; a list of rows per shard
+    results = await asyncio.gather(*(shard_db.execute(query) for shard_db in shards))
+    return [result.all() for result in results]
+
+
+async def _identities_for(db: AsyncSession, user_ids):
+    # Resolved natively before any run_sync, so a write on a room's shard
+    # never reads users synchronously on the event loop
+    identities, missing = _cached_identities(user_ids)
+    if missing:
+        async with async_users_session(db) as users_db:
+            users = (await users_db.execute(_identities_query(missing))).all()
+        identities.update(_remember_identities(users))
+    return identities
+
+
+async def get_chat_rooms(db: AsyncSession, user_id: str):
+    rooms_query, members_query = _user_rooms_queries(user_id)
+    async with async_each_shard(db) as shards:
+        chat_rooms = itertools.chain(*await _scatter(shards, rooms_query))
+        members = list(itertools.chain(*await _scatter(shards, members_query)))
+    users = await _identities_for(db, {member.user_id for member in members})
+    return _rooms_response(chat_rooms, members, users)
+
+
+async def get_inbox(db: AsyncSession, user_id: str):
+    async with async_each_shard(db) as shards:
+        rooms = await _scatter(shards, _inbox_query(user_id))
+    return _inbox_response(_newest_rooms(rooms))
+
+
+async def mark_room_read(
+    db: AsyncSession, user_id: str, room_id: str, message_id: Optional[str] = None
+):
+    return await db.run_sync(
+        controllers.mark_room_read, user_id, room_id, message_id
+    )
+
+
+async def membership_version(db: AsyncSession, user_id: str):
+    async with async_each_shard(db) as shards:
+        versions = await _scatter(shards, _membership_version_query(user_id))
+    return sum(rows[0][0] or 0 for rows in versions)
+
+
+async def room_version(db: AsyncSession, room_id: str):
+    version = room_cache.version(room_id)
+    if version is None:
+        version = (await db.execute(_room_version_query(room_id))).scalar() or 0
+    return version
+
+
+async def create_message(db: AsyncSession, message_data: MessageCreate, room_id: str):
+    if group_writer.running:
+        return await group_writer.write(message_data, room_id)
+    sender_id = message_data.sender_id
+    sender = (await _identities_for(db, {sender_id})).get(sender_id)
+    return await db.run_sync(
+        controllers.insert_message, message_data, room_id, sender
+    )
+
+
+async def get_messages_by_room(
+    db: AsyncSession, room_id: str, skip: int = 0, limit: int = 10
+):
+    _check_page(limit, skip)
+    cached = _cached_room_slice(room_id, skip, limit)
+    if cached is not None:
+        return cached
+
+    if room_cache.version(room_id) is None:
+        version = (await db.execute(_room_version_query(room_id))).scalar() or 0
+        query = _room_cursor_query(room_id, ROOM_CACHE_MESSAGES, None, None)
+        result = await db.execute(query)
+        window = [_message_to_dict(message) for message in result.scalars()]
+        messages, complete = _fill_room_window(room_id, version, window)
+        if complete:
+            return messages[::-1][skip : skip + limit]
+
+    messages, skip, limit = _archived_slice(room_id, skip, limit)
+    if limit > 0:
+        result = await db.execute(_room_page_query(room_id, skip, limit))
+        messages += [_message_to_dict(message) for message in result.scalars()]
+    return messages
+
+
+async def get_messages_by_room_cursor(
+    db: AsyncSession,
+    room_id: str,
+    limit: int = 10,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+):
+    _check_page(limit)
+    if _latest_page_cacheable(limit, before, after):
+        cached = _cached_latest_page(room_id, limit)
+        if cached is not None:
+            return cached
+
+        version = (await db.execute(_room_version_query(room_id))).scalar() or 0
+        query = _room_cursor_query(room_id, ROOM_CACHE_MESSAGES, None, None)
+        result = await db.execute(query)
+        messages = [_message_to_dict(message) for message in result.scalars()]
+        return _fill_latest_page(room_id, version, messages, limit)
+
+    query = _room_cursor_query(room_id, limit, before, after)
+    result = await db.execute(query)
+    messages = [_message_to_dict(message) for message in result.scalars()]
+    messages = _with_archived(room_id, messages, limit, before, after)
+    return _room_cursor_response(messages, limit, after)
+
+
+async def get_messages(db: AsyncSession, skip: int = 0, limit: int = 10):
+    _check_page(limit, skip)
+    query, skip = _scattered_messages_query(skip, limit)
+    async with async_each_shard(db) as shards:
+        pages = await _scatter(shards, query)
+    messages = _gather_messages(pages, skip, limit)
+    senders = await _identities_for(db, {message.sender_id for message in messages})
+    return _messages_response(messages, senders)
+
+
+async def delete_message(
+    db: AsyncSession, message_id: str, user_id: Optional[str] = None
+):
+    return await db.run_sync(controllers.delete_message, message_id, user_id)
+
+
+async def update_message(
+    db: AsyncSession,
+    message_id: str,
+    new_message: UpdateMessage,
+    user_id: Optional[str] = None,
+):
+    return await db.run_sync(
+        controllers.update_message, message_id, new_message, user_id
+    )
@@ -1,7 +1,54 @@
 # controllers.py
+import heapq
+import itertools
+import json
+import os
+import uuid
+import zlib
+from collections import Counter
+from typing import List, Optional
 from pydantic import ValidationError
+from sqlalchemy import (
+    and_,
+    case,
+    func,
+    insert,
+    literal_column,
+    or_,
+    select,
+    text,
+    tuple_,
+    update,
+)
 from sqlalchemy.orm import Session, joinedload, contains_eager
-from app.models.models import Message, User, ChatRoom, UserChatRoom
+from app.models.models import (
+    MEMBERSHIP_CHANGES,
+    ArchivedMessage,
+    Change,
+    ChangeLogHorizon,
+    Message,
+    User,
+    ChatRoom,
+    UserChatRoom,
+    format_time,
+    message_preview,
+    message_time,
+    parse_time,
+)
+from app.archive import message_archive
+from app.cache import ROOM_CACHE_MESSAGES, room_cache, user_cache
+from app.database import (
+    SHARD_COUNT,
+    SessionLocal,
+    ShardReadSessionLocal,
+    each_shard,
+    shard_for,
+    shard_session,
+    users_session,
+)
+from app.broker import broker
+from app.pagination import decode_cursor, encode_cursor
+from app.search import match_expression, matches, messages_fts, score, snippet
 from app.schema.schemas import (
     MessageCreate,
     UpdateMessageResponse,
@@ -16,6 +63,35 @@ from sqlalchemy.exc import IntegrityError
 from fastapi.exceptions import HTTPException
 from fastapi import status
 
+# Upper bound on messages accepted by one batch request
+BATCH_MAX_MESSAGES = int(os.getenv("BATCH_MAX_MESSAGES", default=10000))
+
+# Rows fetched from the cursor, and written out, per chunk of an export
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", default=1000))
+
+# Upper bound on messages returned by one page of history, and on results
+# returned by one page of search
+PAGE_MAX_MESSAGES = int(os.getenv("PAGE_MAX_MESSAGES", default=1000))
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", default=100))
+
+# Upper bound on changes returned by one /sync call
+SYNC_MAX_CHANGES = int(os.getenv("SYNC_MAX_CHANGES", default=1000))
+
+# Newest rooms and messages shown on a profile by default, and at most
+PROFILE_RECENT = int(os.getenv("PROFILE_RECENT", default=10))
+PROFILE_MAX_RECENT = int(os.getenv("PROFILE_MAX_RECENT", default=100))
+
+
+def _check_page(limit: int, skip: int = 0, max_limit: int = PAGE_MAX_MESSAGES):
+    # SQLite reads a negative LIMIT as no limit at all, so a page size is
+    # always checked before it reaches a query
+    if not 1 <= limit <= max_limit:
+        raise HTTPException(
+            status_code=400, detail=f"limit must be between 1 and {max_limit}"
+        )
+    if skip < 0:
+        raise HTTPException(status_code=400, detail="skip must not be negative")
+
 
 def create_user(db, user):
     try:
@@ -31,6 +107,23 @@ def create_user(db, user):
         ) from e
 
 
+def read_credentials(db: Session, email: str):
+    # The stored password (hash, or plaintext from before hashing) for sign-in
+    return db.execute(
+        select(User.id, User.username, User.email, User.password).where(
+            User.email == email
+        )
+    ).first()
+
+
+def set_password(user_id: str, password_hash: str):
+    # Sign-ins read through the read engine; only the rare rehash needs a
+    # write session, and so the write lock
+    with SessionLocal() as db:
+        db.query(User).filter(User.id == user_id).update({"password": password_hash})
+        db.commit()
+
+
 def read_user(db: Session, email: str):
     db_user = db.query(User).filter(User.email == email).first()
     if db_user:
@@ -39,61 +132,205 @@ def read_user(db: Session, email: str):
         raise HTTPException(status_code=404, detail="User not found")
 
 
-def get_user(db: Session, user_email: str):
-    query = db.query(User).filter(User.email == user_email).first()
-    if query:
-        return {
-            "uuid": query.id,
-            "email": query.email,
-            "userName": query.username,
-            "rooms": query.rooms,
-            "sentMessages": query.sent_messages,
-        }
-    else:
-        raise HTTPException(status_code=404, detail="User not found")
+def _profile_queries(user_filter, recent: int):
+    # Three queries of bounded size however long the user's history: the
+    # user with both counts as scalar subqueries, then the newest rooms and
+    # the newest messages, each a seek on an index plus a LIMIT. Other
+    # shards add their counts, rooms and messages on top
+    def counts(user_id):
+        room_count = (
+            select(func.count())
+            .where(UserChatRoom.user_id == user_id)
+            .scalar_subquery()
+        )
+        # Archived messages count too, from their ids left behind
+        message_count = (
+            select(func.count())
+            .where(Message.sender_id == user_id)
+            .scalar_subquery()
+        ) + (
+            select(func.count())
+            .where(ArchivedMessage.sender_id == user_id)
+            .scalar_subquery()
+        )
+        return room_count.label("room_count"), message_count.label("message_count")
 
+    user_query = select(User.id, User.email, User.username, *counts(User.id)).where(
+        user_filter
+    )
 
-def read_user_by_id(db: Session, user_id: str):
-    query = db.query(User).filter(User.id == user_id)
-    if query:
-        return {
-            "uuid": query.id,
-            "email": query.email,
-            "userName": query.username,
-            "rooms": query.rooms,
-        }
-    else:
+    def counts_query(user_id):
+        return select(*counts(user_id))
+
+    def rooms_query(user_id):
+        return (
+            select(ChatRoom.id, ChatRoom.name, ChatRoom.last_activity)
+            .join(UserChatRoom, UserChatRoom.room_id == ChatRoom.id)
+            .where(UserChatRoom.user_id == user_id)
+            .order_by(ChatRoom.last_activity.desc(), ChatRoom.id)
+            .limit(recent)
+        )
+
+    def messages_query(user_id):
+        return (
+            select(
+                Message.id,
+                Message.sender_id,
+                Message.content,
+                Message.time,
+                Message.room_id,
+                Message.username,
+            )
+            .where(Message.sender_id == user_id)
+            .order_by(Message.time.desc(), Message.id.desc())
+            .limit(recent)
+        )
+
+    return user_query, counts_query, rooms_query, messages_query
+
+
+def _profile_response(user, counts, rooms, messages):
+    return {
+        "uuid": user.id,
+        "email": user.email,
+        "userName": user.username,
+        "roomCount": sum(count.room_count for count in counts),
+        "messageCount": sum(count.message_count for count in counts),
+        "rooms": [
+            {
+                "id": room.id,
+                "name": room.name,
+                "last_activity": format_time(room.last_activity),
+            }
+            for room in rooms
+        ],
+        "sentMessages": [
+            dict(message._mapping, time=format_time(message.time))
+            for message in messages
+        ],
+    }
+
+
+def _profile(db: Session, user_filter, recent: int):
+    if not 0 <= recent <= PROFILE_MAX_RECENT:
+        raise HTTPException(
+            status_code=400,
+            detail=f"recent must be between 0 and {PROFILE_MAX_RECENT}",
+        )
+
+    user_query, counts_query, rooms_query, messages_query = _profile_queries(
+        user_filter, recent
+    )
+    user = db.execute(user_query).first()
+    if user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
+    counts, rooms, messages = [user], [], []
+    with each_shard(db) as shards:
+        for shard, shard_db in enumerate(shards):
+            if shard:
+                counts.append(shard_db.execute(counts_query(user.id)).one())
+            rooms.append(shard_db.execute(rooms_query(user.id)).all())
+            messages.append(shard_db.execute(messages_query(user.id)).all())
+    return _profile_response(
+        user,
+        counts,
+        _newest_rooms(rooms)[:recent],
+        _newest_messages(messages)[:recent],
+    )
 
-def create_chat_room(db: Session, room: ChatRoomCreate):
-    # Create ChatRoom instance
-    db_room = ChatRoom(name=room.name)
-    db.add(db_room)
-    db.commit()
 
+def _newest_rooms(pages):
+    # Per-shard lists of rooms merged in inbox order: most recent activity
+    # first, ties by id
+    rooms = itertools.chain.from_iterable(pages)
+    return sorted(rooms, key=lambda room: (-room.last_activity, room.id))
+
+
+def _newest_messages(pages):
+    # Per-shard lists of messages, each newest first, merged newest first
+    return list(
+        heapq.merge(
+            *pages, key=lambda message: (message.time, message.id), reverse=True
+        )
+    )
+
+
+def get_user(db: Session, user_email: str, recent: int = PROFILE_RECENT):
+    return _profile(db, User.email == user_email, recent)
+
+
+def read_user_by_id(db: Session, user_id: str, recent: int = PROFILE_RECENT):
+    return _profile(db, User.id == user_id, recent)
+
+
+def create_chat_room(db: Session, room: ChatRoomCreate):
     # Fetch users by their IDs
-    users = db.query(User).filter(User.id.in_(room.members)).all()
+    users = db.execute(_identities_query(room.members)).all()
+
+    # The id is chosen up front: it decides which shard the room lives in
+    room_id = str(uuid.uuid4())
+    with shard_session(db, shard_for(room_id)) as room_db:
+        return insert_chat_room(room_db, room_id, room.name, users)
+
+
+def insert_chat_room(db: Session, room_id: str, name: str, users):
+    # db is on the room's shard; users are (id, username, email) rows from
+    # the main database
+    db_room = ChatRoom(name=name)
+    db_room.id = room_id
+    db.add(db_room)
 
     # Add fetched users to the chat room
-    db_room.users.extend(users)
+    db.add_all(UserChatRoom(user_id=user.id, room_id=room_id) for user in users)
 
-    db.commit()
-    db.refresh(db_room)
+    events = _record_changes(
+        db,
+        [
+            (
+                room_id,
+                "room.created",
+                room_id,
+                {"id": room_id, "name": name, "members": [user.id for user in users]},
+            )
+        ],
+    )
+    _commit_changes(db, events)
 
     # Build the response with members as UserResponse objects
     members = [
         UserResponse(id=user.id, username=user.username, email=user.email)
-        for user in db_room.users
+        for user in users
     ]
 
-    return ChatRoomResponse(id=db_room.id, name=db_room.name, members=members)
+    return ChatRoomResponse(id=room_id, name=name, members=members)
 
 
 def add_user_to_room(db: Session, user_id: str, room_id: str):
+    # New members start caught up; the history before they joined is not
+    # counted as unread
+    newest = db.execute(
+        select(ChatRoom.last_activity, ChatRoom.last_message_id).where(
+            ChatRoom.id == room_id
+        )
+    ).first()
     db_user_room = UserChatRoom(user_id=user_id, room_id=room_id)
+    if newest is not None:
+        db_user_room.last_read_time = newest.last_activity
+        db_user_room.last_read_message_id = newest.last_message_id
     db.add(db_user_room)
-    db.commit()
+    events = _record_changes(
+        db,
+        [
+            (
+                room_id,
+                "member.added",
+                user_id,
+                {"user_id": user_id, "room_id": room_id},
+            )
+        ],
+    )
+    _commit_changes(db, events)
     db.refresh(db_user_room)
     return db_user_room
 
@@ -102,170 +339,1133 @@ def get_chat_room_by_id(db: Session, chat_room_id: str):
     return db.query(ChatRoom).filter(ChatRoom.id == chat_room_id).first()
 
 
-def get_chat_rooms(db: Session, user_id: str):
-    user_chat_rooms = (
-        db.query(UserChatRoom.room_id).filter(UserChatRoom.user_id == user_id).all()
+def _user_rooms_queries(user_id: str):
+    # Two set-based queries per shard however many rooms the user is in: the
+    # rooms themselves, then every membership of all of those rooms at once.
+    # Members are resolved to users afterwards, since users live in shard 0
+    user_room_ids = (
+        select(UserChatRoom.room_id)
+        .where(UserChatRoom.user_id == user_id)
+        .scalar_subquery()
     )
 
-    chat_rooms_response = []
-    for user_chat_room in user_chat_rooms:
-        chat_room = (
-            db.query(ChatRoom).filter(ChatRoom.id == user_chat_room.room_id).first()
-        )
-        if chat_room:
-            members = (
-                db.query(User)
-                .join(UserChatRoom)
-                .filter(UserChatRoom.room_id == chat_room.id)
-                .all()
-            )
-            members_data = [
-                {"id": member.id, "username": member.username, "email": member.email}
-                for member in members
-            ]
-            chat_rooms_response.append(
-                {
-                    "id": chat_room.id,
-                    "name": chat_room.name,
-                    "members": members_data,
-                }
+    rooms_query = select(ChatRoom.id, ChatRoom.name).where(
+        ChatRoom.id.in_(user_room_ids)
+    )
+
+    members_query = select(UserChatRoom.room_id, UserChatRoom.user_id).where(
+        UserChatRoom.room_id.in_(user_room_ids)
+    )
+
+    return rooms_query, members_query
+
+
+def _rooms_response(chat_rooms, members, users):
+    members_by_room = {}
+    for member in members:
+        if member.user_id in users:
+            members_by_room.setdefault(member.room_id, []).append(
+                users[member.user_id]
             )
 
-    print(chat_rooms_response)
-    return chat_rooms_response
+    return [
+        {
+            "id": chat_room.id,
+            "name": chat_room.name,
+            "members": members_by_room.get(chat_room.id, []),
+        }
+        for chat_room in chat_rooms
+    ]
+
+
+def _rooms_with_members(db: Session, user_id: str):
+    rooms_query, members_query = _user_rooms_queries(user_id)
+    chat_rooms, members = [], []
+    with each_shard(db) as shards:
+        for shard_db in shards:
+            chat_rooms += shard_db.execute(rooms_query).all()
+            members += shard_db.execute(members_query).all()
+    users = _identities_for(db, {member.user_id for member in members})
+    return _rooms_response(chat_rooms, members, users)
+
+
+def get_chat_rooms(db: Session, user_id: str):
+    return _rooms_with_members(db, user_id)
 
 
 def get_user_rooms(db: Session, user_id: str):
-    user_chat_rooms = (
-        db.query(UserChatRoom.room_id).filter(UserChatRoom.user_id == user_id).all()
+    return _rooms_with_members(db, user_id)
+
+
+def _membership_version_query(user_id: str):
+    # A user's room list only changes when a room they are in gains members
+    # (joining one included), so the newest such change versions the list.
+    # The literal filter lets SQLite pick the partial membership index
+    return select(func.max(Change.seq)).where(
+        text(MEMBERSHIP_CHANGES),
+        Change.room_id.in_(
+            select(UserChatRoom.room_id).where(UserChatRoom.user_id == user_id)
+        ),
+    )
+
+
+def _room_version_query(room_id: str):
+    # Newest change in the room: one seek on ix_change_log_room_id_seq
+    return select(func.max(Change.seq)).where(Change.room_id == room_id)
+
+
+def membership_version(db: Session, user_id: str):
+    # Summed over shards: it moves whenever any one of them does
+    with each_shard(db) as shards:
+        return sum(
+            shard_db.execute(_membership_version_query(user_id)).scalar() or 0
+            for shard_db in shards
+        )
+
+
+def room_version(db: Session, room_id: str):
+    version = room_cache.version(room_id)
+    if version is None:
+        version = db.execute(_room_version_query(room_id)).scalar() or 0
+    return version
+
+
+def _history_before(time_column, id_column, time: int, message_id: str):
+    # (time_column, id_column) comes before the message in history order. A
+    # NULL id is a position before every message: a room with no messages
+    # yet, or a member who has read nothing
+    return or_(
+        id_column.is_(None),
+        time_column < time,
+        and_(time_column == time, id_column < message_id),
     )
 
-    chat_rooms_response = []
-    for user_chat_room in user_chat_rooms:
-        chat_room = (
-            db.query(ChatRoom).filter(ChatRoom.id == user_chat_room.room_id).first()
-        )
-        if chat_room:
-            members = (
-                db.query(User)
-                .join(UserChatRoom)
-                .filter(UserChatRoom.room_id == chat_room.id)
-                .all()
+
+def _advance_inbox(db: Session, rows):
+    # New messages, as inserted rows (integer times), possibly across rooms:
+    # move each room's last-message pointer forward and count them as unread
+    # for every member but their sender
+    by_room = {}
+    for row in rows:
+        by_room.setdefault(row["room_id"], []).append(row)
+
+    for room_id, room_rows in by_room.items():
+        newest = max(room_rows, key=lambda row: (row["time"], row["id"]))
+        db.execute(
+            update(ChatRoom)
+            .where(
+                ChatRoom.id == room_id,
+                _history_before(
+                    ChatRoom.last_activity,
+                    ChatRoom.last_message_id,
+                    newest["time"],
+                    newest["id"],
+                ),
             )
-            members_data = [
-                {"id": member.id, "username": member.username, "email": member.email}
-                for member in members
-            ]
-            chat_rooms_response.append(
-                {
-                    "id": chat_room.id,
-                    "name": chat_room.name,
-                    "members": members_data,
-                }
+            .values(
+                last_message_id=newest["id"],
+                last_message_sender_id=newest["sender_id"],
+                last_message_username=newest["username"],
+                last_message_preview=message_preview(newest["content"]),
+                last_activity=newest["time"],
             )
+        )
 
-    print(chat_rooms_response)
-    return chat_rooms_response
+        # Each member gains the messages they did not send themselves
+        sent = Counter(row["sender_id"] for row in room_rows)
+        own = case(
+            *((UserChatRoom.user_id == user, count) for user, count in sent.items()),
+            else_=0,
+        )
+        db.execute(
+            update(UserChatRoom)
+            .where(UserChatRoom.room_id == room_id)
+            .values(unread_count=UserChatRoom.unread_count + len(room_rows) - own)
+        )
+
+
+def _retract_from_inbox(db: Session, message: Message):
+    # A deleted message stops counting for the members who had not read it,
+    # and a room whose newest message it was points at the one before
+    db.execute(
+        update(UserChatRoom)
+        .where(
+            UserChatRoom.room_id == message.room_id,
+            UserChatRoom.user_id != message.sender_id,
+            UserChatRoom.unread_count > 0,
+            _history_before(
+                UserChatRoom.last_read_time,
+                UserChatRoom.last_read_message_id,
+                message.time,
+                message.id,
+            ),
+        )
+        .values(unread_count=UserChatRoom.unread_count - 1)
+    )
+
+    last_message_id = db.execute(
+        select(ChatRoom.last_message_id).where(ChatRoom.id == message.room_id)
+    ).scalar()
+    if last_message_id != message.id:
+        return
+
+    newest = db.execute(
+        select(
+            Message.id,
+            Message.sender_id,
+            Message.username,
+            Message.content,
+            Message.time,
+        )
+        .where(Message.room_id == message.room_id)
+        .order_by(Message.time.desc(), Message.id.desc())
+        .limit(1)
+    ).first()
+    if newest is None:
+        # The room keeps its last activity time with nothing to preview
+        values = {
+            "last_message_id": None,
+            "last_message_sender_id": None,
+            "last_message_username": None,
+            "last_message_preview": None,
+        }
+    else:
+        values = {
+            "last_message_id": newest.id,
+            "last_message_sender_id": newest.sender_id,
+            "last_message_username": newest.username,
+            "last_message_preview": message_preview(newest.content),
+            "last_activity": newest.time,
+        }
+    db.execute(update(ChatRoom).where(ChatRoom.id == message.room_id).values(values))
 
 
 def create_message(db: Session, message_data: MessageCreate, room_id: str,):
     sender_id = message_data.sender_id
 
-    # Check if the sender_id exists in the User table
-    sender = db.query(User).filter(User.id == sender_id).first()
+    # Check if the sender_id exists, from the identity cache for active users
+    sender = _identities_for(db, {sender_id}).get(sender_id)
+    return insert_message(db, message_data, room_id, sender)
+
 
+def insert_message(db: Session, message_data: MessageCreate, room_id: str, sender):
+    # db is on the room's shard; sender is the sender's identity from the
+    # main database, None when there is no such user
     if not sender:
         # Handle the case where the sender_id doesn't exist
-        raise ValueError(f"User with ID {sender_id} does not exist.")
+        raise ValueError(f"User with ID {message_data.sender_id} does not exist.")
 
     # Create the Message instance
-    db_message = Message(**message_data.dict(), username = sender.username ,room_id=room_id)
+    db_message = Message(
+        **message_data.dict(), username=sender["username"], room_id=room_id
+    )
     db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
-    return db_message
+    db.flush()
+    _advance_inbox(
+        db,
+        [
+            {
+                "id": db_message.id,
+                "room_id": room_id,
+                "sender_id": db_message.sender_id,
+                "username": db_message.username,
+                "content": db_message.content,
+                "time": db_message.time,
+            }
+        ],
+    )
+
+    # Every column is filled in client side, so the row is complete after
+    # the flush and needs no refresh SELECT once committed
+    message = _message_to_dict(db_message)
+    events = _record_changes(
+        db, [(room_id, "message.created", message["id"], message)]
+    )
+    _commit_changes(db, events)
+    return message
+
+
+def _record_changes(db: Session, changes):
+    # Appends (room_id, kind, entity_id, data) entries to the change log in
+    # the caller's transaction, so a change is logged if and only if it is
+    # committed. Returns the events to publish once the commit succeeds
+    #
+    # The room cache is patched here rather than after the commit: the
+    # transaction holds SQLite's write lock, so changes reach the cache in
+    # sequence order
+    if not changes:
+        return []
+
+    time = message_time()
+    seqs = (
+        db.execute(
+            insert(Change).returning(Change.seq, sort_by_parameter_order=True),
+            [
+                {
+                    "room_id": room_id,
+                    "kind": kind,
+                    "entity_id": entity_id,
+                    "payload": json.dumps(data, separators=(",", ":")),
+                    "time": time,
+                }
+                for room_id, kind, entity_id, data in changes
+            ],
+        )
+        .scalars()
+        .all()
+    )
+    events = [
+        change_event(seq, room_id, kind, data)
+        for seq, (room_id, kind, _, data) in zip(seqs, changes)
+    ]
+    room_cache.apply(events)
+    return events
+
+
+def change_event(seq: int, room_id: str, kind: str, data):
+    # The same shape goes out over the room websocket and from /sync, keyed
+    # by the entity type ("message", "room", "member")
+    return {"type": kind, "seq": seq, "room_id": room_id, kind.split(".")[0]: data}
+
+
+def _commit_changes(db: Session, events):
+    try:
+        db.commit()
+    except Exception:
+        # The cache already holds these changes; drop the rooms it touched
+        for room_id in {event["room_id"] for event in events}:
+            room_cache.invalidate(room_id)
+        raise
+    _publish_changes(events)
+
+
+def _publish_changes(events):
+    broker.publish(events)
+
+
+def _cached_identities(user_ids):
+    identities = {}
+    missing = set()
+    for user_id in user_ids:
+        identity = user_cache.get(user_id)
+        if identity is None:
+            missing.add(user_id)
+        else:
+            identities[user_id] = identity
+    return identities, missing
+
+
+def _identities_query(user_ids):
+    return select(User.id, User.username, User.email).where(User.id.in_(user_ids))
+
+
+def _remember_identities(users):
+    identities = {}
+    for user in users:
+        identity = {"id": user.id, "username": user.username, "email": user.email}
+        user_cache.set(user.id, identity)
+        identities[user.id] = identity
+    return identities
+
+
+def _identities_for(db: Session, user_ids):
+    # Serve what the cache has and resolve the rest with a single query
+    identities, missing = _cached_identities(user_ids)
+    if missing:
+        with users_session(db) as users_db:
+            users = users_db.execute(_identities_query(missing)).all()
+        identities.update(_remember_identities(users))
+    return identities
+
+
+def _message_row(message_data: MessageCreate, username: str, room_id: str, time):
+    return {
+        "id": str(uuid.uuid4()),
+        "sender_id": message_data.sender_id,
+        "username": username,
+        "content": message_data.content,
+        "time": time,
+        "room_id": room_id,
+    }
+
+
+def _row_to_dict(row):
+    # The public shape of a row built by _message_row
+    return dict(row, time=format_time(row["time"]))
+
+
+def _insert_messages(db: Session, rows):
+    # One executemany INSERT and one commit for the whole group. Returns the
+    # messages as the API shows them
+    db.execute(insert(Message), rows)
+    _advance_inbox(db, rows)
+    messages = [_row_to_dict(row) for row in rows]
+    events = _record_changes(
+        db,
+        [
+            (message["room_id"], "message.created", message["id"], message)
+            for message in messages
+        ],
+    )
+    _commit_changes(db, events)
+    return messages
+
+
+def create_messages_batch(
+    db: Session, messages_data: List[MessageCreate], room_id: str
+):
+    if len(messages_data) > BATCH_MAX_MESSAGES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"A batch can hold at most {BATCH_MAX_MESSAGES} messages",
+        )
+    if not messages_data:
+        return []
+
+    senders = _identities_for(db, {message.sender_id for message in messages_data})
+
+    missing = {message.sender_id for message in messages_data} - senders.keys()
+    if missing:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Users with IDs {sorted(missing)} do not exist.",
+        )
+
+    # One microsecond apart, so the batch keeps its order in the room history
+    time = message_time()
+    rows = [
+        _message_row(
+            message, senders[message.sender_id]["username"], room_id, time + offset
+        )
+        for offset, message in enumerate(messages_data)
+    ]
+    return _insert_messages(db, rows)
+
+
+def write_message_group(db: Session, pending):
+    # Flush callback for the group-commit writer: pending is a list of
+    # (MessageCreate, room_id) pairs from many requests. Returns, in order,
+    # the persisted message or the error for each of them. Each shard's
+    # messages are committed in a transaction of their own
+    by_shard = {}
+    for position, (_, room_id) in enumerate(pending):
+        by_shard.setdefault(shard_for(room_id), []).append(position)
+
+    results = [None] * len(pending)
+    for shard, positions in by_shard.items():
+        try:
+            with shard_session(db, shard) as shard_db:
+                written = _write_shard_group(
+                    shard_db, [pending[position] for position in positions]
+                )
+        except Exception as e:
+            # The shard's transaction failed as a whole
+            written = [e] * len(positions)
+        for position, result in zip(positions, written):
+            results[position] = result
+    return results
+
+
+def _write_shard_group(db: Session, pending):
+    senders = _identities_for(db, {message.sender_id for message, _ in pending})
+
+    # Spaced a microsecond apart in arrival order, like a batch
+    time = message_time()
+    rows = []
+    results = []
+    for offset, (message_data, room_id) in enumerate(pending):
+        sender = senders.get(message_data.sender_id)
+        if sender is None:
+            results.append(
+                ValueError(f"User with ID {message_data.sender_id} does not exist.")
+            )
+            continue
+        rows.append(
+            _message_row(message_data, sender["username"], room_id, time + offset)
+        )
+        results.append(len(rows) - 1)
+
+    messages = _insert_messages(db, rows) if rows else []
+    return [
+        messages[result] if isinstance(result, int) else result for result in results
+    ]
+
+
+def _message_to_dict(message: Message):
+    return {
+        "id": message.id,
+        "sender_id": message.sender_id,
+        "username": message.username,
+        "content": message.content,
+        "time": format_time(message.time),
+        "room_id": message.room_id,
+    }
+
+
+def _room_page_query(room_id: str, skip: int, limit: int):
+    return (
+        select(Message)
+        .where(Message.room_id == room_id)
+        .order_by(Message.time, Message.id)
+        .offset(skip)
+        .limit(limit)
+    )
+
+
+def _archived_slice(room_id: str, skip: int, limit: int):
+    # The archive holds the start of the room's history, so an offset page
+    # takes what it can from there and the rest from the table, with the
+    # offset shifted past the archived messages
+    archived = message_archive.read_range(room_id, skip, limit)
+    hot_skip = max(0, skip - message_archive.count(room_id))
+    return archived, hot_skip, limit - len(archived)
 
 
 def get_messages_by_room(db: Session, room_id: str, skip: int = 0, limit: int = 10):
-    messages = (
-        db.query(
-            Message
+    _check_page(limit, skip)
+    cached = _cached_room_slice(room_id, skip, limit)
+    if cached is not None:
+        return cached
+
+    if room_cache.version(room_id) is None:
+        # Nothing cached for the room: read its window as the cursor pages
+        # do, so offset readers warm the cache too. A small room is then
+        # served from the window
+        version = db.execute(_room_version_query(room_id)).scalar() or 0
+        query = _room_cursor_query(room_id, ROOM_CACHE_MESSAGES, None, None)
+        result = db.execute(query).scalars()
+        window = [_message_to_dict(message) for message in result]
+        messages, complete = _fill_room_window(room_id, version, window)
+        if complete:
+            return messages[::-1][skip : skip + limit]
+
+    messages_list, skip, limit = _archived_slice(room_id, skip, limit)
+    if limit > 0:
+        messages = db.execute(_room_page_query(room_id, skip, limit)).scalars()
+
+        # Convert the query results to a list of dictionaries
+        messages_list += [_message_to_dict(message) for message in messages]
+
+    return messages_list
+
+
+def _cached_room_slice(room_id: str, skip: int, limit: int):
+    # Offset pages can come from the cache only when it holds the whole room
+    messages = room_cache.whole_room(room_id)
+    if messages is None:
+        return None
+    return messages[::-1][skip : skip + limit]
+
+
+def _room_cursor_query(
+    room_id: str, limit: int, before: Optional[str], after: Optional[str]
+):
+    if before and after:
+        raise HTTPException(
+            status_code=400, detail="Pass either before or after, not both"
         )
-        .filter(Message.room_id == room_id)
+
+    query = select(Message).where(Message.room_id == room_id)
+    position = tuple_(Message.time, Message.id)
+
+    def cursor_position(cursor):
+        # Typed like the columns, so the id is bound as a key (a blob under
+        # binary key storage) rather than as plain text
+        return tuple_(
+            *_cursor_key(cursor), types=(Message.time.type, Message.id.type)
+        )
+
+    if after:
+        # Page forward (oldest first) from the cursor, e.g. to catch up
+        query = query.where(position > cursor_position(after))
+        query = query.order_by(Message.time, Message.id)
+    else:
+        # Scroll back (newest first), starting at the latest message
+        if before:
+            query = query.where(position < cursor_position(before))
+        query = query.order_by(Message.time.desc(), Message.id.desc())
+
+    # Both directions seek on ix_messages_room_id_time_id, so a page costs
+    # the same however deep into the history it is. One extra row tells
+    # whether there is another page
+    return query.limit(limit + 1)
+
+
+def _cursor_key(cursor: str):
+    # Cursors carry the public time, which is turned back into epoch
+    # microseconds: (time, id) as the history is ordered
+    time, message_id = decode_cursor(cursor)
+    try:
+        return parse_time(time), message_id
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _with_archived(
+    room_id: str,
+    messages,
+    limit: int,
+    before: Optional[str],
+    after: Optional[str],
+):
+    # messages: a page from _room_cursor_query. Archived messages are older
+    # than everything in the table, so they go in front of a forward page,
+    # and fill up a backward page that ran out of table rows
+    if after:
+        position = _cursor_key(after)
+        newest = message_archive.newest(room_id)
+        if newest is None or position >= newest:
+            return messages
+        return message_archive.read_after(room_id, position, limit + 1) + messages
+
+    if len(messages) > limit:
+        return messages
+    if messages:
+        position = (parse_time(messages[-1]["time"]), messages[-1]["id"])
+    else:
+        position = _cursor_key(before) if before else None
+    archived = message_archive.read_before(room_id, position, limit + 1 - len(messages))
+    return messages + archived
+
+
+def _room_cursor_response(messages, limit: int, after: Optional[str]):
+    has_more = len(messages) > limit
+    return _room_page_response(messages[:limit], has_more, after)
+
+
+def _room_page_response(messages, has_more: bool, after: Optional[str] = None):
+    # messages are already dicts, from the database or the room cache.
+    # When paging forward the cursor is handed back even at the head of the
+    # room, so clients can keep polling from the last message they saw
+    next_cursor = None
+    if messages and (has_more or after):
+        next_cursor = encode_cursor(messages[-1]["time"], messages[-1]["id"])
+
+    return {"messages": messages, "next_cursor": next_cursor, "has_more": has_more}
+
+
+def _latest_page_cacheable(limit: int, before: Optional[str], after: Optional[str]):
+    return not before and not after and limit <= ROOM_CACHE_MESSAGES
+
+
+def _cached_latest_page(room_id: str, limit: int):
+    cached = room_cache.page(room_id, limit)
+    if cached is None:
+        return None
+    messages, has_more = cached
+    return _room_page_response(messages, has_more)
+
+
+def _fill_room_window(room_id: str, version: int, messages):
+    # messages come from _room_cursor_query with ROOM_CACHE_MESSAGES as the
+    # limit, read in the same transaction as version. Topped up from the
+    # archive, so a complete window really is the whole room
+    messages = _with_archived(room_id, messages, ROOM_CACHE_MESSAGES, None, None)
+    complete = len(messages) <= ROOM_CACHE_MESSAGES
+    messages = messages[:ROOM_CACHE_MESSAGES]
+    room_cache.fill(room_id, version, messages, complete)
+    return messages, complete
+
+
+def _fill_latest_page(room_id: str, version: int, messages, limit: int):
+    messages, complete = _fill_room_window(room_id, version, messages)
+    return _room_page_response(
+        messages[:limit], len(messages) > limit or not complete
+    )
+
+
+def get_messages_by_room_cursor(
+    db: Session,
+    room_id: str,
+    limit: int = 10,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+):
+    _check_page(limit)
+    if _latest_page_cacheable(limit, before, after):
+        cached = _cached_latest_page(room_id, limit)
+        if cached is not None:
+            return cached
+
+        # Miss: read the room's version and the whole cacheable window in one
+        # transaction, then serve the page out of it
+        version = db.execute(_room_version_query(room_id)).scalar() or 0
+        query = _room_cursor_query(room_id, ROOM_CACHE_MESSAGES, None, None)
+        result = db.execute(query).scalars()
+        messages = [_message_to_dict(message) for message in result]
+        return _fill_latest_page(room_id, version, messages, limit)
+
+    query = _room_cursor_query(room_id, limit, before, after)
+    result = db.execute(query).scalars()
+    messages = [_message_to_dict(message) for message in result]
+    messages = _with_archived(room_id, messages, limit, before, after)
+    return _room_cursor_response(messages, limit, after)
+
+
+def _messages_query(skip: int, limit: int):
+    return (
+        select(
+            Message.id,
+            Message.sender_id,
+            Message.content,
+            Message.time,
+            Message.room_id,
+        )
+        .order_by(Message.time, Message.id)
         .offset(skip)
         .limit(limit)
-        .all()
     )
 
-    # Convert the query results to a list of dictionaries
-    messages_list = [
+
+def _messages_response(messages, senders):
+    # Convert the query results to a list of dictionaries with appended usernames
+    return [
         {
             "id": message.id,
             "sender_id": message.sender_id,
-            "username": message.username,
+            "username": senders[message.sender_id]["username"]
+            if message.sender_id in senders
+            else None,
             "content": message.content,
-            "time": message.time,
+            "time": format_time(message.time),
             "room_id": message.room_id,
         }
         for message in messages
     ]
 
-    return messages_list
+
+def _scattered_messages_query(skip: int, limit: int):
+    # With one shard the database applies the offset. Otherwise every shard
+    # returns its first skip + limit and the offset is applied to the merge
+    if SHARD_COUNT == 1:
+        return _messages_query(skip, limit), 0
+    return _messages_query(0, skip + limit), skip
+
+
+def _gather_messages(pages, skip: int, limit: int):
+    # Per-shard pages, each in time order, merged in time order
+    merged = heapq.merge(*pages, key=lambda message: (message.time, message.id))
+    return list(itertools.islice(merged, skip, skip + limit))
 
 
 def get_messages(db: Session, skip: int = 0, limit: int = 10):
-    messages = (
-        db.query(
+    _check_page(limit, skip)
+    query, skip = _scattered_messages_query(skip, limit)
+    with each_shard(db) as shards:
+        pages = [shard_db.execute(query).all() for shard_db in shards]
+    messages = _gather_messages(pages, skip, limit)
+    senders = _identities_for(db, {message.sender_id for message in messages})
+    return _messages_response(messages, senders)
+
+
+def _export_chunks(room_id: str):
+    # Runs while the response streams, so it holds its own read session
+    # rather than the request's. yield_per keeps a single SQLite cursor open
+    # and fetches EXPORT_CHUNK_SIZE plain rows at a time, never the whole room.
+    # Archived messages come first, a chunk of them at a time as well
+    for skip in range(0, message_archive.count(room_id), EXPORT_CHUNK_SIZE):
+        messages = message_archive.read_range(room_id, skip, EXPORT_CHUNK_SIZE)
+        yield "".join(
+            json.dumps(message, separators=(",", ":")) + "\n" for message in messages
+        ).encode()
+
+    with ShardReadSessionLocal[shard_for(room_id)]() as db:
+        result = db.execute(
+            select(
+                Message.id,
+                Message.sender_id,
+                Message.username,
+                Message.content,
+                Message.time,
+                Message.room_id,
+            )
+            .where(Message.room_id == room_id)
+            .order_by(Message.time, Message.id)
+            .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+        )
+        for rows in result.partitions():
+            yield "".join(
+                json.dumps(_message_to_dict(row), separators=(",", ":")) + "\n"
+                for row in rows
+            ).encode()
+
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_room_messages(db: Session, room_id: str, compress: bool = False):
+    if get_chat_room_by_id(db, room_id) is None:
+        raise HTTPException(status_code=404, detail="Chat room not found")
+
+    chunks = _export_chunks(room_id)
+    return _gzip_chunks(chunks) if compress else chunks
+
+
+def search_messages(
+    db: Session,
+    q: str,
+    room_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+):
+    if bool(room_id) == bool(user_id):
+        raise HTTPException(
+            status_code=400, detail="Pass exactly one of room_id or user_id"
+        )
+    _check_page(limit, max_limit=SEARCH_MAX_RESULTS)
+
+    expression = match_expression(q)
+    if not expression:
+        raise HTTPException(status_code=400, detail="Empty search query")
+
+    query = (
+        select(
             Message.id,
             Message.sender_id,
+            Message.username,
             Message.content,
             Message.time,
             Message.room_id,
+            snippet().label("snippet"),
+            score().label("score"),
+            messages_fts.c.rowid,
         )
-        .offset(skip)
-        .limit(limit)
-        .all()
+        .select_from(messages_fts)
+        .join(Message, literal_column("messages.rowid") == messages_fts.c.rowid)
+        .where(matches(expression))
     )
 
-    sender_ids = [message.sender_id for message in messages]
+    if room_id:
+        query = query.where(Message.room_id == room_id)
+    else:
+        # Every room the user belongs to
+        query = query.where(
+            Message.room_id.in_(
+                select(UserChatRoom.room_id).where(UserChatRoom.user_id == user_id)
+            )
+        )
 
-    # Fetch usernames corresponding to sender_ids
-    usernames = db.query(User.id, User.username).filter(User.id.in_(sender_ids)).all()
+    # Results are ordered by (score, rowid, shard): rowids are per shard, so
+    # under sharding the cursor carries the shard as the final tiebreak
+    position = tuple_(score(), messages_fts.c.rowid)
+    after = _search_cursor(cursor) if cursor else None
 
-    # Create a mapping of sender_id to username
-    username_mapping = {user.id: user.username for user in usernames}
+    results = []
+    with each_shard(db) as shards:
+        for shard, shard_db in enumerate(shards):
+            if room_id and shard != shard_for(room_id):
+                continue
+            shard_query = query
+            if after:
+                bound = tuple_(*after[:2])
+                shard_query = shard_query.where(
+                    position >= bound if shard > after[2] else position > bound
+                )
+            rows = shard_db.execute(
+                shard_query.order_by(score(), messages_fts.c.rowid).limit(limit + 1)
+            ).all()
+            results += [(row.score, row.rowid, shard, row) for row in rows]
 
-    # Convert the query results to a list of dictionaries with appended usernames
-    messages_list = [
+    results = sorted(results, key=lambda result: result[:3])[: limit + 1]
+    has_more = len(results) > limit
+    results = results[:limit]
+
+    next_cursor = None
+    if has_more:
+        last = results[-1][:3] if SHARD_COUNT > 1 else results[-1][:2]
+        next_cursor = encode_cursor(*last)
+
+    return {
+        "results": [
+            {
+                "id": result.id,
+                "sender_id": result.sender_id,
+                "username": result.username,
+                "content": result.content,
+                "time": format_time(result.time),
+                "room_id": result.room_id,
+                "snippet": result.snippet,
+                "score": result.score,
+            }
+            for *_, result in results
+        ],
+        "next_cursor": next_cursor,
+    }
+
+
+def _search_cursor(cursor: str):
+    # (score, rowid, shard); the shard is only in the cursor under sharding
+    if SHARD_COUNT == 1:
+        return [*decode_cursor(cursor), 0]
+    return decode_cursor(cursor, size=3)
+
+
+def get_changes(db: Session, user_id: str, since="0", limit: int = 100):
+    if not 1 <= limit <= SYNC_MAX_CHANGES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"limit must be between 1 and {SYNC_MAX_CHANGES}",
+        )
+    since = _since_vector(since)
+
+    # Writers take the database lock with BEGIN IMMEDIATE, so sequence
+    # numbers become visible in order and a client never skips one that
+    # commits late. Only the user's current rooms are read; each room is a seek on
+    # ix_change_log_room_id_seq past `since`, so a sync costs what changed
+    # rather than the size of the history
+    #
+    # Every shard numbers its own changes, so under sharding `since` holds
+    # one seq per shard. Each shard's changes stay in seq order; across
+    # shards they are interleaved by time
+    pages = []
+    with each_shard(db) as shards:
+        _ensure_within_horizon(shards, since)
+        for shard, shard_db in enumerate(shards):
+            changes = shard_db.execute(
+                select(
+                    Change.seq, Change.room_id, Change.kind, Change.payload, Change.time
+                )
+                .where(
+                    Change.room_id.in_(
+                        select(UserChatRoom.room_id).where(
+                            UserChatRoom.user_id == user_id
+                        )
+                    ),
+                    Change.seq > since[shard],
+                )
+                .order_by(Change.seq)
+                .limit(limit + 1)
+            ).all()
+            pages.append([(change.time or 0, shard, change) for change in changes])
+
+    changes = list(
+        itertools.islice(heapq.merge(*pages, key=lambda page: page[:2]), limit + 1)
+    )
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    next_since = list(since)
+    for _, shard, change in changes:
+        next_since[shard] = change.seq
+
+    return {
+        "changes": [
+            change_event(
+                change.seq, change.room_id, change.kind, json.loads(change.payload)
+            )
+            for *_, change in changes
+        ],
+        # Clients pass this back as `since`; at the head it stays put
+        "next_since": _since_token(next_since),
+        "has_more": has_more,
+    }
+
+
+def _ensure_within_horizon(shards, since):
+    # Changes up to each shard's horizon have been pruned from change_log. A
+    # client behind it would silently miss some, so it is told to reload
+    # its rooms and carry on from the head instead
+    horizon_query = select(ChangeLogHorizon.pruned_through).where(
+        ChangeLogHorizon.id == 1
+    )
+    horizons = [
+        shard_db.execute(horizon_query).scalar() or 0 for shard_db in shards
+    ]
+    if all(seq >= horizon for seq, horizon in zip(since, horizons)):
+        return
+    heads = [
+        shard_db.execute(select(func.max(Change.seq))).scalar() or 0
+        for shard_db in shards
+    ]
+    raise HTTPException(
+        status_code=status.HTTP_410_GONE,
+        detail={
+            "message": "since is older than the change log, resync required",
+            "next_since": _since_token(heads),
+        },
+    )
+
+
+def _since_vector(since):
+    # A seq per shard, written "12.0.7" under sharding and as the plain seq
+    # with one shard. 0 starts every shard from the beginning
+    try:
+        seqs = [int(seq) for seq in str(since).split(".")]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid since")
+    if seqs == [0]:
+        seqs *= SHARD_COUNT
+    if len(seqs) != SHARD_COUNT:
+        raise HTTPException(
+            status_code=400, detail=f"since must hold {SHARD_COUNT} sequence numbers"
+        )
+    return seqs
+
+
+def _since_token(seqs):
+    return seqs[0] if SHARD_COUNT == 1 else ".".join(map(str, seqs))
+
+
+def _inbox_query(user_id: str):
+    # One query whatever the number of rooms: the user's memberships by
+    # primary key, each joined to its room by primary key. Everything shown
+    # is kept on those two rows by the writes
+    return (
+        select(
+            ChatRoom.id,
+            ChatRoom.name,
+            ChatRoom.last_activity,
+            ChatRoom.last_message_id,
+            ChatRoom.last_message_sender_id,
+            ChatRoom.last_message_username,
+            ChatRoom.last_message_preview,
+            UserChatRoom.unread_count,
+            UserChatRoom.last_read_message_id,
+        )
+        .join(ChatRoom, ChatRoom.id == UserChatRoom.room_id)
+        .where(UserChatRoom.user_id == user_id)
+        .order_by(ChatRoom.last_activity.desc(), ChatRoom.id)
+    )
+
+
+def _inbox_response(rooms):
+    return [
         {
-            "id": message.id,
-            "sender_id": message.sender_id,
-            "username": username_mapping.get(message.sender_id),
-            "content": message.content,
-            "time": message.time,
-            "room_id": message.room_id,
+            "id": room.id,
+            "name": room.name,
+            "last_activity": format_time(room.last_activity),
+            "last_message": (
+                {
+                    "id": room.last_message_id,
+                    "sender_id": room.last_message_sender_id,
+                    "username": room.last_message_username,
+                    "preview": room.last_message_preview,
+                }
+                if room.last_message_id is not None
+                else None
+            ),
+            "unread_count": room.unread_count,
+            "last_read_message_id": room.last_read_message_id,
         }
-        for message in messages
+        for room in rooms
     ]
-    return messages_list
 
 
-def delete_message(db: Session, message_id: str):
+def get_inbox(db: Session, user_id: str):
+    with each_shard(db) as shards:
+        rooms = [shard_db.execute(_inbox_query(user_id)).all() for shard_db in shards]
+    return _inbox_response(_newest_rooms(rooms))
+
+
+def mark_room_read(
+    db: Session, user_id: str, room_id: str, message_id: Optional[str] = None
+):
+    # Moves the member's read cursor up to message_id, or to the newest
+    # message when none is given. The cursor never moves backwards
+    member = db.get(UserChatRoom, (user_id, room_id))
+    if member is None:
+        raise HTTPException(status_code=404, detail="User is not in this room")
+
+    if message_id is None:
+        target = db.execute(
+            select(ChatRoom.last_activity, ChatRoom.last_message_id).where(
+                ChatRoom.id == room_id
+            )
+        ).one()
+        if target.last_message_id is not None:
+            target = (target.last_activity, target.last_message_id)
+        else:
+            target = None
+    else:
+        target = db.execute(
+            select(Message.time, Message.id).where(
+                Message.id == message_id, Message.room_id == room_id
+            )
+        ).first()
+        if target is None:
+            raise HTTPException(status_code=404, detail="Message not found")
+        target = tuple(target)
+
+    # Text keys sort like the bytes of their binary form, so this matches
+    # the database's order whichever KEY_STORAGE is in use
+    cursor = (member.last_read_time or 0, member.last_read_message_id)
+    if target is not None and (cursor[1] is None or cursor < target):
+        member.last_read_time, member.last_read_message_id = target
+        if message_id is None:
+            member.unread_count = 0
+        else:
+            # Messages after the cursor that others sent: a seek on
+            # ix_messages_room_id_time_id
+            member.unread_count = db.execute(
+                select(func.count())
+                .select_from(Message)
+                .where(
+                    Message.room_id == room_id,
+                    Message.sender_id != user_id,
+                    tuple_(Message.time, Message.id)
+                    > tuple_(*target, types=(Message.time.type, Message.id.type)),
+                )
+            ).scalar()
+
+    read_state = {
+        "user_id": user_id,
+        "room_id": room_id,
+        "last_read_message_id": member.last_read_message_id,
+        "unread_count": member.unread_count,
+    }
+    db.commit()
+    return read_state
+
+
+def _ensure_author(message: Message, user_id: Optional[str]):
+    # Signed-in callers may only change their own messages
+    if user_id is not None and message.sender_id != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only the sender can change this message",
+        )
+
+
+def _ensure_not_archived(db: Session, message_id: str):
+    # A message moved to the archive is read-only rather than missing
+    if db.get(ArchivedMessage, message_id) is not None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Message is archived and can no longer be changed",
+        )
+
+
+def delete_message(db: Session, message_id: str, user_id: Optional[str] = None):
     try:
         message = db.query(Message).filter(Message.id == message_id).first()
 
         if message:
+            _ensure_author(message, user_id)
             db.delete(message)
-            db.commit()
+            db.flush()
+            _retract_from_inbox(db, message)
+            events = _record_changes(
+                db,
+                [(message.room_id, "message.deleted", message.id, {"id": message.id})],
+            )
+            _commit_changes(db, events)
             return {
                 "id": message.id,
                 "sender_id": message.sender_id,
                 "content": message.content,
-                "time": message.time,
+                "time": format_time(message.time),
                 "room_id": message.room_id,
                 "status": "success",
             }
         else:
+            _ensure_not_archived(db, message_id)
             # Raise a 404 Not Found HTTPException
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="Message not found"
@@ -285,26 +1485,41 @@ def delete_message(db: Session, message_id: str):
         )
 
 
-def update_message(db: Session, message_id: str, new_message: UpdateMessageResponse):
+def update_message(
+    db: Session,
+    message_id: str,
+    new_message: UpdateMessageResponse,
+    user_id: Optional[str] = None,
+):
     try:
         message = db.query(Message).filter(Message.id == message_id).first()
 
         if message:
+            _ensure_author(message, user_id)
+
             # Update the content of the message
             message.content = new_message.content
+            db.execute(
+                update(ChatRoom)
+                .where(
+                    ChatRoom.id == message.room_id,
+                    ChatRoom.last_message_id == message.id,
+                )
+                .values(last_message_preview=message_preview(message.content))
+            )
+
+            updated = _message_to_dict(message)
+            events = _record_changes(
+                db, [(message.room_id, "message.updated", message.id, updated)]
+            )
 
             # Commit the changes to the database
-            db.commit()
+            _commit_changes(db, events)
 
             # Return the updated message
-            return {
-                "id": message.id,
-                "sender_id": message.sender_id,
-                "content": message.content,
-                "time": message.time,
-                "room_id": message.room_id,
-            }
+            return updated
         else:
+            _ensure_not_archived(db, message_id)
             # Return an error message if the message doesn't exist
             return {"message": "Message not found"}
 
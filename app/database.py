@@ -1,95 +1,260 @@
 #  database.py
-from sqlalchemy import ForeignKey, create_engine, Column, String, DateTime
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy import Sequence
-import uuid
-import datetime
+import os
+import zlib
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from sqlalchemy import create_engine, event, select, union_all
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from app.models.models import ArchivedMessage, Base, Message, key_to_bytes
+from app.migrations.epoch_time import upgrade as upgrade_time_columns
+from app.migrations.inbox import upgrade as upgrade_inbox_columns
+from app.search import (
+    SEARCH_INDEX_CHECK,
+    check_search_index,
+    install_search_index,
+    rebuild_search_index,
+)
 
-DATABASE_URL = "sqlite:///./app/test.db"
+DATABASE_URL = os.getenv("DATABASE_URL", default="sqlite:///./app/test.db")
 
-engine = create_engine(DATABASE_URL)
+# The async engine talks to the same database through aiosqlite
+ASYNC_DATABASE_URL = os.getenv(
+    "ASYNC_DATABASE_URL",
+    default=DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1),
+)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-Base = declarative_base()
+# Serve the hot routes from async controllers instead of the threadpool
+USE_ASYNC_DB = os.getenv("USE_ASYNC_DB", default="false").lower() in ("1", "true")
 
+# Storage profile, applied to every SQLite connection as it is opened
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", default="WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", default="NORMAL")
+# Negative values are KiB, so the default is a 64 MiB page cache
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", default=-65536))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", default=256 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", default=5000))
 
-class User(Base):
-    __tablename__ = "users"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", default=5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", default=10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", default=30))
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", default=10))
 
-    id = Column(String, primary_key=True, index=True, default=lambda: str(uuid.uuid4()))
-    username = Column(String, index=True)
-    email = Column(String, unique=True, index=True)
-    password = Column(String)
+# Rooms, memberships, messages and the change log are split by room over
+# SHARD_COUNT SQLite files, each with its own writer. Shard 0 is
+# DATABASE_URL itself and also holds the users; shard n is the same path
+# with "-shard<n>" before the extension
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", default=1))
 
-    # Define a relationship with the ChatRoom model
-    rooms = relationship("ChatRoom", secondary="user_chat_room", overlaps="rooms")
 
-    # Define a relationship with the Message model
-    sent_messages = relationship(
-        "Message", back_populates="sender", foreign_keys="[Message.sender_id]"
+def _is_sqlite_file(url):
+    url = make_url(url)
+    return url.get_backend_name() == "sqlite" and url.database not in (
+        None,
+        "",
+        ":memory:",
     )
 
-    def __init__(self, username, email, password):
-        self.username = username
-        self.email = email
-        self.password = password
 
+def _shard_url(url, shard):
+    if shard == 0:
+        return url
+    url = make_url(url)
+    stem, extension = os.path.splitext(url.database)
+    return url.set(database=f"{stem}-shard{shard}{extension}")
 
-class ChatRoom(Base):
-    __tablename__ = "chat_rooms"
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    name = Column(String, index=True)
+def _read_only_url(url):
+    # Open the same file through a URI so SQLite itself refuses writes
+    url = make_url(url)
+    return url.set(
+        database=f"file:{url.database}", query={"mode": "ro", "uri": "true"}
+    )
 
-    # Define a relationship with the User model
-    users = relationship("User", secondary="user_chat_room", overlaps="rooms")
 
-    # Define a relationship with the Message model
-    messages = relationship("Message", back_populates="room")
+def _apply_sqlite_profile(engine, read_only=False):
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        # Let SQLAlchemy's begin event below issue BEGIN instead of the
+        # driver, which would otherwise defer it to the first write
+        dbapi_connection.isolation_level = None
 
-    def __init__(self, name):
-        self.name = name
+        cursor = dbapi_connection.cursor()
+        if not read_only:
+            # journal_mode is persistent in the file, set by the writers
+            cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
 
+    @event.listens_for(engine, "begin")
+    def _on_begin(connection):
+        # Writers take the write lock up front. A deferred transaction that
+        # reads first (create_message looks up the sender) and then tries to
+        # upgrade fails with "database is locked" without ever waiting on
+        # busy_timeout
+        connection.exec_driver_sql("BEGIN" if read_only else "BEGIN IMMEDIATE")
 
-class UserChatRoom(Base):
-    __tablename__ = "user_chat_room"
 
-    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
-    room_id = Column(String, ForeignKey("chat_rooms.id"), primary_key=True)
+def _create_engine(url, read_only=False):
+    if not _is_sqlite_file(url):
+        return create_engine(url)
 
+    if read_only:
+        url = _read_only_url(url)
+    engine = create_engine(
+        url,
+        poolclass=QueuePool,
+        pool_size=DB_READ_POOL_SIZE if read_only else DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+    _apply_sqlite_profile(engine, read_only)
+    return engine
 
-class Message(Base):
-    __tablename__ = "messages"
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+def _create_async_engine(url, read_only=False):
+    if not _is_sqlite_file(url):
+        return create_async_engine(url)
 
-    sender_id = Column(String, ForeignKey("users.id"), index=True)
-    content = Column(String)
-    username = Column(String, ForeignKey("users.username"), index=True)
-    time = Column(String)
-    room_id = Column(
-        String, ForeignKey("chat_rooms.id"), default=lambda: str(uuid.uuid4())
+    if read_only:
+        url = _read_only_url(url)
+    # aiosqlite defaults to NullPool, which opens a connection (and its
+    # thread) per session; keep them pooled like the sync engine does
+    async_engine = create_async_engine(
+        url,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=DB_READ_POOL_SIZE if read_only else DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
     )
+    _apply_sqlite_profile(async_engine.sync_engine, read_only)
+    return async_engine
 
-    # Define a relationship with the ChatRoom model
-    room = relationship("ChatRoom", back_populates="messages")
 
-    # Define a relationship with the User model
-    sender = relationship(
-        "User", back_populates="sent_messages", foreign_keys="[Message.sender_id]"
-    )
+if SHARD_COUNT < 1:
+    raise ValueError(f"SHARD_COUNT must be at least 1, got {SHARD_COUNT}")
+if SHARD_COUNT > 1 and not _is_sqlite_file(DATABASE_URL):
+    raise ValueError("SHARD_COUNT above 1 needs DATABASE_URL to be a SQLite file")
+
+engine = _create_engine(DATABASE_URL)
+
+# Reads go to read-only connections when the database is a SQLite file; in
+# WAL mode they never wait on, or block, the writer
+if _is_sqlite_file(DATABASE_URL):
+    read_engine = _create_engine(DATABASE_URL, read_only=True)
+else:
+    read_engine = engine
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+async_engine = _create_async_engine(ASYNC_DATABASE_URL)
+
+if _is_sqlite_file(ASYNC_DATABASE_URL):
+    async_read_engine = _create_async_engine(ASYNC_DATABASE_URL, read_only=True)
+else:
+    async_read_engine = async_engine
+
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False
+)
+
+AsyncReadSessionLocal = async_sessionmaker(
+    async_read_engine, autoflush=False, expire_on_commit=False
+)
+
+
+def _shards(first, create):
+    # Per shard, indexed by shard number; entry 0 is the object above
+    return [first] + [create(shard) for shard in range(1, SHARD_COUNT)]
+
+
+shard_engines = _shards(
+    engine, lambda shard: _create_engine(_shard_url(DATABASE_URL, shard))
+)
+shard_read_engines = _shards(
+    read_engine,
+    lambda shard: _create_engine(_shard_url(DATABASE_URL, shard), read_only=True),
+)
+async_shard_engines = _shards(
+    async_engine,
+    lambda shard: _create_async_engine(_shard_url(ASYNC_DATABASE_URL, shard)),
+)
+async_shard_read_engines = _shards(
+    async_read_engine,
+    lambda shard: _create_async_engine(
+        _shard_url(ASYNC_DATABASE_URL, shard), read_only=True
+    ),
+)
+
+ShardSessionLocal = _shards(
+    SessionLocal,
+    lambda shard: sessionmaker(
+        autocommit=False, autoflush=False, bind=shard_engines[shard]
+    ),
+)
+ShardReadSessionLocal = _shards(
+    ReadSessionLocal,
+    lambda shard: sessionmaker(
+        autocommit=False, autoflush=False, bind=shard_read_engines[shard]
+    ),
+)
+AsyncShardSessionLocal = _shards(
+    AsyncSessionLocal,
+    lambda shard: async_sessionmaker(
+        async_shard_engines[shard], autoflush=False, expire_on_commit=False
+    ),
+)
+AsyncShardReadSessionLocal = _shards(
+    AsyncReadSessionLocal,
+    lambda shard: async_sessionmaker(
+        async_shard_read_engines[shard], autoflush=False, expire_on_commit=False
+    ),
+)
+
+
+def shard_for(room_id: str):
+    # crc32 of the key bytes rather than hash(), which differs between
+    # processes, so every worker routes a room to the same file
+    if SHARD_COUNT == 1:
+        return 0
+    return zlib.crc32(key_to_bytes(room_id)) % SHARD_COUNT
+
 
-    def __init__(
-        self, sender_id, content, username, time=None, custom_uuid=None, room_id=None
-    ):
-        self.sender_id = sender_id
-        self.username = username
-        self.content = content
-        self.time = time or datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-        self.uuid = custom_uuid or str(uuid.uuid4())
-        self.room_id = room_id or str(uuid.uuid4())
+def init_db():
+    # Every shard gets the whole schema; users only has rows in shard 0
+    for shard_engine in shard_engines:
+        _init_shard(shard_engine)
+
+
+def _init_shard(shard_engine):
+    Base.metadata.create_all(bind=shard_engine)
+
+    # Databases from before epoch timestamps are rebuilt in place
+    with shard_engine.begin() as connection:
+        upgraded = upgrade_time_columns(connection)
+        upgrade_inbox_columns(connection)
+
+    # create_all only emits CREATE INDEX for tables it creates itself, so
+    # indexes added to an existing table have to be created explicitly
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=shard_engine, checkfirst=True)
+
+    with shard_engine.begin() as connection:
+        install_search_index(connection)
+        if "messages" in upgraded:
+            # The rebuilt table has new rowids
+            rebuild_search_index(connection)
+        elif SEARCH_INDEX_CHECK:
+            check_search_index(connection)
 
 
 def get_db():
@@ -98,3 +263,124 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_async_read_db():
+    async with AsyncReadSessionLocal() as db:
+        yield db
+
+
+# The room's shard, for routes with a room_id
+def get_room_db(room_id: str):
+    db = ShardSessionLocal[shard_for(room_id)]()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_room_read_db(room_id: str):
+    db = ShardReadSessionLocal[shard_for(room_id)]()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_room_db(room_id: str):
+    async with AsyncShardSessionLocal[shard_for(room_id)]() as db:
+        yield db
+
+
+async def get_async_room_read_db(room_id: str):
+    async with AsyncShardReadSessionLocal[shard_for(room_id)]() as db:
+        yield db
+
+
+# The shard holding the message, for routes with a message_id, archived or
+# not. Shard 0 when no other shard has it, where the controller finds it or
+# answers 404
+def _holds_message(message_id: str):
+    return union_all(
+        select(Message.id).where(Message.id == message_id),
+        select(ArchivedMessage.id).where(ArchivedMessage.id == message_id),
+    )
+
+
+def get_message_db(message_id: str):
+    shard = 0
+    for candidate in range(1, SHARD_COUNT):
+        with shard_read_engines[candidate].connect() as connection:
+            if connection.scalar(_holds_message(message_id)) is not None:
+                shard = candidate
+                break
+    db = ShardSessionLocal[shard]()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_message_db(message_id: str):
+    shard = 0
+    for candidate in range(1, SHARD_COUNT):
+        async with async_shard_read_engines[candidate].connect() as connection:
+            if await connection.scalar(_holds_message(message_id)) is not None:
+                shard = candidate
+                break
+    async with AsyncShardSessionLocal[shard]() as db:
+        yield db
+
+
+def shard_session(db, shard: int):
+    # A write session on the shard; db itself for shard 0, which is the
+    # database the caller's session is on
+    return nullcontext(db) if shard == 0 else ShardSessionLocal[shard]()
+
+
+def async_shard_session(db, shard: int):
+    return nullcontext(db) if shard == 0 else AsyncShardSessionLocal[shard]()
+
+
+def users_session(db):
+    # Users live in shard 0 only, which a room-scoped db may not be on
+    return nullcontext(db) if SHARD_COUNT == 1 else ReadSessionLocal()
+
+
+def async_users_session(db):
+    return nullcontext(db) if SHARD_COUNT == 1 else AsyncReadSessionLocal()
+
+
+@contextmanager
+def each_shard(db):
+    # Read sessions on every shard, for queries spanning rooms, with the
+    # caller's session on the main database serving shard 0
+    sessions = [factory() for factory in ShardReadSessionLocal[1:]]
+    try:
+        yield [db, *sessions]
+    finally:
+        for session in sessions:
+            session.close()
+
+
+@asynccontextmanager
+async def async_each_shard(db):
+    sessions = [factory() for factory in AsyncShardReadSessionLocal[1:]]
+    try:
+        yield [db, *sessions]
+    finally:
+        for session in sessions:
+            await session.close()
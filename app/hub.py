@@ -0,0 +1,109 @@
+# hub.py
+import asyncio
+import os
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+# Events buffered per subscriber before it is considered too slow to keep up
+QUEUE_SIZE = int(os.getenv("ROOM_HUB_QUEUE_SIZE", default=256))
+
+
+class Subscription:
+    def __init__(self, room_id: str, maxsize: int):
+        self.room_id = room_id
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.lagged = False
+
+
+class RoomHub:
+    def __init__(self, queue_size: int = QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._rooms = {}
+        self._loop = None
+
+    def subscribe(self, room_id: str):
+        # Subscriptions live on the event loop; publishers in worker threads
+        # hand their events over to it
+        self._loop = asyncio.get_running_loop()
+        subscription = Subscription(room_id, self.queue_size)
+        self._rooms.setdefault(room_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._rooms.get(subscription.room_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._rooms[subscription.room_id]
+
+    def subscriber_count(self, room_id: str):
+        return len(self._rooms.get(room_id, ()))
+
+    def publish(self, room_id: str, event: dict):
+        # Safe to call from the sync controllers running in the threadpool
+        if self._loop is None or not self._rooms.get(room_id):
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._deliver, room_id, event)
+        except RuntimeError:
+            # The loop has been closed, nobody is listening any more
+            self._loop = None
+
+    def _deliver(self, room_id: str, event: dict):
+        for subscription in list(self._rooms.get(room_id, ())):
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._drop(subscription)
+
+    def _drop(self, subscription: Subscription):
+        # A full queue means the client is not reading; never block the
+        # broadcast on it. Its backlog is discarded and it is told to resync
+        # from the REST history before subscribing again
+        self.unsubscribe(subscription)
+        subscription.lagged = True
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(
+            {"type": "resync", "room_id": subscription.room_id}
+        )
+
+
+hub = RoomHub()
+
+
+async def _forward_events(websocket: WebSocket, subscription: Subscription):
+    while True:
+        event = await subscription.queue.get()
+        await websocket.send_json(event)
+        if subscription.lagged:
+            await websocket.close(code=1013)
+            return
+
+
+async def _wait_for_disconnect(websocket: WebSocket):
+    # Clients do not send anything meaningful; reading just notices hang-ups
+    # in quiet rooms instead of on the next broadcast
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
+
+async def stream_room(websocket: WebSocket, room_id: str):
+    await websocket.accept()
+    subscription = hub.subscribe(room_id)
+    tasks = [
+        asyncio.create_task(_forward_events(websocket, subscription)),
+        asyncio.create_task(_wait_for_disconnect(websocket)),
+    ]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                if not isinstance(task.exception(), WebSocketDisconnect):
+                    raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        hub.unsubscribe(subscription)
@@ -0,0 +1,224 @@
+# metrics.py
+import bisect
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+# Statements slower than this are written to the slow-query log
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", default=100))
+
+slow_query_log = logging.getLogger("app.slow_query")
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One slot per bucket plus the +Inf overflow
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.db_time = Histogram(LATENCY_BUCKETS)
+        self.statuses = {}
+
+
+class RequestStats:
+    def __init__(self, scope=None):
+        self.scope = scope or {}
+        self.statements = 0
+        self.db_seconds = 0.0
+
+    @property
+    def route(self):
+        # The router leaves the matched route in the scope; label by its path
+        # template so ids do not explode the label space
+        route = self.scope.get("route")
+        return route.path if route is not None else "unmatched"
+
+
+# Set per request by the middleware. Starlette copies the context into the
+# threadpool, so sync controllers and their SQL events see the same object
+_current_request = ContextVar("current_request", default=None)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._gauges = []
+
+    def record(self, method, route, status, seconds, stats: RequestStats):
+        with self._lock:
+            metrics = self._routes.get((method, route))
+            if metrics is None:
+                metrics = self._routes[(method, route)] = RouteMetrics()
+            metrics.latency.observe(seconds)
+            metrics.statements.observe(stats.statements)
+            metrics.db_time.observe(stats.db_seconds)
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+
+    def register_gauges(self, prefix, stats):
+        # stats() returns a dict; its numeric fields become gauges
+        self._gauges.append((prefix, stats))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            routes = sorted(self._routes.items())
+            self._render_histograms(
+                lines,
+                "http_request_duration_seconds",
+                "Request latency by route",
+                [(key, metrics.latency) for key, metrics in routes],
+            )
+            self._render_histograms(
+                lines,
+                "http_request_sql_statements",
+                "SQL statements executed per request",
+                [(key, metrics.statements) for key, metrics in routes],
+            )
+            self._render_histograms(
+                lines,
+                "http_request_db_seconds",
+                "Time spent in SQL per request",
+                [(key, metrics.db_time) for key, metrics in routes],
+            )
+
+            lines.append("# HELP chitchat_http_requests_total Requests by status")
+            lines.append("# TYPE chitchat_http_requests_total counter")
+            for (method, route), metrics in routes:
+                for status, count in sorted(metrics.statuses.items()):
+                    labels = _labels(method=method, route=route, status=status)
+                    lines.append(f"chitchat_http_requests_total{labels} {count}")
+
+        for prefix, stats in self._gauges:
+            for key, value in stats().items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"chitchat_{prefix}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _render_histograms(lines, name, help_text, histograms):
+        name = f"chitchat_{name}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for (method, route), histogram in histograms:
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                labels = _labels(method=method, route=route, le=bound)
+                lines.append(f"{name}_bucket{labels} {cumulative}")
+            labels = _labels(method=method, route=route, le="+Inf")
+            lines.append(f"{name}_bucket{labels} {histogram.count}")
+            labels = _labels(method=method, route=route)
+            lines.append(f"{name}_sum{labels} {histogram.sum}")
+            lines.append(f"{name}_count{labels} {histogram.count}")
+
+
+def _labels(**labels):
+    rendered = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        rendered.append(f'{key}="{value}"'.replace("\n", "\\n"))
+    return "{" + ",".join(rendered) + "}"
+
+
+registry = MetricsRegistry()
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats(scope)
+        token = _current_request.set(stats)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _current_request.reset(token)
+            registry.record(
+                scope["method"],
+                stats.route,
+                status,
+                time.perf_counter() - started,
+                stats,
+            )
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(
+        connection, cursor, statement, parameters, context, executemany
+    ):
+        # Kept on the statement's own execution context, which is dropped
+        # with it, so a statement that fails leaves nothing behind on the
+        # pooled connection
+        context.query_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(
+        connection, cursor, statement, parameters, context, executemany
+    ):
+        elapsed = time.perf_counter() - context.query_started
+
+        stats = _current_request.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_seconds += elapsed
+
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            slow_query_log.warning(
+                "slow query %.1f ms route=%s statement=%s parameters=%.500r",
+                elapsed * 1000,
+                stats.route if stats is not None else None,
+                " ".join(statement.split()),
+                parameters,
+            )
@@ -0,0 +1,92 @@
+# migrations
+#
+# Offline schema upgrades for SQLite files. create_all only ever adds
+# missing tables, so a change to an existing table's column types is made by
+# rebuilding the table: create a copy with the current schema, move the rows
+# over through the current column types, drop the old table and rename the
+# copy into place. Indexes and search triggers are put back by init_db.
+# New nullable or defaulted columns are added in place with ALTER TABLE.
+from sqlalchemy import insert
+from sqlalchemy.schema import CreateColumn
+
+from app.models.models import Base, UUIDKey, key_from_bytes
+from app.search import rebuild_search_index
+
+REBUILD_BATCH_SIZE = 5000
+
+
+def rebuild_table(connection, table, transform=None):
+    # transform(row) gets each stored row as a dict of raw values and returns
+    # the values to insert, which then go through the columns' bind types.
+    # Keys are handed to it as UUID strings however they were stored
+    rebuilt = table.to_metadata(Base.metadata, name=f"_rebuild_{table.name}")
+    try:
+        # Index names are global in SQLite; the originals go away with the old
+        # table and init_db recreates them
+        rebuilt.indexes.clear()
+        rebuilt.create(connection)
+
+        names = [column.name for column in table.columns]
+        key_columns = [
+            column.name for column in table.columns if isinstance(column.type, UUIDKey)
+        ]
+        rows = connection.exec_driver_sql(
+            f"SELECT {', '.join(names)} FROM {table.name} ORDER BY rowid"
+        )
+        copied = 0
+        while True:
+            batch = rows.fetchmany(REBUILD_BATCH_SIZE)
+            if not batch:
+                break
+            values = [dict(zip(names, row)) for row in batch]
+            for row in values:
+                for name in key_columns:
+                    if isinstance(row[name], bytes):
+                        row[name] = key_from_bytes(row[name])
+            if transform is not None:
+                values = [transform(row) for row in values]
+            connection.execute(insert(rebuilt), values)
+            copied += len(values)
+
+        connection.exec_driver_sql(f"DROP TABLE {table.name}")
+        connection.exec_driver_sql(
+            f"ALTER TABLE {rebuilt.name} RENAME TO {table.name}"
+        )
+        return copied
+    finally:
+        Base.metadata.remove(rebuilt)
+
+
+def add_missing_columns(connection, table):
+    # Returns the names of the columns added to the stored table
+    stored = {
+        row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table.name})")
+    }
+    added = []
+    for column in table.columns:
+        if column.name not in stored:
+            definition = CreateColumn(column).compile(dialect=connection.dialect)
+            connection.exec_driver_sql(
+                f"ALTER TABLE {table.name} ADD COLUMN {definition}"
+            )
+            added.append(column.name)
+    return added
+
+
+def finish_rebuild(engine):
+    # Dropping messages dropped its search triggers and the copy has new
+    # rowids: restore indexes and triggers, compact the file, then line the
+    # search index up with the table again (VACUUM may renumber rowids too)
+    from app.database import init_db
+
+    init_db()
+
+    # VACUUM cannot run inside the transaction the engine's begin event opens
+    raw = engine.raw_connection()
+    try:
+        raw.cursor().execute("VACUUM")
+    finally:
+        raw.close()
+
+    with engine.begin() as connection:
+        rebuild_search_index(connection)
@@ -0,0 +1,41 @@
+# compact_keys.py
+#
+# Rewrites every UUID key column of the database at DATABASE_URL, and of
+# its shards, into the storage selected by KEY_STORAGE, in either direction:
+#
+#   KEY_STORAGE=binary python -m app.migrations.compact_keys
+#
+# Stop the app first and start it again with the same KEY_STORAGE afterwards.
+import json
+
+from app.database import DATABASE_URL, init_db, shard_engines
+from app.migrations import finish_rebuild, rebuild_table
+from app.models.models import KEY_STORAGE, Base, UUIDKey
+
+
+def migrate():
+    # rebuild_table reads keys back as strings whatever their storage, and
+    # UUIDKey writes them out in the configured one. Older files are brought
+    # up to the current schema first, so every model column exists to copy
+    init_db()
+    copied = {}
+    for engine in shard_engines:
+        with engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                if any(isinstance(column.type, UUIDKey) for column in table.columns):
+                    rows = rebuild_table(connection, table)
+                    copied[table.name] = copied.get(table.name, 0) + rows
+        finish_rebuild(engine)
+    return copied
+
+
+if __name__ == "__main__":
+    if KEY_STORAGE not in ("text", "binary"):
+        raise SystemExit(f"Unknown KEY_STORAGE {KEY_STORAGE!r}")
+    rows = migrate()
+    print(
+        json.dumps(
+            {"database": DATABASE_URL, "key_storage": KEY_STORAGE, "rows": rows},
+            indent=2,
+        )
+    )
@@ -0,0 +1,55 @@
+# epoch_time.py
+#
+# Converts the time columns of messages and change_log from the old
+# "YYYY-MM-DD HH:MM:SS" text to integer epoch microseconds. init_db runs it
+# on startup when it finds a text column; it can also be run ahead of a
+# deploy, which additionally compacts the file:
+#
+#   python -m app.migrations.epoch_time
+import json
+
+from app.migrations import finish_rebuild, rebuild_table
+from app.models.models import Change, Message, parse_time
+
+TIME_TABLES = (Message.__table__, Change.__table__)
+
+
+def outdated_tables(connection):
+    if connection.dialect.name != "sqlite":
+        return []
+
+    outdated = []
+    for table in TIME_TABLES:
+        declared = {
+            row[1]: row[2].upper()
+            for row in connection.exec_driver_sql(f"PRAGMA table_info({table.name})")
+        }
+        if declared.get("time", "INTEGER") != "INTEGER":
+            outdated.append(table)
+    return outdated
+
+
+def _to_epoch(row):
+    if row["time"] is not None:
+        row["time"] = parse_time(row["time"])
+    return row
+
+
+def upgrade(connection):
+    # Returns the rows copied per rebuilt table; empty when already current.
+    # Run inside the caller's transaction, so concurrent workers starting up
+    # serialise on the write lock and only the first one rebuilds
+    return {
+        table.name: rebuild_table(connection, table, _to_epoch)
+        for table in outdated_tables(connection)
+    }
+
+
+if __name__ == "__main__":
+    from app.database import DATABASE_URL, engine
+
+    with engine.begin() as connection:
+        rows = upgrade(connection)
+    if rows:
+        finish_rebuild(engine)
+    print(json.dumps({"database": DATABASE_URL, "rows": rows}, indent=2))
@@ -0,0 +1,53 @@
+# inbox.py
+#
+# Adds the inbox columns: the last-message pointer on chat_rooms and the
+# read cursor and unread count on user_chat_room. Rooms are pointed at
+# their newest message and existing members start out caught up, so nobody
+# is shown their whole history as unread. init_db runs it on startup.
+from app.migrations import add_missing_columns
+from app.models.models import PREVIEW_LENGTH, ChatRoom, UserChatRoom
+
+BACKFILL_ROOMS = f"""
+UPDATE chat_rooms
+SET last_message_id = newest.id,
+    last_message_sender_id = newest.sender_id,
+    last_message_username = newest.username,
+    last_message_preview = substr(newest.content, 1, {PREVIEW_LENGTH}),
+    last_activity = newest.time
+FROM (
+    SELECT room_id, id, sender_id, username, content, time,
+           row_number() OVER (
+               PARTITION BY room_id ORDER BY time DESC, id DESC
+           ) AS position
+    FROM messages
+) AS newest
+WHERE newest.room_id = chat_rooms.id AND newest.position = 1
+"""
+
+BACKFILL_MEMBERS = """
+UPDATE user_chat_room
+SET last_read_time = chat_rooms.last_activity,
+    last_read_message_id = chat_rooms.last_message_id,
+    unread_count = 0
+FROM chat_rooms
+WHERE chat_rooms.id = user_chat_room.room_id
+"""
+
+
+def upgrade(connection):
+    # Returns the added columns per table; empty when already current. Runs
+    # in the caller's transaction like the other startup upgrades
+    if connection.dialect.name != "sqlite":
+        return {}
+
+    added = {}
+    for table in (ChatRoom.__table__, UserChatRoom.__table__):
+        columns = add_missing_columns(connection, table)
+        if columns:
+            added[table.name] = columns
+
+    if "chat_rooms" in added:
+        connection.exec_driver_sql(BACKFILL_ROOMS)
+    if "user_chat_room" in added:
+        connection.exec_driver_sql(BACKFILL_MEMBERS)
+    return added
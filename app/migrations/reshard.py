@@ -0,0 +1,155 @@
+# reshard.py
+#
+# Moves every room into the shard SHARD_COUNT routes it to, after the shard
+# count has changed: the room, its memberships, its messages and its change
+# log. Stop the app first and run it with the new count; when shrinking,
+# also pass the old one so the files beyond the new count are drained:
+#
+#   SHARD_COUNT=8 python -m app.migrations.reshard
+#   SHARD_COUNT=2 python -m app.migrations.reshard --from-count 8
+#
+# A room is copied into its new shard in one transaction and deleted from
+# the old one in the next. If a run stops in between, the next run finds
+# the room already in place and only deletes the leftover. Change log
+# entries are renumbered by the shard they land in, and a since from before
+# no longer has one entry per shard, so sync clients start over from 0.
+# Archived messages are stored per room, not per shard, and stay where
+# they are.
+import argparse
+import json
+import os
+
+from sqlalchemy import delete, exists, insert, literal_column, or_, select, union
+from sqlalchemy.engine import make_url
+
+from app.database import (
+    DATABASE_URL,
+    SHARD_COUNT,
+    _create_engine,
+    _shard_url,
+    init_db,
+    shard_engines,
+    shard_for,
+)
+from app.migrations import REBUILD_BATCH_SIZE
+from app.models.models import Change, ChatRoom, Message, UserChatRoom
+
+# Each table with the column naming a row's room. Copied in this order and
+# deleted in reverse
+ROOM_TABLES = (
+    (ChatRoom.__table__, ChatRoom.id),
+    (UserChatRoom.__table__, UserChatRoom.room_id),
+    (Message.__table__, Message.room_id),
+    (Change.__table__, Change.room_id),
+)
+
+
+def _rooms(connection):
+    # Every room with rows in this file, including messages whose room row
+    # is gone
+    return (
+        connection.execute(
+            union(
+                *(
+                    select(column).where(column.is_not(None))
+                    for _, column in ROOM_TABLES
+                )
+            )
+        )
+        .scalars()
+        .all()
+    )
+
+
+def _holds_room(connection, room_id: str):
+    return connection.execute(
+        select(or_(*(exists().where(column == room_id) for _, column in ROOM_TABLES)))
+    ).scalar()
+
+
+def _copy_room(reading, writing, room_id: str):
+    copied = {}
+    for table, column in ROOM_TABLES:
+        # In rowid order, so change log entries keep their order under their
+        # new sequence numbers; those are assigned by the target
+        renumbered = {
+            key.name for key in table.primary_key.columns if key.autoincrement is True
+        }
+        rows = reading.execute(
+            select(table)
+            .where(column == room_id)
+            .order_by(literal_column("rowid"))
+        )
+        copied[table.name] = 0
+        for batch in rows.partitions(REBUILD_BATCH_SIZE):
+            values = [
+                {
+                    name: value
+                    for name, value in row._mapping.items()
+                    if name not in renumbered
+                }
+                for row in batch
+            ]
+            writing.execute(insert(table), values)
+            copied[table.name] += len(values)
+    return copied
+
+
+def _move_room(source, target, room_id: str):
+    copied = {}
+    with source.connect() as reading, target.begin() as writing:
+        if not _holds_room(writing, room_id):
+            copied = _copy_room(reading, writing, room_id)
+
+    with source.begin() as connection:
+        for table, column in reversed(ROOM_TABLES):
+            connection.execute(delete(table).where(column == room_id))
+    return copied
+
+
+def migrate(from_count: int = SHARD_COUNT):
+    # Returns the rooms moved and the rows copied per table
+    init_db()
+    sources = list(enumerate(shard_engines))
+    for shard in range(SHARD_COUNT, from_count):
+        url = _shard_url(DATABASE_URL, shard)
+        if os.path.exists(make_url(url).database):
+            sources.append((shard, _create_engine(url)))
+
+    moved = {"rooms": 0}
+    for shard, source in sources:
+        with source.connect() as connection:
+            rooms = _rooms(connection)
+        for room_id in rooms:
+            target = shard_for(room_id)
+            if target == shard:
+                continue
+            copied = _move_room(source, shard_engines[target], room_id)
+            for table, rows in copied.items():
+                moved[table] = moved.get(table, 0) + rows
+            moved["rooms"] += 1
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--from-count", type=int, default=SHARD_COUNT)
+    args = parser.parse_args()
+
+    moved = migrate(args.from_count)
+    drained = [
+        make_url(_shard_url(DATABASE_URL, shard)).database
+        for shard in range(SHARD_COUNT, args.from_count)
+    ]
+    print(
+        json.dumps(
+            {
+                "database": DATABASE_URL,
+                "shards": SHARD_COUNT,
+                "moved": moved,
+                # Empty now, and safe to delete
+                "drained": drained,
+            },
+            indent=2,
+        )
+    )
@@ -1,16 +1,117 @@
 import datetime
+import os
+import time
 import uuid
-from sqlalchemy import Column, ForeignKey, String
+from sqlalchemy import (
+    Column,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    String,
+    TypeDecorator,
+    text,
+)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
 Base = declarative_base()
 
 
+# How UUID keys are stored: "text" (36-character strings) or "binary" (16-byte
+# blobs). The application sees UUID strings either way
+KEY_STORAGE = os.getenv("KEY_STORAGE", default="text").lower()
+
+# Changes that alter a room's member list, and so every member's room list
+MEMBERSHIP_CHANGES = "kind IN ('room.created', 'member.added')"
+
+# Characters of the newest message kept on its room for the inbox
+PREVIEW_LENGTH = int(os.getenv("PREVIEW_LENGTH", default=100))
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def message_time():
+    # Stored as integer microseconds since the Unix epoch (UTC)
+    return time.time_ns() // 1000
+
+
+def format_time(micros):
+    # The public form: "YYYY-MM-DD HH:MM:SS.ffffff" in UTC. Fixed width, so
+    # it sorts like the integer it came from
+    return (_EPOCH + micros * _MICROSECOND).isoformat(sep=" ", timespec="microseconds")
+
+
+def parse_time(value):
+    # Accepts the public form, with or without the fraction as older
+    # responses and cursors had it, and returns epoch microseconds
+    if isinstance(value, int):
+        return value
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (parsed - _EPOCH) // _MICROSECOND
+
+
+def message_preview(content):
+    return content[:PREVIEW_LENGTH] if content is not None else None
+
+
+def key_to_bytes(value):
+    # Hand-rolled rather than uuid.UUID(): this runs for every key bound in
+    # every query and is several times faster
+    if len(value) == 36 and value[8] == value[13] == value[18] == value[23] == "-":
+        try:
+            key = bytes.fromhex(value.replace("-", ""))
+        except ValueError:
+            key = None
+        if key is not None and len(key) == 16:
+            return key
+    # Not a UUID, so it can never equal a stored key; kept as its UTF-8
+    # bytes so lookups simply miss and the value still round-trips
+    return value.encode()
+
+
+def key_from_bytes(value):
+    if len(value) != 16:
+        return value.decode()
+    digits = value.hex()
+    return (
+        f"{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}"
+    )
+
+
+class UUIDKey(TypeDecorator):
+    # Primary and foreign keys. In binary mode every index and join over a
+    # key compares 16 bytes instead of 36; the byte order of a UUID matches
+    # the order of its hex string, so keyset pagination is unchanged
+    impl = String
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if KEY_STORAGE == "binary":
+            return dialect.type_descriptor(LargeBinary(16))
+        return dialect.type_descriptor(String())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or KEY_STORAGE != "binary":
+            return value
+        return key_to_bytes(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or KEY_STORAGE != "binary":
+            return value
+        return key_from_bytes(value)
+
+
 class User(Base):
     __tablename__ = "users"
 
-    id = Column(String, primary_key=True, index=True, default=lambda: str(uuid.uuid4()))
+    id = Column(
+        UUIDKey, primary_key=True, index=True, default=lambda: str(uuid.uuid4())
+    )
     username = Column(String, index=True)
     email = Column(String, unique=True, index=True)
     password = Column(String)
@@ -36,9 +137,18 @@ class User(Base):
 class ChatRoom(Base):
     __tablename__ = "chat_rooms"
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(UUIDKey, primary_key=True, default=lambda: str(uuid.uuid4()))
     name = Column(String, index=True)
 
+    # The newest message, kept up to date by the message writes so the inbox
+    # never has to look into messages
+    last_message_id = Column(UUIDKey)
+    last_message_sender_id = Column(UUIDKey)
+    last_message_username = Column(String)
+    last_message_preview = Column(String)
+    # Time of the newest message, or of creation while there is none
+    last_activity = Column(Integer, default=message_time, server_default=text("0"))
+
     # Define a relationship with the User model
     users = relationship("User", secondary="user_chat_room", overlaps="rooms")
 
@@ -49,27 +159,49 @@ class ChatRoom(Base):
         self.name = name
 
     def __repr__(self):
-        return f"id={self.id}, name={self.name}, users={self.users}"
+        # Column values only; touching self.users here would load the members
+        return f"id={self.id}, name={self.name}"
 
 
 class UserChatRoom(Base):
     __tablename__ = "user_chat_room"
+    __table_args__ = (
+        # A room's members: the unread counters every message write updates,
+        # and the member lists of room pages. The primary key leads with
+        # user_id, so without this each of those scans the table
+        Index("ix_user_chat_room_room_id", "room_id", "user_id"),
+    )
+
+    user_id = Column(UUIDKey, ForeignKey("users.id"), primary_key=True)
+    room_id = Column(UUIDKey, ForeignKey("chat_rooms.id"), primary_key=True)
 
-    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
-    room_id = Column(String, ForeignKey("chat_rooms.id"), primary_key=True)
+    # Read cursor: (time, id) of the newest message the member has read, in
+    # history order. unread_count is maintained alongside it by the writes
+    last_read_time = Column(Integer, server_default=text("0"))
+    last_read_message_id = Column(UUIDKey)
+    unread_count = Column(Integer, server_default=text("0"))
 
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Keyset pagination over a room's history seeks on this index
+        Index("ix_messages_room_id_time_id", "room_id", "time", "id"),
+        # GET /messages pages through every room in time order
+        Index("ix_messages_time_id", "time", "id"),
+        # A user's newest messages for their profile, and counting them.
+        # Supersedes the single-column sender_id index
+        Index("ix_messages_sender_id_time_id", "sender_id", "time", "id"),
+    )
 
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(UUIDKey, primary_key=True, default=lambda: str(uuid.uuid4()))
 
-    sender_id = Column(String, ForeignKey("users.id"), index=True)
+    sender_id = Column(UUIDKey, ForeignKey("users.id"))
     content = Column(String)
     username = Column(String, ForeignKey("users.username"), index=True)
-    time = Column(String)
+    time = Column(Integer)
     room_id = Column(
-        String, ForeignKey("chat_rooms.id"), default=lambda: str(uuid.uuid4())
+        UUIDKey, ForeignKey("chat_rooms.id"), default=lambda: str(uuid.uuid4())
     )
 
     # Define a relationship with the ChatRoom model
@@ -86,6 +218,63 @@ class Message(Base):
         self.sender_id = sender_id
         self.username = username
         self.content = content
-        self.time = time or datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        self.time = time or message_time()
         self.uuid = custom_uuid or str(uuid.uuid4())
         self.room_id = room_id or str(uuid.uuid4())
+
+
+class ArchivedMessage(Base):
+    # What stays in the database of a message moved to the archive: enough
+    # to count a sender's messages and to tell an archived id from an
+    # unknown one. The content lives in the archive segments only
+    __tablename__ = "archived_messages"
+    __table_args__ = (
+        Index("ix_archived_messages_sender_id", "sender_id"),
+    )
+
+    id = Column(UUIDKey, primary_key=True)
+    room_id = Column(UUIDKey)
+    sender_id = Column(UUIDKey)
+
+
+class Change(Base):
+    __tablename__ = "change_log"
+    __table_args__ = (
+        # Delta sync reads a room's changes after a given sequence number
+        Index("ix_change_log_room_id_seq", "room_id", "seq"),
+        # Partial index over the few membership changes, for room-list ETags.
+        # Carrying kind makes it covering, so the planner always prefers it
+        Index(
+            "ix_change_log_membership",
+            "room_id",
+            "seq",
+            "kind",
+            sqlite_where=text(MEMBERSHIP_CHANGES),
+        ),
+        # AUTOINCREMENT so sequence numbers are never reused, even after the
+        # newest rows are deleted
+        {"sqlite_autoincrement": True},
+    )
+
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    room_id = Column(UUIDKey, ForeignKey("chat_rooms.id"))
+    kind = Column(String)
+    entity_id = Column(UUIDKey)
+    payload = Column(String)
+    time = Column(Integer)
+
+    def __init__(self, room_id, kind, entity_id, payload, time=None):
+        self.room_id = room_id
+        self.kind = kind
+        self.entity_id = entity_id
+        self.payload = payload
+        self.time = time or message_time()
+
+
+class ChangeLogHorizon(Base):
+    # One row: the newest seq pruned from change_log. A sync from before it
+    # may have missed changes that are gone, so it has to start over
+    __tablename__ = "change_log_horizon"
+
+    id = Column(Integer, primary_key=True)
+    pruned_through = Column(Integer)
@@ -0,0 +1,24 @@
+# pagination.py
+import base64
+import binascii
+import json
+
+from fastapi.exceptions import HTTPException
+
+
+def encode_cursor(*values):
+    # Cursors are opaque to clients: the sort key of the last row they saw
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int = 2):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, ValueError) as e:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from e
+
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
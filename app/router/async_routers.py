@@ -0,0 +1,213 @@
+# async_routers.py
+from typing import List, Optional
+from fastapi import APIRouter, Depends, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.controllers.async_controllers import (
+    create_message,
+    get_messages,
+    get_messages_by_room,
+    get_messages_by_room_cursor,
+    delete_message,
+    update_message,
+    create_chat_room,
+    add_user_to_room,
+    create_user,
+    get_chat_rooms,
+    get_inbox,
+    mark_room_read,
+    membership_version,
+    read_user,
+    room_version,
+)
+from app.schema.schemas import (
+    GetMessageResponse,
+    MessageCreate,
+    MessageResponse,
+    UpdateMessage,
+    UpdateMessageResponse,
+    UserResponse,
+    ChatRoomCreate,
+    UserCreate,
+    ChatRoomResponse,
+    UserChatRoomResponse,
+    AllChatRoomResponse,
+    SignInResponse,
+    DeleteMessageResponse,
+    InboxRoomResponse,
+    MarkRead,
+    ReadStateResponse,
+)
+from app.admission import admit_message_write, admit_write
+from app.auth import current_user_id, ensure_self, ensure_sender, password_hasher
+from app.responses import not_modified, trusted
+from app.database import (
+    get_async_db,
+    get_async_message_db,
+    get_async_read_db,
+    get_async_room_db,
+    get_async_room_read_db,
+)
+
+# Same paths as app.router.routers. When USE_ASYNC_DB is set this router is
+# included first, so these routes take precedence and everything else falls
+# through to the sync router.
+async_router = APIRouter()
+
+
+@async_router.post("/auth/sign-up", response_model=UserResponse)
+async def create_users(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
+    password = await password_hasher.hash(user.password)
+    user = UserCreate(username=user.username, email=user.email, password=password)
+    return await create_user(db, user)
+
+
+@async_router.get(
+    "/auth/sign-in/{email}", response_model=SignInResponse, deprecated=True
+)
+async def read_users(email: str, db: AsyncSession = Depends(get_async_read_db)):
+    return await read_user(db, email)
+
+
+@async_router.post(
+    "/chat-room",
+    response_model=ChatRoomResponse,
+    dependencies=[Depends(admit_write)],
+)
+async def create_chat_rooms(
+    room: ChatRoomCreate, db: AsyncSession = Depends(get_async_db)
+):
+    return await create_chat_room(db, room)
+
+
+@async_router.post(
+    "/users/{user_id}/rooms/{room_id}",
+    response_model=UserChatRoomResponse,
+    dependencies=[Depends(admit_write)],
+)
+async def add_user_to_rooms(
+    user_id: str, room_id: str, db: AsyncSession = Depends(get_async_room_db)
+):
+    return await add_user_to_room(db, user_id, room_id)
+
+
+@async_router.post(
+    "/messages/{room_id}",
+    response_model=MessageResponse,
+    dependencies=[Depends(admit_message_write)],
+)
+async def create_messages(
+    message: MessageCreate,
+    room_id: str,
+    db: AsyncSession = Depends(get_async_room_db),
+    user_id: Optional[str] = Depends(current_user_id),
+):
+    ensure_sender(user_id, [message.sender_id])
+    return await create_message(db, message, room_id)
+
+
+@async_router.get("/user/rooms/{user_id}", response_model=List[AllChatRoomResponse])
+async def get_chat_room(
+    user_id: str,
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_read_db),
+    signed_in: Optional[str] = Depends(current_user_id),
+):
+    ensure_self(signed_in, user_id)
+    etag = f'"rooms-{await membership_version(db, user_id)}"'
+    cached = not_modified(request, response, etag)
+    if cached:
+        return cached
+    return trusted(await get_chat_rooms(db, user_id), headers=response.headers)
+
+
+@async_router.get("/users/{user_id}/inbox", response_model=List[InboxRoomResponse])
+async def read_inbox(
+    user_id: str,
+    db: AsyncSession = Depends(get_async_read_db),
+    signed_in: Optional[str] = Depends(current_user_id),
+):
+    ensure_self(signed_in, user_id)
+    return trusted(await get_inbox(db, user_id))
+
+
+@async_router.post(
+    "/users/{user_id}/rooms/{room_id}/read",
+    response_model=ReadStateResponse,
+    dependencies=[Depends(admit_write)],
+)
+async def mark_read(
+    user_id: str,
+    room_id: str,
+    read: Optional[MarkRead] = None,
+    db: AsyncSession = Depends(get_async_room_db),
+    signed_in: Optional[str] = Depends(current_user_id),
+):
+    ensure_self(signed_in, user_id)
+    message_id = read.message_id if read else None
+    return await mark_room_read(db, user_id, room_id, message_id)
+
+
+@async_router.get("/messages/{room_id}")
+async def read_messages(
+    room_id: str,
+    request: Request,
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: bool = False,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_room_read_db),
+):
+    # Any change to the room moves its version, whichever page this is
+    etag = f'"room-{await room_version(db, room_id)}"'
+    cached = not_modified(request, response, etag)
+    if cached:
+        return cached
+
+    if cursor or before or after:
+        return trusted(
+            await get_messages_by_room_cursor(
+                db, room_id, limit=limit, before=before, after=after
+            ),
+            headers=response.headers,
+        )
+    return trusted(
+        await get_messages_by_room(db, room_id, skip=skip, limit=limit),
+        headers=response.headers,
+    )
+
+
+@async_router.get("/messages", response_model=list[GetMessageResponse])
+async def read_all_messages(
+    skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_async_read_db)
+):
+    return trusted(await get_messages(db, skip=skip, limit=limit))
+
+
+@async_router.delete(
+    "/messages/{message_id}",
+    response_model=DeleteMessageResponse,
+    dependencies=[Depends(admit_write)],
+)
+async def delete_messages(
+    message_id: str,
+    db: AsyncSession = Depends(get_async_message_db),
+    user_id: Optional[str] = Depends(current_user_id),
+):
+    return await delete_message(db, message_id, user_id)
+
+
+@async_router.put(
+    "/messages/{message_id}",
+    response_model=UpdateMessageResponse,
+    dependencies=[Depends(admit_write)],
+)
+async def edit_message(
+    message_id: str,
+    new_message: UpdateMessage,
+    db: AsyncSession = Depends(get_async_message_db),
+    user_id: Optional[str] = Depends(current_user_id),
+):
+    return await update_message(db, message_id, new_message, user_id)
@@ -1,11 +1,16 @@
 # routers.py
-from typing import List
-from fastapi import APIRouter, Depends
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, WebSocket
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from sqlalchemy.orm import Session
 from app.controllers.controllers import (
+    PROFILE_RECENT,
     create_message,
+    create_messages_batch,
     get_messages,
     get_messages_by_room,
+    get_messages_by_room_cursor,
     delete_message,
     get_user,
     read_user_by_id,
@@ -14,7 +19,16 @@ from app.controllers.controllers import (
     add_user_to_room,
     create_user,
     get_chat_rooms,
+    read_credentials,
     read_user,
+    set_password,
+    search_messages,
+    export_room_messages,
+    get_changes,
+    get_inbox,
+    mark_room_read,
+    membership_version,
+    room_version,
 )
 from app.schema.schemas import (
     GetMessageResponse,
@@ -30,74 +44,350 @@ from app.schema.schemas import (
     AllChatRoomResponse,
     SignInResponse,
     SignIn,
+    TokenResponse,
+    InboxRoomResponse,
+    MarkRead,
+    ReadStateResponse,
 )
-from app.database import get_db
+from app.admission import (
+    admission,
+    admit_batch_write,
+    admit_message_write,
+    admit_write,
+)
+from app.archive import message_archive
+from app.broker import broker
+from app.auth import (
+    auth_stats,
+    current_user_id,
+    ensure_self,
+    ensure_sender,
+    ensure_user_scope,
+    issue_token,
+    needs_rehash,
+    password_hasher,
+)
+from app.responses import not_modified, trusted
+from app.database import (
+    get_db,
+    get_message_db,
+    get_read_db,
+    get_room_db,
+    get_room_read_db,
+)
+from app.cache import room_cache, user_cache
+from app.hub import stream_room
+from app.metrics import registry
+from app.writer import group_writer
 from app.schema.schemas import DeleteMessageResponse
 
 router = APIRouter()
 
 
 @router.post("/auth/sign-up", response_model=UserResponse)
-def create_users(user: UserCreate, db: Session = Depends(get_db)):
-    return create_user(db, user)
+async def create_users(user: UserCreate, db: Session = Depends(get_db)):
+    # Hashed in the auth process pool, stored from the threadpool
+    password = await password_hasher.hash(user.password)
+    user = UserCreate(username=user.username, email=user.email, password=password)
+    return await run_in_threadpool(create_user, db, user)
+
 
+@router.post("/auth/sign-in", response_model=TokenResponse)
+async def sign_in(credentials: SignIn, db: Session = Depends(get_read_db)):
+    user = await run_in_threadpool(read_credentials, db, credentials.email)
+    if user is None or not await password_hasher.verify(
+        credentials.password, user.password
+    ):
+        raise HTTPException(status_code=401, detail="Incorrect email or password")
 
-@router.get("/auth/sign-in/{email}", response_model=SignInResponse)
-def read_users(email: str, db: Session = Depends(get_db)):
+    if needs_rehash(user.password):
+        # Plaintext from before hashing, or an outdated cost
+        password = await password_hasher.hash(credentials.password)
+        await run_in_threadpool(set_password, user.id, password)
+
+    token, expires = issue_token(user.id)
+    return {
+        "access_token": token,
+        "token_type": "bearer",
+        "expires_at": expires,
+        "user": {"id": user.id, "username": user.username, "email": user.email},
+    }
+
+
+@router.get(
+    "/auth/sign-in/{email}", response_model=SignInResponse, deprecated=True
+)
+def read_users(email: str, db: Session = Depends(get_read_db)):
+    # Looks the account up only; passwords are checked by POST /auth/sign-in
     return read_user(db, email)
 
 
 @router.get("/user/{email}")
-def get_current_user(email: str, db: Session = Depends(get_db)):
-    return get_user(db, email)
+def get_current_user(
+    email: str, recent: int = PROFILE_RECENT, db: Session = Depends(get_read_db)
+):
+    return get_user(db, email, recent)
 
 
-@router.get("/user/{id}")
-def get_user_by_id(id: str, db: Session = Depends(get_db)):
-    return read_user_by_id(db, id)
+# Under /users: "/user/{id}" could never match, "/user/{email}" took every id
+@router.get("/users/{user_id}")
+def get_user_by_id(
+    user_id: str, recent: int = PROFILE_RECENT, db: Session = Depends(get_read_db)
+):
+    return read_user_by_id(db, user_id, recent)
 
 
-@router.post("/chat-room", response_model=ChatRoomResponse)
+@router.post(
+    "/chat-room",
+    response_model=ChatRoomResponse,
+    dependencies=[Depends(admit_write)],
+)
 def create_chat_rooms(room: ChatRoomCreate, db: Session = Depends(get_db)):
     return create_chat_room(db, room)
 
 
-@router.post("/users/{user_id}/rooms/{room_id}", response_model=UserChatRoomResponse)
-def add_user_to_rooms(user_id: str, room_id: str, db: Session = Depends(get_db)):
+@router.post(
+    "/users/{user_id}/rooms/{room_id}",
+    response_model=UserChatRoomResponse,
+    dependencies=[Depends(admit_write)],
+)
+def add_user_to_rooms(user_id: str, room_id: str, db: Session = Depends(get_room_db)):
     return add_user_to_room(db, user_id, room_id)
 
 
-@router.post("/messages/{room_id}", response_model=MessageResponse)
-def create_messages(
-    message: MessageCreate, room_id: str, db: Session = Depends(get_db)
+@router.post(
+    "/messages/{room_id}",
+    response_model=MessageResponse,
+    dependencies=[Depends(admit_message_write)],
+)
+async def create_messages(
+    message: MessageCreate,
+    room_id: str,
+    db: Session = Depends(get_room_db),
+    user_id: Optional[str] = Depends(current_user_id),
 ):
-    return create_message(db, message, room_id)
+    ensure_sender(user_id, [message.sender_id])
+    if group_writer.running:
+        # Committed together with other waiting messages
+        return await group_writer.write(message, room_id)
+    return await run_in_threadpool(create_message, db, message, room_id)
+
+
+@router.post(
+    "/messages/{room_id}/batch",
+    response_model=List[MessageResponse],
+    dependencies=[Depends(admit_batch_write)],
+)
+def create_messages_in_batch(
+    messages: List[MessageCreate],
+    room_id: str,
+    db: Session = Depends(get_room_db),
+    user_id: Optional[str] = Depends(current_user_id),
+):
+    ensure_sender(user_id, [message.sender_id for message in messages])
+    return trusted(create_messages_batch(db, messages, room_id))
 
 
 @router.get("/user/rooms/{user_id}", response_model=List[AllChatRoomResponse])
-def get_chat_room(user_id: str, db: Session = Depends(get_db)):
-    return get_chat_rooms(db, user_id)
+def get_chat_room(
+    user_id: str,
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_read_db),
+    signed_in: Optional[str] = Depends(current_user_id),
+):
+    ensure_self(signed_in, user_id)
+    etag = f'"rooms-{membership_version(db, user_id)}"'
+    cached = not_modified(request, response, etag)
+    if cached:
+        return cached
+    return trusted(get_chat_rooms(db, user_id), headers=response.headers)
+
+
+@router.get("/users/{user_id}/inbox", response_model=List[InboxRoomResponse])
+def read_inbox(
+    user_id: str,
+    db: Session = Depends(get_read_db),
+    signed_in: Optional[str] = Depends(current_user_id),
+):
+    ensure_self(signed_in, user_id)
+    return trusted(get_inbox(db, user_id))
+
+
+@router.post(
+    "/users/{user_id}/rooms/{room_id}/read",
+    response_model=ReadStateResponse,
+    dependencies=[Depends(admit_write)],
+)
+def mark_read(
+    user_id: str,
+    room_id: str,
+    read: Optional[MarkRead] = None,
+    db: Session = Depends(get_room_db),
+    signed_in: Optional[str] = Depends(current_user_id),
+):
+    ensure_self(signed_in, user_id)
+    return mark_room_read(db, user_id, room_id, read.message_id if read else None)
 
 
 @router.get("/messages/{room_id}")
 def read_messages(
-    room_id: str, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)
+    room_id: str,
+    request: Request,
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: bool = False,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    db: Session = Depends(get_room_read_db),
 ):
-    return get_messages_by_room(db, room_id, skip=skip, limit=limit)
+    # Any change to the room moves its version, whichever page this is
+    etag = f'"room-{room_version(db, room_id)}"'
+    cached = not_modified(request, response, etag)
+    if cached:
+        return cached
+
+    if cursor or before or after:
+        return trusted(
+            get_messages_by_room_cursor(
+                db, room_id, limit=limit, before=before, after=after
+            ),
+            headers=response.headers,
+        )
+    return trusted(
+        get_messages_by_room(db, room_id, skip=skip, limit=limit),
+        headers=response.headers,
+    )
 
 
 @router.get("/messages", response_model=list[GetMessageResponse])
-def read_messages(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return get_messages(db, skip=skip, limit=limit)
+def read_messages(skip: int = 0, limit: int = 100, db: Session = Depends(get_read_db)):
+    return trusted(get_messages(db, skip=skip, limit=limit))
+
+
+@router.get("/rooms/{room_id}/export")
+def export_room(
+    room_id: str, gzip: bool = False, db: Session = Depends(get_room_read_db)
+):
+    chunks = export_room_messages(db, room_id, compress=gzip)
+    filename = f"room-{room_id}.ndjson" + (".gz" if gzip else "")
+    return StreamingResponse(
+        chunks,
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 
-@router.delete("/messages/{message_id}", response_model=DeleteMessageResponse)
-def delete_messages(message_id: str, db: Session = Depends(get_db)):
-    return delete_message(db, message_id)
+@router.get("/search", dependencies=[Depends(ensure_user_scope)])
+def search(
+    q: str,
+    room_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+):
+    """Full-text search over messages still in the database.
+
+    Messages moved to the archive are not searched; they remain readable
+    through room history and export only. Searching by user_id takes being
+    signed in as that user.
+    """
+    return trusted(
+        search_messages(
+            db, q, room_id=room_id, user_id=user_id, limit=limit, cursor=cursor
+        )
+    )
+
+
+@router.get("/sync")
+def sync(
+    user_id: str,
+    since: str = "0",
+    limit: int = 100,
+    db: Session = Depends(get_read_db),
+    signed_in: Optional[str] = Depends(current_user_id),
+):
+    """Changes in the user's rooms after `since`, oldest first.
+
+    A `since` older than the retained change log is answered with 410 and
+    a fresh `next_since`: the client reloads its rooms and resumes from it.
+    """
+    ensure_self(signed_in, user_id)
+    return trusted(get_changes(db, user_id, since=since, limit=limit))
 
 
-@router.put("/messages/{message_id}", response_model=UpdateMessageResponse)
+@router.delete(
+    "/messages/{message_id}",
+    response_model=DeleteMessageResponse,
+    dependencies=[Depends(admit_write)],
+)
+def delete_messages(
+    message_id: str,
+    db: Session = Depends(get_message_db),
+    user_id: Optional[str] = Depends(current_user_id),
+):
+    return delete_message(db, message_id, user_id)
+
+
+@router.put(
+    "/messages/{message_id}",
+    response_model=UpdateMessageResponse,
+    dependencies=[Depends(admit_write)],
+)
 def edit_message(
-    message_id: str, new_message: UpdateMessage, db: Session = Depends(get_db)
+    message_id: str,
+    new_message: UpdateMessage,
+    db: Session = Depends(get_message_db),
+    user_id: Optional[str] = Depends(current_user_id),
 ):
-    return update_message(db, message_id, new_message)
+    return update_message(db, message_id, new_message, user_id)
+
+
+@router.get("/stats/group-commit")
+def group_commit_stats():
+    return group_writer.stats()
+
+
+@router.get("/stats/user-cache")
+def user_cache_stats():
+    return user_cache.stats()
+
+
+@router.get("/stats/room-cache")
+def room_cache_stats():
+    return room_cache.stats()
+
+
+@router.get("/stats/auth")
+def auth_pool_stats():
+    return auth_stats()
+
+
+@router.get("/stats/admission")
+def admission_stats():
+    return admission.stats()
+
+
+@router.get("/stats/broker")
+def broker_stats():
+    return broker.stats()
+
+
+@router.get("/stats/archive")
+def archive_stats():
+    return message_archive.stats()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@router.websocket("/ws/rooms/{room_id}")
+async def room_events(websocket: WebSocket, room_id: str):
+    await stream_room(websocket, room_id)
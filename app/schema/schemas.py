@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
 
 
@@ -16,13 +16,20 @@ class UserResponse(BaseModel):
 
 class SignIn(BaseModel):
     email: str
+    password: str
 
 
 class SignInResponse(BaseModel):
     id: str
     username: str
     email: str
-    password: str
+
+
+class TokenResponse(BaseModel):
+    access_token: str
+    token_type: str
+    expires_at: int
+    user: UserResponse
 
 
 class ChatRoomCreate(BaseModel):
@@ -47,6 +54,34 @@ class UserChatRoomResponse(BaseModel):
     room_id: str
 
 
+class LastMessagePreview(BaseModel):
+    id: str
+    sender_id: str
+    username: Optional[str]
+    preview: Optional[str]
+
+
+class InboxRoomResponse(BaseModel):
+    id: str
+    name: str
+    last_activity: str
+    last_message: Optional[LastMessagePreview]
+    unread_count: int
+    last_read_message_id: Optional[str]
+
+
+class MarkRead(BaseModel):
+    # Defaults to the newest message in the room
+    message_id: Optional[str] = None
+
+
+class ReadStateResponse(BaseModel):
+    user_id: str
+    room_id: str
+    last_read_message_id: Optional[str]
+    unread_count: int
+
+
 class MessageCreate(BaseModel):
     content: str
     sender_id: str
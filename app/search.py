@@ -0,0 +1,124 @@
+# search.py
+import os
+
+from sqlalchemy import column, func, literal_column, table, text
+from sqlalchemy.exc import DatabaseError
+
+# External-content FTS5 index over messages.content. It stores only the
+# index; snippets are read back from the messages table through its rowid
+messages_fts = table("messages_fts", column("rowid"))
+
+_FTS_TABLE = literal_column("messages_fts")
+
+# Check at startup that the index still lines up with messages. Reads the
+# whole index, about half a second per 200k messages; turn off for very
+# large files and run check_search_index from maintenance instead
+SEARCH_INDEX_CHECK = os.getenv("SEARCH_INDEX_CHECK", default="true").lower() in (
+    "1",
+    "true",
+)
+
+SEARCH_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content,
+        content='messages',
+        content_rowid='rowid',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    # The triggers cover every write path: ORM, executemany batches and the
+    # group-commit writer
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+    BEGIN
+        INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+    BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content)
+        VALUES ('delete', old.rowid, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content
+    ON messages
+    BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, content)
+        VALUES ('delete', old.rowid, old.content);
+        INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content);
+    END
+    """,
+]
+
+
+def install_search_index(connection):
+    if connection.dialect.name != "sqlite":
+        return
+
+    exists = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")
+    ).first()
+    for statement in SEARCH_DDL:
+        connection.execute(text(statement))
+    if not exists:
+        # Index the history written before search was installed
+        rebuild_search_index(connection)
+
+
+def rebuild_search_index(connection):
+    connection.execute(
+        text("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    )
+
+
+def check_search_index(connection):
+    # messages has no INTEGER PRIMARY KEY, so a VACUUM, from here or from
+    # the sqlite3 shell, may renumber its rowids and leave the index
+    # pointing at the wrong messages. FTS5's integrity check with rank 1
+    # compares the index against the table; on a mismatch it is rebuilt.
+    # Returns whether it had to be
+    if connection.dialect.name != "sqlite":
+        return False
+    try:
+        with connection.begin_nested():
+            connection.execute(
+                text(
+                    "INSERT INTO messages_fts (messages_fts, rank) "
+                    "VALUES ('integrity-check', 1)"
+                )
+            )
+    except DatabaseError:
+        rebuild_search_index(connection)
+        return True
+    return False
+
+
+def match_expression(query: str):
+    # Every term is quoted so user input can never be parsed as FTS5 syntax
+    # (column filters, NEAR, unbalanced quotes...). A trailing * keeps its
+    # meaning as a prefix search
+    terms = []
+    for term in query.split():
+        prefix = term.endswith("*")
+        term = term.rstrip("*")
+        if not term:
+            continue
+        quoted = '"' + term.replace('"', '""') + '"'
+        terms.append(quoted + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def matches(expression: str):
+    return _FTS_TABLE.op("MATCH")(expression)
+
+
+def score():
+    # bm25 is lower for better matches
+    return func.bm25(_FTS_TABLE)
+
+
+def snippet(tokens: int = 12):
+    return func.snippet(_FTS_TABLE, 0, "[", "]", "…", tokens)
@@ -0,0 +1,161 @@
+# writer.py
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+GROUP_COMMIT = os.getenv("GROUP_COMMIT", default="false").lower() in ("1", "true")
+# Flush when this many messages are waiting...
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", default=256))
+# ...or when the oldest waiting message has waited this long
+GROUP_COMMIT_MAX_DELAY_MS = float(os.getenv("GROUP_COMMIT_MAX_DELAY_MS", default=5))
+
+_STOP = object()
+
+log = logging.getLogger("app.writer")
+
+
+class GroupCommitWriter:
+    def __init__(self, max_batch: int, max_delay_ms: float):
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._session_factory = None
+        self._flush = None
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._batches = 0
+        self._messages = 0
+        self._errors = 0
+        self._largest_batch = 0
+        self._flush_seconds = 0.0
+        self._max_flush_seconds = 0.0
+        self._wait_seconds = 0.0
+
+    @property
+    def running(self):
+        # A writer whose thread has died must not be queued into: nothing
+        # would ever resolve the futures
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, session_factory, flush):
+        if self.running:
+            return
+        self._session_factory = session_factory
+        self._flush = flush
+        self._thread = threading.Thread(
+            target=self._run, name="group-commit-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        # Messages queued before the stop marker are still flushed
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, message_data, room_id: str) -> Future:
+        future = Future()
+        self._queue.put((message_data, room_id, future, time.monotonic()))
+        return future
+
+    async def write(self, message_data, room_id: str):
+        # Resolves once the batch holding this message has committed
+        return await asyncio.wrap_future(self.submit(message_data, room_id))
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            # Callers that gave up while queued (a client that disconnected
+            # cancels its future) are dropped unwritten; the rest can no
+            # longer be cancelled, so resolving them below cannot fail
+            batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                # Never let one batch end the loop; its callers get the error
+                log.exception("group commit batch failed")
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _write_batch(self, batch):
+        started = time.monotonic()
+        pending = [(message_data, room_id) for message_data, room_id, _, _ in batch]
+        try:
+            with self._session_factory() as db:
+                results = self._flush(db, pending)
+        except Exception as e:
+            # The transaction failed as a whole; every caller gets the error
+            results = [e] * len(batch)
+
+        finished = time.monotonic()
+        errors = 0
+        for (_, _, future, _), result in zip(batch, results):
+            if isinstance(result, Exception):
+                errors += 1
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+        with self._stats_lock:
+            self._batches += 1
+            self._messages += len(batch)
+            self._errors += errors
+            self._largest_batch = max(self._largest_batch, len(batch))
+            self._flush_seconds += finished - started
+            self._max_flush_seconds = max(self._max_flush_seconds, finished - started)
+            self._wait_seconds += sum(finished - queued for _, _, _, queued in batch)
+
+    def stats(self):
+        with self._stats_lock:
+            batches = self._batches or 1
+            messages = self._messages or 1
+            return {
+                "enabled": self.running,
+                "max_batch": self.max_batch,
+                "max_delay_ms": self.max_delay * 1000,
+                "queue_depth": self._queue.qsize(),
+                "batches": self._batches,
+                "messages": self._messages,
+                "errors": self._errors,
+                "avg_batch_size": round(self._messages / batches, 2),
+                "largest_batch": self._largest_batch,
+                "avg_flush_ms": round(self._flush_seconds / batches * 1000, 3),
+                "max_flush_ms": round(self._max_flush_seconds * 1000, 3),
+                "avg_commit_latency_ms": round(
+                    self._wait_seconds / messages * 1000, 3
+                ),
+            }
+
+
+group_writer = GroupCommitWriter(GROUP_COMMIT_MAX_BATCH, GROUP_COMMIT_MAX_DELAY_MS)
@@ -0,0 +1,90 @@
+# bench_async_db.py
+#
+# Compares the sync (threadpool) and async (aiosqlite) database paths on a
+# single uvicorn worker under many concurrent clients.
+#
+#   python -m benchmarks.bench_async_db --clients 200 --duration 10
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from benchmarks.common import HTTPClient, running_server, sign_up, summarize
+
+
+async def seed(server, messages):
+    client = HTTPClient(server["host"], server["port"])
+    user = await sign_up(client)
+    room = await client.json(
+        "POST",
+        "/chat-room",
+        {"name": "bench", "members": [user["id"]]},
+        user["headers"],
+    )
+    for i in range(messages):
+        await client.json(
+            "POST",
+            f"/messages/{room['id']}",
+            {"content": f"seed message {i}", "sender_id": user["id"]},
+            user["headers"],
+        )
+    await client.close()
+    return user, room
+
+
+async def run_client(server, user, room, deadline, write_ratio, latencies):
+    client = HTTPClient(server["host"], server["port"])
+    try:
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            if random.random() < write_ratio:
+                await client.json(
+                    "POST",
+                    f"/messages/{room['id']}",
+                    {"content": "benchmark", "sender_id": user["id"]},
+                    user["headers"],
+                )
+            else:
+                await client.json(
+                    "GET", f"/messages/{room['id']}?cursor=true&limit=50"
+                )
+            latencies.append(time.perf_counter() - started)
+    finally:
+        await client.close()
+
+
+async def run_mode(use_async, args):
+    env = {"USE_ASYNC_DB": "true" if use_async else "false"}
+    with running_server(env) as server:
+        user, room = await seed(server, args.messages)
+        latencies = []
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(
+            *(
+                run_client(server, user, room, deadline, args.write_ratio, latencies)
+                for _ in range(args.clients)
+            )
+        )
+        return summarize(latencies, time.monotonic() - started)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    args = parser.parse_args()
+
+    results = {
+        "clients": args.clients,
+        "sync": await run_mode(False, args),
+        "async": await run_mode(True, args),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+# bench_batch_insert.py
+#
+# Imports the same number of messages one POST at a time and through
+# POST /messages/{room_id}/batch, and reports messages per second for each.
+#
+#   python -m benchmarks.bench_batch_insert --messages 2000 --batch-size 500
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.common import HTTPClient, running_server, sign_up
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    with running_server() as server:
+        client = HTTPClient(server["host"], server["port"])
+        user = await sign_up(client)
+        room = await client.json(
+            "POST",
+            "/chat-room",
+            {"name": "import", "members": [user["id"]]},
+            user["headers"],
+        )
+        message = {"content": "imported message", "sender_id": user["id"]}
+
+        started = time.perf_counter()
+        for _ in range(args.messages):
+            await client.json(
+                "POST", f"/messages/{room['id']}", message, user["headers"]
+            )
+        single = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for offset in range(0, args.messages, args.batch_size):
+            count = min(args.batch_size, args.messages - offset)
+            await client.json(
+                "POST",
+                f"/messages/{room['id']}/batch",
+                [message] * count,
+                user["headers"],
+            )
+        batched = time.perf_counter() - started
+        await client.close()
+
+    print(
+        json.dumps(
+            {
+                "messages": args.messages,
+                "batch_size": args.batch_size,
+                "single_per_s": round(args.messages / single, 1),
+                "batch_per_s": round(args.messages / batched, 1),
+                "speedup": round(single / batched, 1),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
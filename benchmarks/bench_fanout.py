@@ -0,0 +1,106 @@
+# bench_fanout.py
+#
+# Real-time fan-out across uvicorn workers. For each broker backend and
+# worker count, opens websocket subscribers on one room (the kernel spreads
+# the connections over the workers), posts messages at a fixed rate and
+# reports what fraction of the expected deliveries arrived, delivery
+# throughput and post-to-receive latency.
+#
+#   python -m benchmarks.bench_fanout --workers 1,2,4 --subscribers 40
+#   python -m benchmarks.bench_fanout --brokers local,sqlite --workers 4
+import argparse
+import asyncio
+import json
+import time
+
+import websockets
+
+from benchmarks.common import HTTPClient, running_server, sign_up, summarize
+
+
+async def subscribe(server, room_id, ready, latencies, received):
+    url = f"ws://{server['host']}:{server['port']}/ws/rooms/{room_id}"
+    async with websockets.connect(url, max_queue=None) as websocket:
+        ready.set_result(None)
+        async for raw in websocket:
+            event = json.loads(raw)
+            if event.get("type") != "message.created":
+                continue
+            sent = float(event["message"]["content"])
+            latencies.append(time.time() - sent)
+            received.append(event["seq"])
+
+
+async def run(broker, workers, args):
+    with running_server({"BROKER": broker}, workers=workers) as server:
+        client = HTTPClient(server["host"], server["port"])
+        user = await sign_up(client)
+        room = await client.json(
+            "POST",
+            "/chat-room",
+            {"name": "fanout", "members": [user["id"]]},
+            user["headers"],
+        )
+
+        latencies, received = [], []
+        readies = []
+        subscribers = []
+        for _ in range(args.subscribers):
+            ready = asyncio.get_running_loop().create_future()
+            readies.append(ready)
+            subscribers.append(
+                asyncio.create_task(
+                    subscribe(server, room["id"], ready, latencies, received)
+                )
+            )
+        await asyncio.gather(*readies)
+
+        started = time.monotonic()
+        interval = 1 / args.rate
+        for i in range(args.messages):
+            await client.json(
+                "POST",
+                f"/messages/{room['id']}",
+                {"content": repr(time.time()), "sender_id": user["id"]},
+                user["headers"],
+            )
+            await asyncio.sleep(started + (i + 1) * interval - time.monotonic())
+
+        # Give the tails on other workers time to catch up
+        await asyncio.sleep(args.drain)
+        elapsed = time.monotonic() - started
+        for task in subscribers:
+            task.cancel()
+        await asyncio.gather(*subscribers, return_exceptions=True)
+        await client.close()
+
+    expected = args.messages * args.subscribers
+    return {
+        "broker": broker,
+        "workers": workers,
+        "delivered": len(received),
+        "expected": expected,
+        "delivered_ratio": round(len(received) / expected, 4),
+        "latency": summarize(latencies, elapsed),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--brokers", default="sqlite")
+    parser.add_argument("--workers", default="1,2,4,8")
+    parser.add_argument("--subscribers", type=int, default=40)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=100.0, help="posts per second")
+    parser.add_argument("--drain", type=float, default=1.0)
+    args = parser.parse_args()
+
+    results = []
+    for broker in args.brokers.split(","):
+        for workers in map(int, args.workers.split(",")):
+            results.append(await run(broker, workers, args))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
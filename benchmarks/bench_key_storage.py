@@ -0,0 +1,146 @@
+# bench_key_storage.py
+#
+# Seeds the same data under KEY_STORAGE=text and KEY_STORAGE=binary and
+# reports the on-disk size of every table and index (from SQLite's dbstat)
+# next to batch-insert, history-scroll and room-list throughput.
+#
+#   python -m benchmarks.bench_key_storage --messages 200000 --duration 10
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import time
+
+from benchmarks.common import HTTPClient, running_server, sign_up, summarize
+
+
+async def seed(client, args):
+    users = [await sign_up(client) for _ in range(args.users)]
+    rooms = []
+    for i in range(args.rooms):
+        members = random.sample(users, min(args.members_per_room, len(users)))
+        rooms.append(
+            await client.json(
+                "POST",
+                "/chat-room",
+                {"name": f"room-{i}", "members": [user["id"] for user in members]},
+                members[0]["headers"],
+            )
+        )
+
+    # A signed-in caller may only post as themselves, so each batch comes
+    # from one member
+    users_by_id = {user["id"]: user for user in users}
+    started = time.perf_counter()
+    remaining = args.messages
+    while remaining > 0:
+        room = random.choice(rooms)
+        sender = users_by_id[random.choice(room["members"])["id"]]
+        count = min(remaining, 1000)
+        batch = [{"content": "x" * 40, "sender_id": sender["id"]}] * count
+        await client.json(
+            "POST", f"/messages/{room['id']}/batch", batch, sender["headers"]
+        )
+        remaining -= count
+    insert_seconds = time.perf_counter() - started
+
+    return users, rooms, round(args.messages / insert_seconds, 1)
+
+
+async def scroll(client, rooms, latencies):
+    room = random.choice(rooms)
+    path = f"/messages/{room['id']}?cursor=true&limit=50"
+    for _ in range(5):
+        started = time.perf_counter()
+        page = await client.json("GET", path)
+        latencies.append(time.perf_counter() - started)
+        if not page["next_cursor"]:
+            break
+        path = f"/messages/{room['id']}?before={page['next_cursor']}&limit=50"
+
+
+async def room_list(client, users, latencies):
+    user = random.choice(users)
+    started = time.perf_counter()
+    await client.json("GET", f"/user/rooms/{user['id']}", headers=user["headers"])
+    latencies.append(time.perf_counter() - started)
+
+
+async def run_client(server, users, rooms, deadline, latencies):
+    client = HTTPClient(server["host"], server["port"])
+    try:
+        while time.monotonic() < deadline:
+            if random.random() < 0.8:
+                await scroll(client, rooms, latencies["history"])
+            else:
+                await room_list(client, users, latencies["rooms"])
+    finally:
+        await client.close()
+
+
+def storage_sizes(path):
+    # Bytes per table and index, FTS shadow tables folded into one entry
+    with sqlite3.connect(path) as connection:
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        rows = connection.execute(
+            "SELECT name, SUM(pgsize) FROM dbstat GROUP BY name"
+        ).fetchall()
+    sizes = {}
+    for name, size in rows:
+        if name.startswith("messages_fts"):
+            name = "messages_fts"
+        sizes[name] = sizes.get(name, 0) + size
+    return {
+        "file_bytes": os.path.getsize(path),
+        "objects": dict(sorted(sizes.items(), key=lambda item: -item[1])),
+    }
+
+
+async def run_mode(mode, args):
+    # The room cache is off so every page read reaches SQLite
+    env = {"KEY_STORAGE": mode, "ROOM_CACHE_MESSAGES": "0"}
+    with running_server(env) as server:
+        seeder = HTTPClient(server["host"], server["port"])
+        users, rooms, insert_rate = await seed(seeder, args)
+        await seeder.close()
+
+        latencies = {"history": [], "rooms": []}
+        started = time.monotonic()
+        deadline = started + args.duration
+        await asyncio.gather(
+            *(
+                run_client(server, users, rooms, deadline, latencies)
+                for _ in range(args.clients)
+            )
+        )
+        elapsed = time.monotonic() - started
+
+        return {
+            "batch_insert_per_s": insert_rate,
+            "history": summarize(latencies["history"], elapsed),
+            "rooms": summarize(latencies["rooms"], elapsed),
+            "storage": storage_sizes(os.path.join(server["tmpdir"], "bench.db")),
+        }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--rooms", type=int, default=200)
+    parser.add_argument("--members-per-room", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10.0)
+    args = parser.parse_args()
+
+    results = {mode: await run_mode(mode, args) for mode in ("text", "binary")}
+    text_bytes = results["text"]["storage"]["file_bytes"]
+    binary_bytes = results["binary"]["storage"]["file_bytes"]
+    results["file_size_ratio"] = round(binary_bytes / text_bytes, 3)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
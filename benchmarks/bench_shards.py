@@ -0,0 +1,123 @@
+# bench_shards.py
+#
+# Write throughput with rooms sharded over SHARD_COUNT SQLite files. For
+# each shard count, starts the app with several workers, creates rooms,
+# then has concurrent clients post messages to random rooms and reports
+# posts per second with latency percentiles. Every shard has its own write
+# lock, so posts to rooms on different shards commit in parallel. A short
+# read leg times the room list, which gathers from every shard.
+#
+#   python -m benchmarks.bench_shards --shards 1,2,4,8 --workers 4
+#   python -m benchmarks.bench_shards --shards 1,4 --env GROUP_COMMIT=true
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from benchmarks.common import HTTPClient, running_server, sign_up, summarize
+from benchmarks.loadtest import env_pair
+
+
+async def post_messages(server, rooms, count, latencies, errors):
+    client = HTTPClient(server["host"], server["port"])
+    try:
+        for _ in range(count):
+            room = random.choice(rooms)
+            started = time.perf_counter()
+            try:
+                await client.json(
+                    "POST",
+                    f"/messages/{room['id']}",
+                    {"content": "sharded message", "sender_id": room["sender"]},
+                    room["headers"],
+                )
+            except (RuntimeError, ConnectionError):
+                errors.append(room["id"])
+                await client.close()
+                continue
+            latencies.append(time.perf_counter() - started)
+    finally:
+        await client.close()
+
+
+async def run(shards, args):
+    env = dict(args.env, SHARD_COUNT=str(shards))
+    with running_server(env, workers=args.workers) as server:
+        client = HTTPClient(server["host"], server["port"])
+        users = [await sign_up(client, "shard") for _ in range(args.users)]
+        rooms = []
+        for i in range(args.rooms):
+            members = random.sample(users, min(3, len(users)))
+            room = await client.json(
+                "POST",
+                "/chat-room",
+                {"name": f"room-{i}", "members": [user["id"] for user in members]},
+                members[0]["headers"],
+            )
+            rooms.append(
+                {
+                    "id": room["id"],
+                    "sender": members[0]["id"],
+                    "headers": members[0]["headers"],
+                }
+            )
+        await client.close()
+
+        latencies, errors = [], []
+        started = time.monotonic()
+        await asyncio.gather(
+            *(
+                post_messages(server, rooms, args.messages, latencies, errors)
+                for _ in range(args.clients)
+            )
+        )
+        elapsed = time.monotonic() - started
+
+        # A new connection: the seeding one has idled past keep-alive
+        client = HTTPClient(server["host"], server["port"])
+        reads = []
+        read_started = time.monotonic()
+        for _ in range(args.reads):
+            user = random.choice(users)
+            request_started = time.perf_counter()
+            await client.json(
+                "GET", f"/user/rooms/{user['id']}", headers=user["headers"]
+            )
+            reads.append(time.perf_counter() - request_started)
+        read_elapsed = time.monotonic() - read_started
+        await client.close()
+
+    return {
+        "shards": shards,
+        "workers": args.workers,
+        "posts": summarize(latencies, elapsed),
+        "errors": len(errors),
+        "room_list": summarize(reads, read_elapsed),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", default="1,2,4,8")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rooms", type=int, default=64)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--messages", type=int, default=100, help="posts per client")
+    parser.add_argument("--reads", type=int, default=200)
+    parser.add_argument(
+        "--env",
+        type=env_pair,
+        action="append",
+        default=[],
+        help="NAME=VALUE passed to the spawned server, may be repeated",
+    )
+    args = parser.parse_args()
+
+    results = [await run(shards, args) for shards in map(int, args.shards.split(","))]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
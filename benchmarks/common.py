@@ -0,0 +1,171 @@
+# common.py
+import asyncio
+import contextlib
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def running_server(env=None, workers=1):
+    # A real uvicorn process on a throwaway SQLite file, so numbers include
+    # the HTTP stack and never touch app/test.db
+    with tempfile.TemporaryDirectory() as tmpdir:
+        port = free_port()
+        server_env = dict(os.environ)
+        server_env["DATABASE_URL"] = f"sqlite:///{tmpdir}/bench.db"
+        # Seeding from one address would trip the per-client write limits;
+        # pass ADMISSION_CONTROL=true in env to measure with them on
+        server_env["ADMISSION_CONTROL"] = "false"
+        server_env.update(env or {})
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "main:app",
+                "--port",
+                str(port),
+                "--workers",
+                str(workers),
+                "--log-level",
+                "warning",
+            ],
+            cwd=ROOT,
+            env=server_env,
+        )
+        try:
+            wait_for_port(port)
+            yield {"host": "127.0.0.1", "port": port, "tmpdir": tmpdir}
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with contextlib.suppress(OSError):
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+class HTTPClient:
+    # Minimal keep-alive HTTP/1.1 client so benchmarks need nothing beyond
+    # the app's own requirements
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+
+    async def request(self, method, path, body=None, headers=None):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(
+                self.host, self.port
+            )
+
+        payload = b"" if body is None else json.dumps(body).encode()
+        lines = [
+            f"{method} {path} HTTP/1.1",
+            f"Host: {self.host}:{self.port}",
+            f"Content-Length: {len(payload)}",
+            "Content-Type: application/json",
+        ]
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + payload)
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError("server closed the connection")
+        status = int(status_line.split()[1])
+
+        response_headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode().partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int((await self._reader.readline()).strip(), 16)
+                chunk = await self._reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                chunks.append(chunk[:-2])
+            content = b"".join(chunks)
+        else:
+            length = int(response_headers.get("content-length", 0))
+            content = await self._reader.readexactly(length)
+
+        if response_headers.get("connection") == "close":
+            await self.close()
+        return status, response_headers, content
+
+    async def json(self, method, path, body=None, headers=None):
+        status, _, content = await self.request(method, path, body, headers)
+        if status >= 400:
+            raise RuntimeError(f"{method} {path} -> {status}: {content[:200]!r}")
+        return json.loads(content) if content else None
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            with contextlib.suppress(Exception):
+                await self._writer.wait_closed()
+            self._writer = None
+
+
+async def sign_up(client, prefix="bench", sign_in=True):
+    # The new user, signed in unless asked not to: user["headers"] then
+    # carries the bearer token its writes need
+    suffix = uuid.uuid4().hex[:12]
+    credentials = {"email": f"{suffix}@bench", "password": "x"}
+    user = await client.json(
+        "POST", "/auth/sign-up", {"username": f"{prefix}-{suffix}", **credentials}
+    )
+    if sign_in:
+        token = await client.json("POST", "/auth/sign-in", credentials)
+        user["headers"] = {"Authorization": f"Bearer {token['access_token']}"}
+    return user
+
+
+def summarize(latencies, elapsed):
+    # Latencies are in seconds, reported in milliseconds
+    if not latencies:
+        return {"requests": 0}
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+
+    return {
+        "requests": len(ordered),
+        "throughput": round(len(ordered) / elapsed, 1),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+    }
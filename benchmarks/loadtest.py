@@ -0,0 +1,256 @@
+# loadtest.py
+#
+# Mixed-workload load test for main.app. Starts uvicorn on a temporary
+# SQLite file (or targets a running server with --host/--port), seeds
+# users, rooms and messages, then drives sign-up, message posting, room
+# history scroll-back and room-list fetches from concurrent clients.
+# Throughput and p50/p95/p99 latency per route are printed as JSON so runs
+# can be compared across commits.
+#
+#   python -m benchmarks.loadtest --clients 50 --duration 30 --out run.json
+#   python -m benchmarks.loadtest --env USE_ASYNC_DB=true --env GROUP_COMMIT=true
+import argparse
+import asyncio
+import contextlib
+import json
+import platform
+import random
+import subprocess
+import time
+
+from benchmarks.common import ROOT, HTTPClient, running_server, sign_up, summarize
+
+DEFAULT_MIX = "signup=1,post=4,history=10,rooms=3"
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight)
+    unknown = set(weights) - set(OPERATIONS)
+    if unknown:
+        raise SystemExit(f"unknown operations in --mix: {sorted(unknown)}")
+    return weights
+
+
+async def seed(client, args):
+    users = [await sign_up(client, "load") for _ in range(args.users)]
+
+    rooms = []
+    for i in range(args.rooms):
+        members = random.sample(users, min(args.members_per_room, len(users)))
+        room = await client.json(
+            "POST",
+            "/chat-room",
+            {"name": f"room-{i}", "members": [user["id"] for user in members]},
+            members[0]["headers"],
+        )
+        rooms.append(room)
+
+    # History goes in through the batch endpoint so seeding stays quick. A
+    # signed-in caller may only post as themselves, so each batch comes from
+    # one member
+    headers = {user["id"]: user["headers"] for user in users}
+    remaining = args.messages
+    while remaining > 0:
+        room = random.choice(rooms)
+        sender = random.choice(room["members"])
+        count = min(remaining, 500)
+        batch = [
+            {"content": f"seeded message {i}", "sender_id": sender["id"]}
+            for i in range(count)
+        ]
+        await client.json(
+            "POST",
+            f"/messages/{room['id']}/batch",
+            batch,
+            headers[sender["id"]],
+        )
+        remaining -= count
+
+    return users, rooms
+
+
+async def op_signup(client, state, record):
+    # Only the sign-up is measured. These users never sign in, so room lists
+    # are fetched for the seeded users alone
+    started = time.perf_counter()
+    await sign_up(client, "load", sign_in=False)
+    record("POST /auth/sign-up", started)
+
+
+async def op_post(client, state, record):
+    room = random.choice(state["rooms"])
+    sender = random.choice(room["members"])
+    started = time.perf_counter()
+    await client.json(
+        "POST",
+        f"/messages/{room['id']}",
+        {"content": "load test message", "sender_id": sender["id"]},
+        state["headers"][sender["id"]],
+    )
+    record("POST /messages/{room_id}", started)
+
+
+async def op_history(client, state, record):
+    # Open a room at its newest page, then scroll back a few pages
+    room = random.choice(state["rooms"])
+    path = f"/messages/{room['id']}?cursor=true&limit={state['page_size']}"
+    for _ in range(random.randint(1, state["max_scroll_pages"])):
+        started = time.perf_counter()
+        page = await client.json("GET", path)
+        record("GET /messages/{room_id}", started)
+        if not page["next_cursor"]:
+            break
+        path = (
+            f"/messages/{room['id']}?before={page['next_cursor']}"
+            f"&limit={state['page_size']}"
+        )
+
+
+async def op_rooms(client, state, record):
+    user = random.choice(state["users"])
+    started = time.perf_counter()
+    await client.json("GET", f"/user/rooms/{user['id']}", headers=user["headers"])
+    record("GET /user/rooms/{user_id}", started)
+
+
+OPERATIONS = {
+    "signup": op_signup,
+    "post": op_post,
+    "history": op_history,
+    "rooms": op_rooms,
+}
+
+
+async def run_client(host, port, state, weights, deadline, latencies, errors):
+    client = HTTPClient(host, port)
+    names = list(weights)
+    name_weights = [weights[name] for name in names]
+
+    def record(route, started):
+        latencies.setdefault(route, []).append(time.perf_counter() - started)
+
+    try:
+        while time.monotonic() < deadline:
+            name = random.choices(names, weights=name_weights)[0]
+            try:
+                await OPERATIONS[name](client, state, record)
+            except (RuntimeError, ConnectionError) as e:
+                errors[name] = errors.get(name, 0) + 1
+                state["last_errors"][name] = str(e)[:200]
+                await client.close()
+    finally:
+        await client.close()
+
+
+def git_revision():
+    with contextlib.suppress(Exception):
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    return None
+
+
+async def run(host, port, args):
+    weights = parse_mix(args.mix)
+    seeder = HTTPClient(host, port)
+    users, rooms = await seed(seeder, args)
+    await seeder.close()
+
+    state = {
+        "users": users,
+        "headers": {user["id"]: user["headers"] for user in users},
+        "rooms": rooms,
+        "page_size": args.page_size,
+        "max_scroll_pages": args.max_scroll_pages,
+        "last_errors": {},
+    }
+    latencies = {}
+    errors = {}
+
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(
+        *(
+            run_client(host, port, state, weights, deadline, latencies, errors)
+            for _ in range(args.clients)
+        )
+    )
+    elapsed = time.monotonic() - started
+
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "config": {
+            "users": args.users,
+            "rooms": args.rooms,
+            "messages": args.messages,
+            "members_per_room": args.members_per_room,
+            "clients": args.clients,
+            "duration": args.duration,
+            "mix": weights,
+            "env": dict(args.env),
+            "workers": args.workers,
+        },
+        "routes": {
+            route: summarize(samples, elapsed)
+            for route, samples in sorted(latencies.items())
+        },
+        "total": summarize(
+            [sample for samples in latencies.values() for sample in samples], elapsed
+        ),
+        "errors": errors,
+        "last_errors": state["last_errors"],
+    }
+
+
+def env_pair(value):
+    name, _, setting = value.partition("=")
+    return name, setting
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rooms", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--members-per-room", type=int, default=8)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--max-scroll-pages", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--env",
+        type=env_pair,
+        action="append",
+        default=[],
+        help="NAME=VALUE passed to the spawned server, may be repeated",
+    )
+    parser.add_argument("--host", help="target an already running server")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--out", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.host:
+        report = await run(args.host, args.port, args)
+    else:
+        with running_server(dict(args.env), workers=args.workers) as server:
+            report = await run(server["host"], server["port"], args)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,10 +1,43 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from app.router.routers import router
-from app.database import Base, engine  # Import Base and engine
+from app.router.async_routers import async_router
+from app.controllers.controllers import change_event, write_message_group
+from app.admission import admission
+from app.auth import auth_stats, password_hasher
+from app.archive import message_archive
+from app.broker import broker
+from app.cache import room_cache, user_cache
+from app.database import (
+    USE_ASYNC_DB,
+    SessionLocal,
+    async_shard_engines,
+    async_shard_read_engines,
+    init_db,
+    shard_engines,
+    shard_read_engines,
+)
+from app.metrics import MetricsMiddleware, instrument_engine, registry
+from app.writer import GROUP_COMMIT, group_writer
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if GROUP_COMMIT:
+        group_writer.start(SessionLocal, write_message_group)
+    # Relays changes committed by other workers to this one's websockets
+    broker.start(shard_read_engines, change_event)
+    yield
+    broker.stop()
+    # Flush whatever is still queued before the process exits
+    group_writer.stop()
+    password_hasher.shutdown()
 
-# Create FastAPI app
-app = FastAPI()
+
+# Create FastAPI app; responses are encoded with orjson
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Allow all origins to enable CORS
 app.add_middleware(
@@ -15,8 +48,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Include your router
+# Per-route latency, SQL statement counts and DB time, served at /metrics
+app.add_middleware(MetricsMiddleware)
+for instrumented in {*shard_engines, *shard_read_engines}:
+    instrument_engine(instrumented)
+for instrumented in {*async_shard_engines, *async_shard_read_engines}:
+    instrument_engine(instrumented.sync_engine)
+registry.register_gauges("group_commit", group_writer.stats)
+registry.register_gauges("user_cache", user_cache.stats)
+registry.register_gauges("room_cache", room_cache.stats)
+registry.register_gauges("auth", auth_stats)
+registry.register_gauges("admission", admission.stats)
+registry.register_gauges("broker", broker.stats)
+registry.register_gauges("archive", message_archive.stats)
+
+# Include your router; async routes shadow their sync twins when enabled
+if USE_ASYNC_DB:
+    app.include_router(async_router)
 app.include_router(router)
 
 # Create the database tables
-Base.metadata.create_all(bind=engine)  # Create tables before running the app
+init_db()  # Create tables and indexes before running the app
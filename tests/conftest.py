@@ -0,0 +1,114 @@
+# conftest.py
+#
+# The app reads its settings when first imported, so they are fixed here,
+# before any test imports it: a throwaway SQLite file that never touches
+# app/test.db, and no per-client write limits for the fixtures' bursts.
+import atexit
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import uuid
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_tmpdir = tempfile.mkdtemp(prefix="chitchat-tests-")
+atexit.register(shutil.rmtree, _tmpdir, ignore_errors=True)
+
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir}/test.db"
+os.environ["ADMISSION_CONTROL"] = "false"
+os.environ.setdefault("AUTH_SCRYPT_N", "1024")
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    from main import app
+
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def make_user(client):
+    # A signed-up user, with headers carrying their bearer token
+    def make_user():
+        name = uuid.uuid4().hex[:12]
+        credentials = {"email": f"{name}@test", "password": "secret"}
+        response = client.post(
+            "/auth/sign-up", json={"username": name, **credentials}
+        )
+        assert response.status_code == 200, response.text
+        user = response.json()
+        token = client.post("/auth/sign-in", json=credentials).json()["access_token"]
+        user["headers"] = {"Authorization": f"Bearer {token}"}
+        return user
+
+    return make_user
+
+
+@pytest.fixture
+def make_room(client):
+    # Created by the first member
+    def make_room(members):
+        response = client.post(
+            "/chat-room",
+            json={"name": "room", "members": [member["id"] for member in members]},
+            headers=members[0]["headers"],
+        )
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    return make_room
+
+
+@pytest.fixture
+def record_statements():
+    # (statement, parameters) of everything any engine sends while the
+    # block runs, async engines included
+    @contextlib.contextmanager
+    def record_statements():
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(Engine, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(Engine, "before_cursor_execute", record)
+
+    return record_statements
+
+
+@pytest.fixture
+def run_app(tmp_path):
+    # Settings read at import, like KEY_STORAGE or SHARD_COUNT, can only
+    # change in a fresh interpreter: runs the code there against a database
+    # of its own and returns what it printed last, as JSON
+    def run_app(code, **env):
+        environ = {
+            **os.environ,
+            "DATABASE_URL": f"sqlite:///{tmp_path}/app.db",
+            **env,
+        }
+        result = subprocess.run(
+            [sys.executable, "-c", textwrap.dedent(code)],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            env=environ,
+            capture_output=True,
+            text=True,
+            timeout=120,
+        )
+        assert result.returncode == 0, result.stderr
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    return run_app
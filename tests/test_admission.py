@@ -0,0 +1,86 @@
+import pytest
+from starlette.requests import Request
+
+import app.admission
+from app.admission import RateLimiter, _client_key, admission
+
+
+def make_request():
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/messages/room",
+        "headers": [],
+        "client": ("203.0.113.7", 50000),
+    }
+    return Request(scope)
+
+
+def test_anonymous_writes_are_keyed_by_peer_address():
+    # A sender_id in the body is chosen by the caller, so it must not pick
+    # whose bucket pays for the write
+    assert _client_key(make_request(), None) == "ip:203.0.113.7"
+
+
+def test_signed_in_writes_are_keyed_by_user():
+    assert _client_key(make_request(), "user-1") == "user:user-1"
+
+
+@pytest.fixture
+def limited(monkeypatch):
+    # Admission on, with a five-message bucket that barely refills
+    monkeypatch.setattr(app.admission, "ADMISSION_CONTROL", True)
+    monkeypatch.setattr(admission, "users", RateLimiter(0.01, 5, 100))
+
+
+@pytest.fixture
+def room(client, make_user, make_room):
+    user = make_user()
+    return make_room([user]), user
+
+
+def post(client, room, count=None):
+    room, user = room
+    message = {"content": "hi", "sender_id": user["id"]}
+    if count is None:
+        return client.post(
+            f"/messages/{room['id']}", json=message, headers=user["headers"]
+        )
+    return client.post(
+        f"/messages/{room['id']}/batch",
+        json=[message] * count,
+        headers=user["headers"],
+    )
+
+
+def test_empty_bucket_is_answered_with_retry_after(client, room, limited):
+    for _ in range(5):
+        assert post(client, room).status_code == 200
+    response = post(client, room)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_batches_are_charged_by_length(client, room, limited):
+    assert post(client, room, count=4).status_code == 200
+    # One token left: a two-message batch waits, a single post does not
+    assert post(client, room, count=2).status_code == 429
+    assert post(client, room).status_code == 200
+
+
+def test_batches_larger_than_the_bucket_are_refused(client, room, limited):
+    response = post(client, room, count=6)
+    assert response.status_code == 413
+    assert post(client, room, count=5).status_code == 200
+
+
+def test_idle_buckets_are_evicted():
+    limiter = RateLimiter(rate=10, burst=20, max_users=100)
+    limiter.take("user:a", now=0)
+    limiter.take("user:b", now=1)
+    assert len(limiter) == 2
+
+    # A full refill after its last use, a's bucket is dropped
+    limiter.take("user:b", now=2 + limiter.idle_seconds - 1)
+    assert len(limiter) == 1
+    assert limiter.evictions == 1
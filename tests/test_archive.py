@@ -0,0 +1,174 @@
+import gzip
+import json
+import uuid
+
+import pytest
+from sqlalchemy import delete, func, select, update
+
+from app.archive import archive_messages, message_archive, prune_change_log
+from app.cache import room_cache
+from app.database import engine
+from app.models.models import Change, ChangeLogHorizon, Message
+from app.pagination import encode_cursor
+
+DAY = 86400 * 1_000_000
+
+
+def age_oldest(room_id, count):
+    # Moves the room's oldest messages 200 days back, keeping their order
+    with engine.begin() as connection:
+        oldest = (
+            select(Message.id)
+            .where(Message.room_id == room_id)
+            .order_by(Message.time, Message.id)
+            .limit(count)
+        )
+        connection.execute(
+            update(Message)
+            .where(Message.id.in_(oldest))
+            .values(time=Message.time - 200 * DAY)
+        )
+
+
+def post_batch(client, room, user, count, prefix="message"):
+    response = client.post(
+        f"/messages/{room['id']}/batch",
+        json=[
+            {"content": f"{prefix} {i}", "sender_id": user["id"]} for i in range(count)
+        ],
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
+    return response.json()
+
+
+@pytest.fixture
+def room(client, make_user, make_room):
+    user = make_user()
+    return make_room([user]), user
+
+
+@pytest.fixture
+def horizon():
+    # Pruning moves the shared database's sync horizon; put it back
+    yield
+    with engine.begin() as connection:
+        connection.execute(delete(ChangeLogHorizon))
+
+
+def test_archived_messages_count_and_are_read_only(client, room):
+    room, user = room
+    archived = post_batch(client, room, user, 5)[0]["id"]
+    response = client.post(
+        f"/messages/{room['id']}",
+        json={"content": "new", "sender_id": user["id"]},
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
+
+    age_oldest(room["id"], 5)
+    archive_messages(engine, 90, 256)
+    assert message_archive.count(room["id"]) == 5
+
+    assert client.get(f"/users/{user['id']}").json()["messageCount"] == 6
+
+    response = client.delete(f"/messages/{archived}", headers=user["headers"])
+    assert response.status_code == 409
+    assert "archived" in response.json()["detail"]
+    response = client.put(
+        f"/messages/{archived}", json={"content": "edited"}, headers=user["headers"]
+    )
+    assert response.status_code == 409
+
+    response = client.delete(f"/messages/{uuid.uuid4()}", headers=user["headers"])
+    assert response.status_code == 404
+
+
+def read_everything(client, room_id):
+    # The room's whole history through each read path, oldest first: offset
+    # pages, cursor pages backward and forward, and the gzipped export
+    room_cache.clear()
+    offset = []
+    while True:
+        page = client.get(f"/messages/{room_id}?skip={len(offset)}&limit=17").json()
+        if not page:
+            break
+        offset += page
+
+    backward = []
+    path = f"/messages/{room_id}?cursor=true&limit=17"
+    while path:
+        page = client.get(path).json()
+        backward += page["messages"]
+        cursor = page["next_cursor"]
+        path = cursor and f"/messages/{room_id}?before={cursor}&limit=17"
+
+    forward = offset[:1]
+    cursor = encode_cursor(offset[0]["time"], offset[0]["id"])
+    while True:
+        page = client.get(f"/messages/{room_id}?after={cursor}&limit=17").json()
+        forward += page["messages"]
+        if not page["has_more"]:
+            break
+        cursor = page["next_cursor"]
+
+    response = client.get(f"/rooms/{room_id}/export?gzip=true")
+    assert response.status_code == 200
+    body = response.content
+    if body[:2] == b"\x1f\x8b":
+        body = gzip.decompress(body)
+    exported = [json.loads(line) for line in body.decode().splitlines()]
+    return offset, backward[::-1], forward, exported
+
+
+def test_history_reads_across_both_tiers(client, room):
+    # Larger than the room cache's window, so offset pages come from the
+    # table and the archive rather than from the cache
+    room, user = room
+    post_batch(client, room, user, 130)
+    age_oldest(room["id"], 90)
+    before = read_everything(client, room["id"])
+
+    archive_messages(engine, 90, 16)
+    assert message_archive.count(room["id"]) == 90
+    after = read_everything(client, room["id"])
+
+    ids = [[message["id"] for message in messages] for messages in after]
+    assert len(ids[0]) == 130
+    assert ids[0] == ids[1] == ids[2] == ids[3]
+    assert after == before
+
+
+def test_pruned_change_log_asks_for_a_resync(client, room, horizon):
+    room, user = room
+    post_batch(client, room, user, 5, prefix="synced")
+    head = client.get(
+        "/sync", params={"user_id": user["id"]}, headers=user["headers"]
+    ).json()["next_since"]
+
+    age_oldest(room["id"], 4)
+    archive_messages(engine, 90, 256)
+    with engine.connect() as connection:
+        version = connection.scalar(
+            select(func.max(Change.seq)).where(Change.room_id == room["id"])
+        )
+    assert prune_change_log(engine, 30) >= 4
+    with engine.connect() as connection:
+        # The room's version is untouched
+        assert version == connection.scalar(
+            select(func.max(Change.seq)).where(Change.room_id == room["id"])
+        )
+
+    response = client.get(
+        "/sync", params={"user_id": user["id"]}, headers=user["headers"]
+    )
+    assert response.status_code == 410
+    assert response.json()["detail"]["next_since"] >= head
+
+    # From the head, or from anywhere past what was pruned, syncing goes on
+    response = client.get(
+        "/sync",
+        params={"user_id": user["id"], "since": head},
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
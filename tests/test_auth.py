@@ -0,0 +1,82 @@
+import os
+
+import pytest
+from sqlalchemy import select, update
+
+from app.auth import AUTH_SECRET, AUTH_SECRET_FILE, _load_secret
+from app.database import engine
+from app.models.models import User
+
+
+def test_writes_require_a_token(client, make_user, make_room):
+    user = make_user()
+    room = make_room([user])
+    message = {"content": "hi", "sender_id": user["id"]}
+
+    response = client.post(f"/messages/{room['id']}", json=message)
+    assert response.status_code == 401
+    response = client.post(
+        "/chat-room", json={"name": "room", "members": [user["id"]]}
+    )
+    assert response.status_code == 401
+
+    response = client.post(
+        f"/messages/{room['id']}", json=message, headers=user["headers"]
+    )
+    assert response.status_code == 200
+
+
+def test_signing_secret_is_shared_through_its_file(tmp_path):
+    # Every worker loads the secret the first one wrote
+    assert AUTH_SECRET_FILE and os.path.exists(AUTH_SECRET_FILE)
+    assert _load_secret(AUTH_SECRET_FILE) == AUTH_SECRET
+
+    path = str(tmp_path / "auth-secret")
+    secret = _load_secret(path)
+    assert len(secret) == 32
+    assert _load_secret(path) == secret
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+
+def test_sign_in_reads_without_the_write_lock(client, make_user, record_statements):
+    user = make_user()
+    with record_statements() as statements:
+        response = client.post(
+            "/auth/sign-in", json={"email": user["email"], "password": "secret"}
+        )
+    assert response.status_code == 200
+    assert not any(statement == "BEGIN IMMEDIATE" for statement, _ in statements)
+
+
+def test_sign_in_rehashes_plaintext_passwords(client, make_user):
+    user = make_user()
+    with engine.begin() as connection:
+        connection.execute(
+            update(User).where(User.id == user["id"]).values(password="legacy")
+        )
+
+    response = client.post(
+        "/auth/sign-in", json={"email": user["email"], "password": "legacy"}
+    )
+    assert response.status_code == 200
+    with engine.connect() as connection:
+        stored = connection.scalar(select(User.password).where(User.id == user["id"]))
+    assert stored != "legacy"
+
+
+@pytest.mark.parametrize(
+    "path",
+    [
+        "/users/{user_id}/inbox",
+        "/user/rooms/{user_id}",
+        "/sync?user_id={user_id}",
+        "/search?q=hi&user_id={user_id}",
+    ],
+)
+def test_per_user_reads_need_that_user(client, make_user, path):
+    user, other = make_user(), make_user()
+    path = path.format(user_id=user["id"])
+
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers=other["headers"]).status_code == 403
+    assert client.get(path, headers=user["headers"]).status_code == 200
@@ -0,0 +1,67 @@
+import pytest
+
+import app.controllers.controllers as controllers
+
+
+@pytest.fixture
+def room(client, make_user, make_room):
+    user = make_user()
+    return make_room([user]), user
+
+
+def batch(client, room, user, messages):
+    return client.post(
+        f"/messages/{room['id']}/batch", json=messages, headers=user["headers"]
+    )
+
+
+def test_batch_is_one_insert_and_keeps_its_order(client, room, record_statements):
+    room, user = room
+    messages = [{"content": f"batched {i}", "sender_id": user["id"]} for i in range(20)]
+
+    with record_statements() as statements:
+        response = batch(client, room, user, messages)
+    assert response.status_code == 200
+    written = response.json()
+    assert [message["content"] for message in written] == [
+        message["content"] for message in messages
+    ]
+    assert {message["room_id"] for message in written} == {room["id"]}
+    inserts = [
+        statement
+        for statement, _ in statements
+        if statement.startswith("INSERT INTO messages ")
+    ]
+    assert len(inserts) == 1
+
+    history = client.get(f"/messages/{room['id']}?cursor=true&limit=20").json()
+    assert [message["id"] for message in history["messages"]] == [
+        message["id"] for message in reversed(written)
+    ]
+
+
+def test_batch_is_rejected_whole(client, room, make_user):
+    # One message the caller may not send spoils the batch
+    room, user = room
+    other = make_user()
+    response = batch(
+        client,
+        room,
+        user,
+        [
+            {"content": "fine", "sender_id": user["id"]},
+            {"content": "not mine", "sender_id": other["id"]},
+        ],
+    )
+    assert response.status_code == 403
+    assert client.get(f"/messages/{room['id']}").json() == []
+
+
+def test_batch_size_is_bounded(client, room, monkeypatch):
+    room, user = room
+    monkeypatch.setattr(controllers, "BATCH_MAX_MESSAGES", 3)
+    messages = [{"content": f"{i}", "sender_id": user["id"]} for i in range(4)]
+
+    assert batch(client, room, user, messages).status_code == 413
+    assert batch(client, room, user, messages[:3]).status_code == 200
+    assert batch(client, room, user, []).json() == []
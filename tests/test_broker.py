@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+import app.broker
+import app.controllers.controllers as controllers
+from app.broker import SQLiteBroker
+from app.controllers.controllers import change_event
+from app.database import shard_read_engines
+
+
+class RecordingHub:
+    def __init__(self):
+        self.events = []
+
+    def publish(self, room_id, event):
+        self.events.append(event)
+
+
+@pytest.fixture
+def tail(client, monkeypatch):
+    # Another worker's broker: the test client's requests publish nothing
+    # here, so it only learns of them from the change log
+    hub = RecordingHub()
+    monkeypatch.setattr(app.broker, "hub", hub)
+    monkeypatch.setattr(controllers, "_publish_changes", lambda events: None)
+    broker = SQLiteBroker(poll_interval_ms=5, batch_size=2, dedupe_size=100)
+    broker.start(shard_read_engines, change_event)
+    yield broker, hub
+    broker.stop()
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_changes_from_other_workers_are_delivered_once(
+    client, make_user, make_room, tail
+):
+    broker, hub = tail
+    user = make_user()
+    room = make_room([user])
+    response = client.post(
+        f"/messages/{room['id']}/batch",
+        json=[{"content": f"relayed {i}", "sender_id": user["id"]} for i in range(5)],
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
+    written = [message["id"] for message in response.json()]
+
+    def relayed():
+        return [
+            event["message"]["id"]
+            for event in hub.events
+            if event["type"] == "message.created"
+            and event["room_id"] == room["id"]
+        ]
+
+    # Batches smaller than the backlog: the tail keeps reading until caught up
+    assert wait_for(lambda: len(relayed()) == 5)
+    assert relayed() == written
+    assert broker.stats()["delivered_remote"] >= 5
+
+    # Publishing what the tail already delivered sends nothing again
+    seqs = [event["seq"] for event in hub.events]
+    broker.publish(hub.events[-1:])
+    assert [event["seq"] for event in hub.events] == seqs
+
+
+def test_own_changes_are_not_delivered_again_by_the_tail(
+    client, make_user, make_room, tail
+):
+    broker, hub = tail
+    user = make_user()
+    room = make_room([user])
+    assert wait_for(
+        lambda: any(event["room_id"] == room["id"] for event in hub.events)
+    )
+    seq = max(event["seq"] for event in hub.events) + 1
+    own = change_event(seq, room["id"], "message.created", {"id": "own"})
+
+    # Claimed by this worker's request before its commit reaches the tail
+    broker.publish([own])
+    delivered = len(hub.events)
+    response = client.post(
+        f"/messages/{room['id']}",
+        json={"content": "own", "sender_id": user["id"]},
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
+    assert wait_for(lambda: broker.last_seqs[0] >= seq)
+    assert hub.events[delivered - 1] is own
+    assert hub.events[delivered:] == []
@@ -0,0 +1,75 @@
+def post(client, room, user, content):
+    response = client.post(
+        f"/messages/{room['id']}",
+        json={"content": content, "sender_id": user["id"]},
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_unchanged_room_page_is_not_sent_again(
+    client, make_user, make_room, record_statements
+):
+    user = make_user()
+    room = make_room([user])
+    message = post(client, room, user, "tagged")
+    path = f"/messages/{room['id']}?cursor=true&limit=10"
+
+    first = client.get(path)
+    etag = first.headers["etag"]
+    with record_statements() as statements:
+        cached = client.get(path, headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.headers["etag"] == etag
+    assert cached.content == b""
+    # Only the version lookup ran, not the page's query
+    assert not any("messages.content" in statement for statement, _ in statements)
+
+    # The tag covers every page of the room, in either form a client sends it
+    other_page = client.get(
+        f"/messages/{room['id']}?skip=0&limit=5",
+        headers={"If-None-Match": f'"stale", W/{etag}'},
+    )
+    assert other_page.status_code == 304
+
+    # Any change to the room moves it
+    tags = {etag}
+    for change in (
+        lambda: post(client, room, user, "newer"),
+        lambda: client.put(
+            f"/messages/{message['id']}",
+            json={"content": "edited"},
+            headers=user["headers"],
+        ),
+        lambda: client.delete(f"/messages/{message['id']}", headers=user["headers"]),
+    ):
+        change()
+        response = client.get(path, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        etag = response.headers["etag"]
+        assert etag not in tags
+        tags.add(etag)
+
+
+def test_room_list_changes_tag_when_membership_does(client, make_user, make_room):
+    user, other = make_user(), make_user()
+    make_room([user])
+    path = f"/user/rooms/{user['id']}"
+
+    etag = client.get(path, headers=user["headers"]).headers["etag"]
+    cached = client.get(path, headers={**user["headers"], "If-None-Match": etag})
+    assert cached.status_code == 304
+
+    # A message in one of the rooms leaves the list as it was
+    room = make_room([user, other])
+    etag = client.get(path, headers=user["headers"]).headers["etag"]
+    post(client, room, other, "hello")
+    cached = client.get(path, headers={**user["headers"], "If-None-Match": etag})
+    assert cached.status_code == 304
+
+    make_room([other, user])
+    response = client.get(path, headers={**user["headers"], "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert len(response.json()) == 3
@@ -0,0 +1,63 @@
+import gzip
+import json
+import uuid
+
+import pytest
+
+import app.controllers.controllers as controllers
+
+
+@pytest.fixture
+def room(client, make_user, make_room, monkeypatch):
+    # Several chunks' worth of messages
+    monkeypatch.setattr(controllers, "EXPORT_CHUNK_SIZE", 10)
+    user = make_user()
+    room = make_room([user])
+    response = client.post(
+        f"/messages/{room['id']}/batch",
+        json=[{"content": f"export {i}", "sender_id": user["id"]} for i in range(25)],
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
+    return room, response.json()
+
+
+def lines(body):
+    return [json.loads(line) for line in body.decode().splitlines()]
+
+
+def test_export_streams_the_history_oldest_first(client, room):
+    room, written = room
+    response = client.get(f"/rooms/{room['id']}/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert f"room-{room['id']}.ndjson" in response.headers["content-disposition"]
+
+    exported = lines(response.content)
+    assert [message["id"] for message in exported] == [
+        message["id"] for message in written
+    ]
+    assert exported[0]["content"] == "export 0"
+    assert set(exported[0]) == {
+        "id",
+        "sender_id",
+        "username",
+        "content",
+        "time",
+        "room_id",
+    }
+
+
+def test_gzipped_export_holds_the_same_lines(client, room):
+    room, _ = room
+    plain = client.get(f"/rooms/{room['id']}/export").content
+    response = client.get(f"/rooms/{room['id']}/export?gzip=true")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/gzip"
+    assert response.headers["content-disposition"].endswith('.ndjson.gz"')
+    assert response.content[:2] == b"\x1f\x8b"
+    assert gzip.decompress(response.content) == plain
+
+
+def test_export_of_unknown_room_is_404(client):
+    assert client.get(f"/rooms/{uuid.uuid4()}/export").status_code == 404
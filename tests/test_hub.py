@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+from app.hub import RoomHub, hub
+
+
+def test_room_subscribers_receive_changes(client, make_user, make_room):
+    user = make_user()
+    room = make_room([user])
+
+    with client.websocket_connect(f"/ws/rooms/{room['id']}") as websocket:
+        response = client.post(
+            f"/messages/{room['id']}",
+            json={"content": "live", "sender_id": user["id"]},
+            headers=user["headers"],
+        )
+        assert response.status_code == 200
+        message = response.json()
+        created = websocket.receive_json()
+
+        response = client.delete(f"/messages/{message['id']}", headers=user["headers"])
+        assert response.status_code == 200
+        deleted = websocket.receive_json()
+
+    assert created["type"] == "message.created"
+    assert created["room_id"] == room["id"]
+    assert created["message"]["id"] == message["id"]
+    assert created["message"]["content"] == "live"
+    assert deleted["type"] == "message.deleted"
+    assert deleted["message"] == {"id": message["id"]}
+    assert deleted["seq"] > created["seq"]
+
+
+def test_closed_sockets_are_unsubscribed(client, make_user, make_room):
+    room = make_room([make_user()])
+    with client.websocket_connect(f"/ws/rooms/{room['id']}"):
+        pass
+    # The server notices the hang-up on its own loop
+    deadline = time.monotonic() + 5
+    while hub.subscriber_count(room["id"]) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert hub.subscriber_count(room["id"]) == 0
+
+
+def test_slow_subscriber_is_dropped_and_told_to_resync():
+    async def scenario():
+        hub = RoomHub(queue_size=2)
+        slow = hub.subscribe("room")
+        for seq in range(3):
+            hub.publish("room", {"seq": seq})
+        # Deliveries are handed to the loop; let them run
+        await asyncio.sleep(0)
+        return hub, slow
+
+    hub, slow = asyncio.run(scenario())
+    assert slow.lagged
+    assert hub.subscriber_count("room") == 0
+    assert slow.queue.get_nowait() == {"type": "resync", "room_id": "room"}
+    assert slow.queue.empty()
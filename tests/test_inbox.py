@@ -0,0 +1,87 @@
+import pytest
+
+from app.models.models import PREVIEW_LENGTH
+
+
+def post(client, room, user, contents):
+    response = client.post(
+        f"/messages/{room['id']}/batch",
+        json=[{"content": content, "sender_id": user["id"]} for content in contents],
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
+    return response.json()
+
+
+def inbox(client, user):
+    response = client.get(f"/users/{user['id']}/inbox", headers=user["headers"])
+    assert response.status_code == 200
+    return response.json()
+
+
+def inbox_room(client, user, room):
+    return next(entry for entry in inbox(client, user) if entry["id"] == room["id"])
+
+
+def mark_read(client, user, room, message_id=None):
+    response = client.post(
+        f"/users/{user['id']}/rooms/{room['id']}/read",
+        json={"message_id": message_id},
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
+    return response.json()
+
+
+@pytest.fixture
+def pair(make_user, make_room):
+    alice, bob = make_user(), make_user()
+    return alice, bob, make_room([alice, bob])
+
+
+def test_inbox_counts_what_others_sent(client, pair):
+    alice, bob, room = pair
+    sent = post(client, room, bob, ["one", "two", "three"])
+    post(client, room, alice, ["x" * (PREVIEW_LENGTH + 50)])
+
+    entry = inbox_room(client, alice, room)
+    assert entry["unread_count"] == 3
+    last = entry["last_message"]
+    assert last["sender_id"] == alice["id"]
+    assert last["username"] == alice["username"]
+    assert last["preview"] == "x" * PREVIEW_LENGTH
+    assert inbox_room(client, bob, room)["unread_count"] == 1
+
+    # Reading up to a message counts only what others sent after it
+    assert mark_read(client, alice, room, sent[1]["id"])["unread_count"] == 1
+    # and the read cursor never moves back
+    read = mark_read(client, alice, room, sent[0]["id"])
+    assert read == {
+        "user_id": alice["id"],
+        "room_id": room["id"],
+        "last_read_message_id": sent[1]["id"],
+        "unread_count": 1,
+    }
+    assert mark_read(client, alice, room)["unread_count"] == 0
+    assert inbox_room(client, alice, room)["unread_count"] == 0
+
+
+def test_deleted_messages_leave_the_inbox(client, pair):
+    alice, bob, room = pair
+    first, second = post(client, room, bob, ["kept", "deleted"])
+
+    response = client.delete(f"/messages/{second['id']}", headers=bob["headers"])
+    assert response.status_code == 200
+    entry = inbox_room(client, alice, room)
+    assert entry["unread_count"] == 1
+    assert entry["last_message"]["id"] == first["id"]
+    assert entry["last_message"]["preview"] == "kept"
+
+
+def test_inbox_lists_the_latest_conversation_first(client, make_room, pair):
+    alice, bob, older = pair
+    newer = make_room([bob, alice])
+    assert [entry["id"] for entry in inbox(client, alice)] == [newer["id"], older["id"]]
+
+    post(client, older, bob, ["bump"])
+    assert [entry["id"] for entry in inbox(client, alice)] == [older["id"], newer["id"]]
@@ -0,0 +1,86 @@
+import uuid
+
+from app.models.models import key_from_bytes, key_to_bytes
+
+SEED = """
+    import json
+    from fastapi.testclient import TestClient
+    from main import app
+
+    with TestClient(app) as client:
+        credentials = {"email": "keys@test", "password": "secret"}
+        user = client.post(
+            "/auth/sign-up", json={"username": "keys", **credentials}
+        ).json()
+        token = client.post("/auth/sign-in", json=credentials).json()
+        headers = {"Authorization": f"Bearer {token['access_token']}"}
+        room = client.post(
+            "/chat-room",
+            json={"name": "keys", "members": [user["id"]]},
+            headers=headers,
+        ).json()
+        messages = client.post(
+            f"/messages/{room['id']}/batch",
+            json=[{"content": f"key {i}", "sender_id": user["id"]} for i in range(5)],
+            headers=headers,
+        ).json()
+    print(json.dumps({"user": user, "room": room, "messages": messages}))
+"""
+
+MIGRATE = """
+    import json
+    from app.migrations.compact_keys import migrate
+
+    print(json.dumps(migrate()))
+"""
+
+READ = """
+    import json
+    from fastapi.testclient import TestClient
+    from sqlalchemy import text
+    from app.database import engine
+    from main import app
+
+    with engine.connect() as connection:
+        stored = connection.scalars(
+            text("SELECT DISTINCT typeof(id) FROM messages")
+        ).all()
+    with TestClient(app) as client:
+        credentials = {"email": "keys@test", "password": "secret"}
+        token = client.post("/auth/sign-in", json=credentials).json()
+        headers = {"Authorization": f"Bearer {token['access_token']}"}
+        user_id = token["user"]["id"]
+        rooms = client.get(f"/user/rooms/{user_id}", headers=headers).json()
+        history = client.get(
+            f"/messages/{rooms[0]['id']}?cursor=true&limit=10"
+        ).json()
+    print(json.dumps({"stored": stored, "rooms": rooms, "history": history}))
+"""
+
+
+def test_keys_round_trip_in_order():
+    keys = sorted(str(uuid.uuid4()) for _ in range(100))
+    stored = [key_to_bytes(key) for key in keys]
+    assert all(len(key) == 16 for key in stored)
+    # Byte order is string order, so keyset pages are unchanged
+    assert stored == sorted(stored)
+    assert [key_from_bytes(key) for key in stored] == keys
+
+    # Anything else round-trips too, and never equals a UUID's bytes
+    assert key_from_bytes(key_to_bytes("not-a-uuid")) == "not-a-uuid"
+    assert len(key_to_bytes("not-a-uuid")) != 16
+
+
+def test_text_keys_migrate_to_binary_and_back(run_app):
+    seeded = run_app(SEED, KEY_STORAGE="text")
+
+    for storage, stored in (("binary", "blob"), ("text", "text")):
+        assert run_app(MIGRATE, KEY_STORAGE=storage)["messages"] == 5
+        read = run_app(READ, KEY_STORAGE=storage)
+
+        assert read["stored"] == [stored]
+        assert [room["id"] for room in read["rooms"]] == [seeded["room"]["id"]]
+        assert read["rooms"][0]["members"][0]["id"] == seeded["user"]["id"]
+        assert [message["id"] for message in read["history"]["messages"]] == [
+            message["id"] for message in reversed(seeded["messages"])
+        ]
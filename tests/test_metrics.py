@@ -0,0 +1,16 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from app.database import engine
+
+
+def test_failed_statements_leave_no_timing_behind(client):
+    # client, so the app has instrumented the engine
+    with engine.connect() as connection:
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                connection.execute(text("SELECT * FROM no_such_table"))
+        connection.rollback()
+        assert "query_started" not in connection.info
+        assert connection.execute(text("SELECT 1")).scalar() == 1
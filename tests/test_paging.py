@@ -0,0 +1,66 @@
+import pytest
+
+from app.controllers.controllers import PAGE_MAX_MESSAGES, SEARCH_MAX_RESULTS
+
+
+@pytest.fixture
+def room(client, make_user, make_room):
+    user = make_user()
+    room = make_room([user])
+    response = client.post(
+        f"/messages/{room['id']}/batch",
+        json=[{"content": f"paged {i}", "sender_id": user["id"]} for i in range(30)],
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
+    return room, user
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "limit=-2",
+        "limit=0",
+        f"limit={PAGE_MAX_MESSAGES + 1}",
+        "skip=-1",
+        "cursor=true&limit=-2",
+    ],
+)
+def test_room_history_rejects_unbounded_pages(client, room, query):
+    room, _ = room
+    response = client.get(f"/messages/{room['id']}?{query}")
+    assert response.status_code == 400
+
+
+def test_cursor_page_rejects_negative_limit(client, room):
+    room, _ = room
+    page = client.get(f"/messages/{room['id']}?cursor=true&limit=5").json()
+    response = client.get(
+        f"/messages/{room['id']}?before={page['next_cursor']}&limit=-2"
+    )
+    assert response.status_code == 400
+
+
+def test_other_pages_are_bounded(client, room):
+    _, user = room
+    assert client.get("/messages?limit=-2").status_code == 400
+    response = client.get(
+        "/search",
+        params={"q": "paged", "user_id": user["id"], "limit": SEARCH_MAX_RESULTS + 1},
+        headers=user["headers"],
+    )
+    assert response.status_code == 400
+    response = client.get(
+        "/sync", params={"user_id": user["id"], "limit": -2}, headers=user["headers"]
+    )
+    assert response.status_code == 400
+
+
+def test_pages_within_bounds(client, room):
+    room, _ = room
+    assert len(client.get(f"/messages/{room['id']}?limit=7").json()) == 7
+    page = client.get(f"/messages/{room['id']}?cursor=true&limit=5").json()
+    older = client.get(
+        f"/messages/{room['id']}?before={page['next_cursor']}&limit=5"
+    ).json()
+    assert len(older["messages"]) == 5
@@ -0,0 +1,68 @@
+import uuid
+
+import pytest
+
+from app.controllers.controllers import PROFILE_MAX_RECENT
+
+
+@pytest.fixture
+def busy_user(client, make_user, make_room):
+    user = make_user()
+    rooms = [make_room([user]) for _ in range(3)]
+    sent = []
+    for room in rooms:
+        response = client.post(
+            f"/messages/{room['id']}/batch",
+            json=[
+                {"content": f"{room['id']} {i}", "sender_id": user["id"]}
+                for i in range(5)
+            ],
+            headers=user["headers"],
+        )
+        assert response.status_code == 200
+        sent += response.json()
+    return user, rooms, sent
+
+
+def test_profile_is_bounded_and_projected(client, busy_user, record_statements):
+    user, rooms, sent = busy_user
+    with record_statements() as statements:
+        response = client.get(f"/users/{user['id']}?recent=4")
+    assert response.status_code == 200
+    profile = response.json()
+
+    assert set(profile) == {
+        "uuid",
+        "email",
+        "userName",
+        "roomCount",
+        "messageCount",
+        "rooms",
+        "sentMessages",
+    }
+    assert (profile["uuid"], profile["userName"]) == (user["id"], user["username"])
+    assert (profile["roomCount"], profile["messageCount"]) == (3, 15)
+    # Newest first, and no more than asked for
+    assert [message["id"] for message in profile["sentMessages"]] == [
+        message["id"] for message in sent[::-1][:4]
+    ]
+    assert [room["id"] for room in profile["rooms"]] == [
+        room["id"] for room in rooms[::-1]
+    ]
+    # The same few queries however long the history
+    selects = [statement for statement, _ in statements if "SELECT" in statement]
+    assert len(selects) <= 3
+
+    profile = client.get(f"/users/{user['id']}?recent=0").json()
+    assert profile["sentMessages"] == profile["rooms"] == []
+    assert profile["messageCount"] == 15
+
+
+@pytest.mark.parametrize("recent", [-1, PROFILE_MAX_RECENT + 1])
+def test_profile_rejects_unbounded_requests(client, busy_user, recent):
+    user, _, _ = busy_user
+    assert client.get(f"/users/{user['id']}?recent={recent}").status_code == 400
+
+
+def test_unknown_profile_is_404(client):
+    assert client.get(f"/users/{uuid.uuid4()}").status_code == 404
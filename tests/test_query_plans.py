@@ -0,0 +1,118 @@
+# The plans SQLite picks for the statements each route actually sends, so
+# an index that stops being used fails here instead of in production
+import pytest
+
+from app.cache import room_cache
+from app.database import engine
+
+
+@pytest.fixture
+def room(client, make_user, make_room):
+    user = make_user()
+    room = make_room([user, make_user()])
+    response = client.post(
+        f"/messages/{room['id']}/batch",
+        json=[{"content": f"message {i}", "sender_id": user["id"]} for i in range(20)],
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
+    return room, user, response.json()
+
+
+def plans(client, record_statements, method, path, **kwargs):
+    # EXPLAIN QUERY PLAN of every single-row SELECT and UPDATE the request
+    # sent, with the same parameters. The room page cache is emptied first
+    # so history is read from the table
+    room_cache.clear()
+    with record_statements() as statements:
+        response = client.request(method, path, **kwargs)
+    assert response.status_code == 200, response.text
+
+    details = []
+    with engine.connect() as connection:
+        for statement, parameters in statements:
+            if not isinstance(parameters, tuple):
+                continue
+            if statement.lstrip().upper().startswith(("SELECT", "UPDATE")):
+                rows = connection.exec_driver_sql(
+                    "EXPLAIN QUERY PLAN " + statement, parameters
+                )
+                details += [row[3] for row in rows]
+    return details
+
+
+def assert_searches(details, expected):
+    assert any(detail.startswith(expected) for detail in details), details
+    for table in ("messages", "user_chat_room", "change_log"):
+        assert not any(detail.split()[:2] == ["SCAN", table] for detail in details)
+
+
+def test_room_history_seeks_room_index(client, record_statements, room):
+    room, _, _ = room
+    path = f"/messages/{room['id']}"
+    expected = "SEARCH messages USING INDEX ix_messages_room_id_time_id"
+
+    newest = plans(client, record_statements, "GET", path + "?cursor=true&limit=5")
+    assert_searches(newest, expected)
+
+    page = client.get(path + "?cursor=true&limit=5").json()
+    older = plans(
+        client,
+        record_statements,
+        "GET",
+        f"{path}?before={page['next_cursor']}&limit=5",
+    )
+    assert_searches(older, expected)
+
+
+def test_profile_seeks_sender_index(client, record_statements, room):
+    _, user, _ = room
+    details = plans(client, record_statements, "GET", f"/users/{user['id']}")
+    assert_searches(
+        details, "SEARCH messages USING INDEX ix_messages_sender_id_time_id"
+    )
+
+
+def test_sync_seeks_change_log_index(client, record_statements, room):
+    _, user, _ = room
+    details = plans(
+        client,
+        record_statements,
+        "GET",
+        f"/sync?user_id={user['id']}&since=3",
+        headers=user["headers"],
+    )
+    assert_searches(
+        details,
+        "SEARCH change_log USING INDEX ix_change_log_room_id_seq (room_id=? AND seq>?)",
+    )
+
+
+def test_room_members_seek_room_index(client, record_statements, room):
+    room, user, _ = room
+    expected = "SEARCH user_chat_room USING COVERING INDEX ix_user_chat_room_room_id"
+    details = plans(
+        client,
+        record_statements,
+        "GET",
+        f"/user/rooms/{user['id']}",
+        headers=user["headers"],
+    )
+    assert_searches(details, expected)
+
+
+def test_message_write_updates_unread_through_room_index(
+    client, record_statements, room
+):
+    room, user, _ = room
+    details = plans(
+        client,
+        record_statements,
+        "POST",
+        f"/messages/{room['id']}",
+        json={"content": "new", "sender_id": user["id"]},
+        headers=user["headers"],
+    )
+    assert_searches(
+        details, "SEARCH user_chat_room USING INDEX ix_user_chat_room_room_id"
+    )
@@ -0,0 +1,32 @@
+from app.cache import room_cache
+
+
+def test_offset_reads_fill_the_room_cache(client, make_user, make_room):
+    user = make_user()
+    room = make_room([user])
+    response = client.post(
+        f"/messages/{room['id']}/batch",
+        json=[{"content": f"cached {i}", "sender_id": user["id"]} for i in range(5)],
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
+    room_cache.clear()
+    path = f"/messages/{room['id']}?skip=1&limit=3"
+
+    before = client.get("/stats/room-cache").json()
+    first = client.get(path).json()
+    after_miss = client.get("/stats/room-cache").json()
+    assert after_miss["misses"] == before["misses"] + 1
+    assert after_miss["rooms"] == before["rooms"] + 1
+
+    second = client.get(path).json()
+    after_hit = client.get("/stats/room-cache").json()
+    assert after_hit["hits"] == after_miss["hits"] + 1
+    assert after_hit["misses"] == after_miss["misses"]
+
+    assert first == second
+    assert [message["content"] for message in first] == [
+        "cached 1",
+        "cached 2",
+        "cached 3",
+    ]
@@ -0,0 +1,27 @@
+from app.cache import user_cache
+
+
+def room_list_statements(client, record_statements, user):
+    # A cold identity cache, so member lookups are counted too
+    user_cache.clear()
+    with record_statements() as statements:
+        response = client.get(f"/user/rooms/{user['id']}", headers=user["headers"])
+    assert response.status_code == 200
+    return response.json(), len(statements)
+
+
+def test_room_list_query_count_does_not_grow_with_rooms(
+    client, record_statements, make_user, make_room
+):
+    one, many = make_user(), make_user()
+    make_room([one, make_user()])
+    for _ in range(10):
+        make_room([many, make_user(), make_user()])
+
+    rooms, one_room = room_list_statements(client, record_statements, one)
+    assert len(rooms) == 1
+    rooms, ten_rooms = room_list_statements(client, record_statements, many)
+    assert len(rooms) == 10
+    assert all(len(room["members"]) == 3 for room in rooms)
+
+    assert ten_rooms == one_room
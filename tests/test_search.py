@@ -0,0 +1,114 @@
+import uuid
+
+import pytest
+from sqlalchemy import text
+
+from app.database import engine
+from app.search import check_search_index
+
+
+@pytest.fixture
+def word():
+    # A term no other test writes, so results are only this test's messages
+    return "kiwi" + uuid.uuid4().hex[:10]
+
+
+def post(client, room, user, contents):
+    response = client.post(
+        f"/messages/{room['id']}/batch",
+        json=[{"content": content, "sender_id": user["id"]} for content in contents],
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
+    return response.json()
+
+
+def search(client, headers=None, **params):
+    response = client.get("/search", params=params, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_closer_matches_rank_first(client, make_user, make_room, word):
+    user = make_user()
+    room = make_room([user])
+    post(
+        client,
+        room,
+        user,
+        [
+            f"a long message that mentions {word} once among many other words",
+            f"{word} {word}",
+        ],
+    )
+
+    results = search(client, q=word, room_id=room["id"])["results"]
+    assert [result["content"] for result in results] == [
+        f"{word} {word}",
+        f"a long message that mentions {word} once among many other words",
+    ]
+    assert results[0]["score"] <= results[1]["score"]
+    assert f"[{word}]" in results[0]["snippet"]
+
+
+def test_room_and_user_filters(client, make_user, make_room, word):
+    user, other = make_user(), make_user()
+    mine, shared, theirs = (
+        make_room([user]),
+        make_room([user, other]),
+        make_room([other]),
+    )
+    post(client, mine, user, [f"{word} in mine"])
+    post(client, shared, other, [f"{word} in shared"])
+    post(client, theirs, other, [f"{word} in theirs"])
+
+    def contents(results):
+        return sorted(result["content"] for result in results["results"])
+
+    assert contents(search(client, q=word, room_id=mine["id"])) == [f"{word} in mine"]
+    assert contents(
+        search(client, q=word, user_id=user["id"], headers=user["headers"])
+    ) == [f"{word} in mine", f"{word} in shared"]
+    assert contents(
+        search(client, q=word, user_id=other["id"], headers=other["headers"])
+    ) == [f"{word} in shared", f"{word} in theirs"]
+
+
+def test_cursor_continues_where_the_page_ended(client, make_user, make_room, word):
+    user = make_user()
+    room = make_room([user])
+    posted = post(client, room, user, [f"{word} number {i}" for i in range(7)])
+
+    seen = []
+    page = search(client, q=word, room_id=room["id"], limit=3)
+    while True:
+        seen += [result["id"] for result in page["results"]]
+        if not page["next_cursor"]:
+            break
+        page = search(
+            client, q=word, room_id=room["id"], limit=3, cursor=page["next_cursor"]
+        )
+
+    assert len(seen) == len(set(seen)) == 7
+    assert set(seen) == {message["id"] for message in posted}
+
+
+def test_renumbered_rowids_are_detected_and_rebuilt(
+    client, make_user, make_room, word
+):
+    user = make_user()
+    room = make_room([user])
+    post(client, room, user, [f"{word} before the renumbering"])
+
+    # What a VACUUM may do to a table without an INTEGER PRIMARY KEY
+    with engine.begin() as connection:
+        connection.execute(text("UPDATE messages SET rowid = rowid + 1000000"))
+    with engine.begin() as connection:
+        assert check_search_index(connection)
+    with engine.begin() as connection:
+        assert not check_search_index(connection)
+
+    results = search(client, q=word, room_id=room["id"])["results"]
+    assert [result["content"] for result in results] == [
+        f"{word} before the renumbering"
+    ]
@@ -0,0 +1,124 @@
+SHARDED = """
+    import json
+    from fastapi.testclient import TestClient
+    from sqlalchemy import select
+    from app.database import shard_engines, shard_for
+    from app.models.models import ChatRoom, Message, User
+    from main import app
+
+    def sign_up(client, name):
+        credentials = {"email": f"{name}@test", "password": "secret"}
+        client.post("/auth/sign-up", json={"username": name, **credentials})
+        token = client.post("/auth/sign-in", json=credentials).json()
+        token["user"]["headers"] = {
+            "Authorization": f"Bearer {token['access_token']}"
+        }
+        return token["user"]
+
+    with TestClient(app) as client:
+        alice, bob = sign_up(client, "alice"), sign_up(client, "bob")
+        rooms = [
+            client.post(
+                "/chat-room",
+                json={"name": f"room {i}", "members": [alice["id"], bob["id"]]},
+                headers=alice["headers"],
+            ).json()
+            for i in range(8)
+        ]
+        for i, room in enumerate(rooms):
+            client.post(
+                f"/messages/{room['id']}/batch",
+                json=[
+                    {"content": f"sharded {i} {j}", "sender_id": bob["id"]}
+                    for j in range(i + 1)
+                ],
+                headers=bob["headers"],
+            )
+        message = client.get(f"/messages/{rooms[0]['id']}").json()[0]
+        edited = client.put(
+            f"/messages/{message['id']}",
+            json={"content": "edited"},
+            headers=bob["headers"],
+        ).status_code
+
+        reads = {
+            "history": {
+                room["id"]: [
+                    m["content"]
+                    for m in client.get(f"/messages/{room['id']}?limit=20").json()
+                ]
+                for room in rooms
+            },
+            "rooms": client.get(
+                f"/user/rooms/{alice['id']}", headers=alice["headers"]
+            ).json(),
+            "inbox": client.get(
+                f"/users/{alice['id']}/inbox", headers=alice["headers"]
+            ).json(),
+            "search": client.get(
+                "/search",
+                params={"q": "sharded", "user_id": alice["id"], "limit": 100},
+                headers=alice["headers"],
+            ).json()["results"],
+            "profile": client.get(f"/users/{bob['id']}").json(),
+            "edited": edited,
+        }
+
+    stored = []
+    for engine in shard_engines:
+        with engine.connect() as connection:
+            stored.append(
+                {
+                    "users": connection.scalars(select(User.id)).all(),
+                    "rooms": connection.scalars(select(ChatRoom.id)).all(),
+                    "message_rooms": sorted(
+                        set(connection.scalars(select(Message.room_id)))
+                    ),
+                }
+            )
+    placement = {room["id"]: shard_for(room["id"]) for room in rooms}
+    print(
+        json.dumps(
+            {
+                "rooms": [room["id"] for room in rooms],
+                "users": [alice["id"], bob["id"]],
+                "reads": reads,
+                "stored": stored,
+                "placement": placement,
+            }
+        )
+    )
+"""
+
+
+def test_rooms_spread_over_shards_read_as_one(run_app):
+    result = run_app(SHARDED, SHARD_COUNT="3")
+    rooms, reads, stored = result["rooms"], result["reads"], result["stored"]
+    placement = result["placement"]
+
+    # Each room lives, with its messages, on the one shard it hashes to, and
+    # users only on the first
+    assert len(set(placement.values())) > 1
+    for shard, contents in enumerate(stored):
+        held = sorted(room for room in rooms if placement[room] == shard)
+        assert sorted(contents["rooms"]) == held
+        assert contents["message_rooms"] == held
+        assert sorted(contents["users"]) == (
+            sorted(result["users"]) if shard == 0 else []
+        )
+
+    # Reads across shards see everything, in the same order as one file
+    for i, room in enumerate(rooms):
+        expected = [f"sharded {i} {j}" for j in range(i + 1)]
+        if i == 0:
+            expected[0] = "edited"
+        assert sorted(reads["history"][room]) == sorted(expected)
+    assert reads["edited"] == 200
+    assert sorted(room["id"] for room in reads["rooms"]) == sorted(rooms)
+    assert [room["id"] for room in reads["inbox"]] == rooms[::-1]
+    assert [room["unread_count"] for room in reads["inbox"]] == list(
+        range(8, 0, -1)
+    )
+    assert len(reads["search"]) == sum(range(1, 9)) - 1
+    assert reads["profile"]["roomCount"] == 8
+    assert reads["profile"]["messageCount"] == sum(range(1, 9))
@@ -0,0 +1,72 @@
+import time
+
+from sqlalchemy import select
+
+from app.cache import LRUCache
+from app.database import SessionLocal
+from app.models.models import User
+
+
+def post(client, room, user, content):
+    response = client.post(
+        f"/messages/{room['id']}",
+        json={"content": content, "sender_id": user["id"]},
+        headers=user["headers"],
+    )
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_repeat_senders_are_served_from_the_cache(
+    client, make_user, make_room, record_statements
+):
+    user = make_user()
+    room = make_room([user])
+    post(client, room, user, "first")
+
+    before = client.get("/stats/user-cache").json()
+    with record_statements() as statements:
+        post(client, room, user, "second")
+    after = client.get("/stats/user-cache").json()
+
+    assert after["hits"] > before["hits"]
+    assert after["misses"] == before["misses"]
+    assert not any(
+        "FROM users" in statement and "users.username" in statement
+        for statement, _ in statements
+    )
+
+
+def test_changed_users_are_looked_up_again(client, make_user, make_room):
+    user = make_user()
+    room = make_room([user])
+    post(client, room, user, "before")
+
+    with SessionLocal() as db:
+        stored = db.scalar(select(User).where(User.id == user["id"]))
+        stored.username = "renamed-" + user["username"]
+        db.commit()
+
+    post(client, room, user, "after")
+    history = client.get(f"/messages/{room['id']}?cursor=true").json()["messages"]
+    assert [(message["content"], message["username"]) for message in history] == [
+        ("after", "renamed-" + user["username"]),
+        ("before", user["username"]),
+    ]
+
+
+def test_least_recently_used_and_expired_entries_go():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+
+    cache = LRUCache(maxsize=2, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
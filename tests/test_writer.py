@@ -0,0 +1,47 @@
+import contextlib
+import threading
+
+import pytest
+
+from app.writer import GroupCommitWriter
+
+
+@pytest.fixture
+def writer():
+    # Flushes by echoing each message back; the first batch waits for
+    # release so the test can queue behind it
+    release = threading.Event()
+    flushed = []
+
+    def flush(db, pending):
+        release.wait(5)
+        flushed.extend(message for message, _ in pending)
+        return [message.upper() for message, _ in pending]
+
+    writer = GroupCommitWriter(max_batch=1, max_delay_ms=0)
+    writer.start(contextlib.nullcontext, flush)
+    yield writer, release, flushed
+    release.set()
+    writer.stop()
+
+
+def test_cancelled_waiter_does_not_stop_the_writer(writer):
+    writer, release, flushed = writer
+    first = writer.submit("first", "room")
+    cancelled = writer.submit("gone", "room")
+    assert cancelled.cancel()
+    release.set()
+
+    assert first.result(5) == "FIRST"
+    assert writer.submit("next", "room").result(5) == "NEXT"
+    assert writer.running
+    assert "gone" not in flushed
+
+
+def test_failed_batch_does_not_stop_the_writer(writer):
+    writer, release, _ = writer
+    release.set()
+    with pytest.raises(AttributeError):
+        writer.submit(None, "room").result(5)
+    assert writer.submit("next", "room").result(5) == "NEXT"
+    assert writer.running